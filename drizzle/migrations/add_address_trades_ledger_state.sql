@@ -0,0 +1,47 @@
+-- address_trades 持倉賬本狀態
+-- 創建日期: 2026-10-19
+-- 持倉賬本（python-backend/position_ledger.py）不再按 address_trades.id 游標讀取新行：
+-- 亂序提交的 id 會被跳過，ON DUPLICATE KEY UPDATE 原地修改的行也不會重新應用。
+-- 改為每行記錄狀態：0 未應用，1 已應用，2 應用後金額被修改（所在市場的持倉按交易重建）
+
+SET @dbname = DATABASE();
+SET @tablename = 'address_trades';
+
+-- 1. 添加 ledger_state 欄位
+SET @columnname = 'ledger_state';
+SET @preparedStatement = (SELECT IF(
+  (SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+   WHERE (table_name = @tablename)
+   AND (table_schema = @dbname)
+   AND (column_name = @columnname)) > 0,
+  'SELECT 1',
+  'ALTER TABLE address_trades ADD COLUMN ledger_state TINYINT NOT NULL DEFAULT 0 COMMENT "持倉賬本狀態（0 未應用，1 已應用，2 應用後被修改）"'
+));
+PREPARE alterIfNotExists FROM @preparedStatement;
+EXECUTE alterIfNotExists;
+DEALLOCATE PREPARE alterIfNotExists;
+
+-- 2. 添加 (ledger_state, id) 索引（按狀態讀取待應用的行）
+SET @indexname = 'idx_ledger_state';
+SET @preparedStatement = (SELECT IF(
+  (SELECT COUNT(*) FROM INFORMATION_SCHEMA.STATISTICS
+   WHERE (table_name = @tablename)
+   AND (table_schema = @dbname)
+   AND (index_name = @indexname)) > 0,
+  'SELECT 1',
+  'ALTER TABLE address_trades ADD INDEX idx_ledger_state (ledger_state, id)'
+));
+PREPARE alterIfNotExists FROM @preparedStatement;
+EXECUTE alterIfNotExists;
+DEALLOCATE PREPARE alterIfNotExists;
+
+-- 3. 舊檢查點之前的行已經應用過
+UPDATE address_trades
+SET ledger_state = 1
+WHERE ledger_state = 0
+  AND id <= (
+    SELECT CAST(lastCursor AS UNSIGNED) FROM sync_state WHERE serviceName = 'position_ledger'
+  );
+
+-- 完成
+SELECT 'address_trades 持倉賬本狀態遷移完成！' AS status;
@@ -0,0 +1,53 @@
+-- 警報通知去重鍵
+-- 創建日期: 2026-10-19
+-- dedup_key = SHA1(user_id:alert_type:target_id:去重窗口編號)，由 Python 警報檢測器寫入，
+-- 唯一索引讓 INSERT IGNORE 冪等去重，取代按 JSON_EXTRACT(metadata, '$.target_id') 掃描
+-- 前端手動創建的通知 dedup_key 為 NULL，不受唯一索引限制
+
+SET @dbname = DATABASE();
+SET @tablename = 'alert_notifications';
+
+-- 1. 添加 dedup_key 欄位
+SET @columnname = 'dedup_key';
+SET @preparedStatement = (SELECT IF(
+  (SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+   WHERE (table_name = @tablename)
+   AND (table_schema = @dbname)
+   AND (column_name = @columnname)) > 0,
+  'SELECT 1',
+  'ALTER TABLE alert_notifications ADD COLUMN dedup_key CHAR(40) NULL COMMENT "去重鍵（SHA1）"'
+));
+PREPARE alterIfNotExists FROM @preparedStatement;
+EXECUTE alterIfNotExists;
+DEALLOCATE PREPARE alterIfNotExists;
+
+-- 2. 添加唯一索引
+SET @indexname = 'uniq_dedup_key';
+SET @preparedStatement = (SELECT IF(
+  (SELECT COUNT(*) FROM INFORMATION_SCHEMA.STATISTICS
+   WHERE (table_name = @tablename)
+   AND (table_schema = @dbname)
+   AND (index_name = @indexname)) > 0,
+  'SELECT 1',
+  'ALTER TABLE alert_notifications ADD UNIQUE INDEX uniq_dedup_key (dedup_key)'
+));
+PREPARE alterIfNotExists FROM @preparedStatement;
+EXECUTE alterIfNotExists;
+DEALLOCATE PREPARE alterIfNotExists;
+
+-- 3. 添加 created_at 索引（警報檢測器按時間預載入去重窗口內的去重鍵）
+SET @indexname = 'idx_created_at';
+SET @preparedStatement = (SELECT IF(
+  (SELECT COUNT(*) FROM INFORMATION_SCHEMA.STATISTICS
+   WHERE (table_name = @tablename)
+   AND (table_schema = @dbname)
+   AND (index_name = @indexname)) > 0,
+  'SELECT 1',
+  'ALTER TABLE alert_notifications ADD INDEX idx_created_at (created_at)'
+));
+PREPARE alterIfNotExists FROM @preparedStatement;
+EXECUTE alterIfNotExists;
+DEALLOCATE PREPARE alterIfNotExists;
+
+-- 完成
+SELECT '警報通知去重鍵遷移完成！' AS status;
@@ -0,0 +1,23 @@
+-- 多級價格彙總表
+-- 創建日期: 2026-10-19
+-- resolution 為彙總級別（秒）：60 / 900 / 3600 / 86400
+-- 只有 60 秒級別由原始交易構建，其餘級別由上一級彙總
+
+CREATE TABLE IF NOT EXISTS market_price_rollups (
+  market_id INT NOT NULL COMMENT '市場 ID',
+  resolution INT NOT NULL COMMENT '彙總級別（秒）',
+  bucket_start INT NOT NULL COMMENT '時間間隔起點（Unix 時間戳）',
+  open_price BIGINT NOT NULL COMMENT '開盤價（cents）',
+  high_price BIGINT NOT NULL COMMENT '最高價（cents）',
+  low_price BIGINT NOT NULL COMMENT '最低價（cents）',
+  close_price BIGINT NOT NULL COMMENT '收盤價（cents）',
+  vwap DECIMAL(14, 4) NOT NULL COMMENT '成交量加權平均價（cents）',
+  volume BIGINT NOT NULL DEFAULT 0 COMMENT '成交量',
+  trade_count INT NOT NULL DEFAULT 0 COMMENT '成交筆數',
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (market_id, resolution, bucket_start),
+  INDEX idx_resolution_bucket (resolution, bucket_start)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='多級價格彙總';
+
+-- 完成
+SELECT '多級價格彙總表遷移完成！' AS status;
@@ -0,0 +1,51 @@
+-- 市場結算（地址勝負和盈虧）
+-- 創建日期: 2026-10-19
+-- 結算引擎（python-backend/settlement_engine.py）在市場結算後按 address_trades 的淨持倉
+-- 更新 addresses 的勝負統計和已實現盈虧；market_settlements 記錄已結算的市場，保證每個市場只結算一次
+
+-- 1. 創建 market_settlements 表
+CREATE TABLE IF NOT EXISTS market_settlements (
+  market_id INT PRIMARY KEY COMMENT '市場 ID',
+  winning_outcome VARCHAR(10) NULL COMMENT '獲勝結果（YES/NO，非二元結果為 NULL）',
+  participants INT NOT NULL DEFAULT 0 COMMENT '結算的地址數',
+  winners INT NOT NULL DEFAULT 0 COMMENT '盈利地址數',
+  losers INT NOT NULL DEFAULT 0 COMMENT '虧損地址數',
+  total_pnl DECIMAL(20, 6) NOT NULL DEFAULT 0 COMMENT '所有地址的盈虧合計',
+  settled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '結算時間',
+  FOREIGN KEY (market_id) REFERENCES markets(id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='已結算市場';
+
+SET @dbname = DATABASE();
+
+-- 2. address_trades 添加 outcome 欄位（交易的結果 token）
+SET @tablename = 'address_trades';
+SET @columnname = 'outcome';
+SET @preparedStatement = (SELECT IF(
+  (SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+   WHERE (table_name = @tablename)
+   AND (table_schema = @dbname)
+   AND (column_name = @columnname)) > 0,
+  'SELECT 1',
+  'ALTER TABLE address_trades ADD COLUMN outcome ENUM("YES", "NO") NULL COMMENT "交易的結果（YES/NO）" AFTER side'
+));
+PREPARE alterIfNotExists FROM @preparedStatement;
+EXECUTE alterIfNotExists;
+DEALLOCATE PREPARE alterIfNotExists;
+
+-- 3. addresses 添加 realized_pnl 欄位
+SET @tablename = 'addresses';
+SET @columnname = 'realized_pnl';
+SET @preparedStatement = (SELECT IF(
+  (SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+   WHERE (table_name = @tablename)
+   AND (table_schema = @dbname)
+   AND (column_name = @columnname)) > 0,
+  'SELECT 1',
+  'ALTER TABLE addresses ADD COLUMN realized_pnl DECIMAL(20, 6) DEFAULT 0 COMMENT "已結算市場的已實現盈虧（USDC）" AFTER win_rate'
+));
+PREPARE alterIfNotExists FROM @preparedStatement;
+EXECUTE alterIfNotExists;
+DEALLOCATE PREPARE alterIfNotExists;
+
+-- 完成
+SELECT '市場結算遷移完成！' AS status;
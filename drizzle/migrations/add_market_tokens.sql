@@ -0,0 +1,17 @@
+-- 市場結果 token
+-- 創建日期: 2026-10-19
+-- 由 python-backend/market_tokens.py 從 Gamma API（clobTokenIds / outcomes）同步，
+-- 交易的 makerAssetId / takerAssetId 通過此表映射到市場和 YES / NO 結果
+
+CREATE TABLE IF NOT EXISTS market_tokens (
+  token_id VARCHAR(100) PRIMARY KEY COMMENT '結果 token 的 asset ID',
+  market_id INT NOT NULL COMMENT '市場 ID',
+  outcome ENUM('YES', 'NO') NOT NULL COMMENT '結果',
+  outcome_index TINYINT NOT NULL COMMENT '結果在市場 outcomes 中的位置',
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (market_id) REFERENCES markets(id) ON DELETE CASCADE,
+  UNIQUE KEY uk_market_outcome (market_id, outcome)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='市場結果 token';
+
+-- 完成
+SELECT '市場結果 token 遷移完成！' AS status;
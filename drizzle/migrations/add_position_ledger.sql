@@ -0,0 +1,25 @@
+-- 持倉賬本
+-- 創建日期: 2026-10-19
+-- 按 (地址, 市場, 結果) 記錄持倉，由 python-backend/position_ledger.py 增量應用 address_trades 的新行，
+-- 已應用到的 address_trades.id 記錄在 sync_state（serviceName = 'position_ledger'，lastCursor）
+
+CREATE TABLE IF NOT EXISTS position_ledger (
+  address_id INT NOT NULL COMMENT '地址 ID',
+  market_id INT NOT NULL COMMENT '市場 ID',
+  outcome ENUM('YES', 'NO') NOT NULL COMMENT '結果',
+  size DECIMAL(24, 6) NOT NULL DEFAULT 0 COMMENT '持倉份數',
+  cost_basis DECIMAL(24, 6) NOT NULL DEFAULT 0 COMMENT '當前持倉成本（USDC，平均成本法）',
+  realized_pnl DECIMAL(24, 6) NOT NULL DEFAULT 0 COMMENT '已實現盈虧（USDC）',
+  first_entry_at TIMESTAMP NULL COMMENT '首次建倉時間',
+  last_trade_at TIMESTAMP NULL COMMENT '最後交易時間',
+  trade_count INT NOT NULL DEFAULT 0 COMMENT '交易次數',
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (address_id, market_id, outcome),
+  FOREIGN KEY (address_id) REFERENCES addresses(id) ON DELETE CASCADE,
+  FOREIGN KEY (market_id) REFERENCES markets(id) ON DELETE CASCADE,
+  INDEX idx_market (market_id),
+  INDEX idx_first_entry (market_id, first_entry_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='持倉賬本';
+
+-- 完成
+SELECT '持倉賬本遷移完成！' AS status;
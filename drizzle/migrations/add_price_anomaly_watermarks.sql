@@ -0,0 +1,30 @@
+-- 價格異常檢測增量處理：每個市場的處理水位
+-- 創建日期: 2026-10-19
+
+-- 1. 創建 price_anomaly_watermarks 表（記錄每個市場已檢測到的最後一個價格點）
+CREATE TABLE IF NOT EXISTS price_anomaly_watermarks (
+  market_id INT NOT NULL PRIMARY KEY COMMENT '市場 ID',
+  last_timestamp TIMESTAMP NOT NULL COMMENT '最後處理的價格點時間',
+  last_price INT NOT NULL COMMENT '最後處理的價格（cents），用於銜接下一批數據',
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  FOREIGN KEY (market_id) REFERENCES markets(id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='價格異常檢測水位';
+
+-- 2. 確保 market_price_history 有 (market_id, timestamp) 索引，增量查詢依賴此索引
+SET @dbname = DATABASE();
+SET @tablename = 'market_price_history';
+SET @indexname = 'idx_market_timestamp';
+SET @preparedStatement = (SELECT IF(
+  (SELECT COUNT(*) FROM INFORMATION_SCHEMA.STATISTICS
+   WHERE (table_name = @tablename)
+   AND (table_schema = @dbname)
+   AND (index_name = @indexname)) > 0,
+  'SELECT 1',
+  'ALTER TABLE market_price_history ADD INDEX idx_market_timestamp (market_id, timestamp)'
+));
+PREPARE alterIfNotExists FROM @preparedStatement;
+EXECUTE alterIfNotExists;
+DEALLOCATE PREPARE alterIfNotExists;
+
+-- 完成
+SELECT '價格異常檢測水位遷移完成！' AS status;
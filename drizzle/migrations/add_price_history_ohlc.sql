@@ -0,0 +1,74 @@
+-- 價格歷史 OHLC 欄位
+-- 創建日期: 2026-10-19
+-- price 欄位保持為成交量加權平均價（VWAP），新增開高低收和成交筆數
+
+SET @dbname = DATABASE();
+SET @tablename = 'market_price_history';
+
+SET @columnname = 'open_price';
+SET @preparedStatement = (SELECT IF(
+  (SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+   WHERE (table_name = @tablename)
+   AND (table_schema = @dbname)
+   AND (column_name = @columnname)) > 0,
+  'SELECT 1',
+  'ALTER TABLE market_price_history ADD COLUMN open_price INT NULL COMMENT "開盤價（cents）"'
+));
+PREPARE alterIfNotExists FROM @preparedStatement;
+EXECUTE alterIfNotExists;
+DEALLOCATE PREPARE alterIfNotExists;
+
+SET @columnname = 'high_price';
+SET @preparedStatement = (SELECT IF(
+  (SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+   WHERE (table_name = @tablename)
+   AND (table_schema = @dbname)
+   AND (column_name = @columnname)) > 0,
+  'SELECT 1',
+  'ALTER TABLE market_price_history ADD COLUMN high_price INT NULL COMMENT "最高價（cents）"'
+));
+PREPARE alterIfNotExists FROM @preparedStatement;
+EXECUTE alterIfNotExists;
+DEALLOCATE PREPARE alterIfNotExists;
+
+SET @columnname = 'low_price';
+SET @preparedStatement = (SELECT IF(
+  (SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+   WHERE (table_name = @tablename)
+   AND (table_schema = @dbname)
+   AND (column_name = @columnname)) > 0,
+  'SELECT 1',
+  'ALTER TABLE market_price_history ADD COLUMN low_price INT NULL COMMENT "最低價（cents）"'
+));
+PREPARE alterIfNotExists FROM @preparedStatement;
+EXECUTE alterIfNotExists;
+DEALLOCATE PREPARE alterIfNotExists;
+
+SET @columnname = 'close_price';
+SET @preparedStatement = (SELECT IF(
+  (SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+   WHERE (table_name = @tablename)
+   AND (table_schema = @dbname)
+   AND (column_name = @columnname)) > 0,
+  'SELECT 1',
+  'ALTER TABLE market_price_history ADD COLUMN close_price INT NULL COMMENT "收盤價（cents）"'
+));
+PREPARE alterIfNotExists FROM @preparedStatement;
+EXECUTE alterIfNotExists;
+DEALLOCATE PREPARE alterIfNotExists;
+
+SET @columnname = 'trade_count';
+SET @preparedStatement = (SELECT IF(
+  (SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+   WHERE (table_name = @tablename)
+   AND (table_schema = @dbname)
+   AND (column_name = @columnname)) > 0,
+  'SELECT 1',
+  'ALTER TABLE market_price_history ADD COLUMN trade_count INT NOT NULL DEFAULT 0 COMMENT "成交筆數"'
+));
+PREPARE alterIfNotExists FROM @preparedStatement;
+EXECUTE alterIfNotExists;
+DEALLOCATE PREPARE alterIfNotExists;
+
+-- 完成
+SELECT '價格歷史 OHLC 欄位遷移完成！' AS status;
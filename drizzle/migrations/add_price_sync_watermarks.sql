@@ -0,0 +1,14 @@
+-- 價格歷史增量同步：每個市場最後一個已完成並同步的時間間隔
+-- 創建日期: 2026-10-19
+
+CREATE TABLE IF NOT EXISTS price_sync_watermarks (
+  market_id INT NOT NULL COMMENT '市場 ID',
+  interval_seconds INT NOT NULL COMMENT '聚合時間間隔（秒）',
+  last_closed_bucket INT NOT NULL COMMENT '最後一個已完成間隔的起點（Unix 時間戳）',
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (market_id, interval_seconds),
+  FOREIGN KEY (market_id) REFERENCES markets(id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='價格歷史同步水位';
+
+-- 完成
+SELECT '價格歷史同步水位遷移完成！' AS status;
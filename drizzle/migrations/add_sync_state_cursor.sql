@@ -0,0 +1,24 @@
+-- sync_state 游標檢查點
+-- 創建日期: 2026-10-19
+-- 按字符串 ID 游標分頁的同步服務（例如市場結算同步按 id_gt 分頁）把最後寫入的 ID 保存在 lastCursor，
+-- 中斷後從游標繼續；按時間同步的服務不使用此欄位
+
+SET @dbname = DATABASE();
+SET @tablename = 'sync_state';
+
+-- 1. 添加 lastCursor 欄位
+SET @columnname = 'lastCursor';
+SET @preparedStatement = (SELECT IF(
+  (SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+   WHERE (table_name = @tablename)
+   AND (table_schema = @dbname)
+   AND (column_name = @columnname)) > 0,
+  'SELECT 1',
+  'ALTER TABLE sync_state ADD COLUMN lastCursor VARCHAR(128) NULL COMMENT "最後同步的 ID 游標" AFTER lastTimestamp'
+));
+PREPARE alterIfNotExists FROM @preparedStatement;
+EXECUTE alterIfNotExists;
+DEALLOCATE PREPARE alterIfNotExists;
+
+-- 完成
+SELECT 'sync_state 游標檢查點遷移完成！' AS status;
@@ -0,0 +1,10 @@
+-- 多窗口異常檢測：擴展 market_anomalies.anomaly_type
+-- 創建日期: 2026-10-19
+-- 檢測器會寫入 price_spike、zscore_breakout_15m / 1h / 24h、range_breakout_15m / 1h / 24h，
+-- 類型隨窗口配置變化，因此改為 VARCHAR 而不是持續擴充 ENUM
+
+ALTER TABLE market_anomalies
+  MODIFY COLUMN anomaly_type VARCHAR(50) NOT NULL COMMENT '異常類型';
+
+-- 完成
+SELECT 'market_anomalies.anomaly_type 遷移完成！' AS status;
@@ -189,6 +189,7 @@ export const addresses = mysqlTable("addresses", {
   loss_count: int("loss_count").default(0),
   settled_count: int("settled_count").default(0),
   win_rate: decimal("win_rate", { precision: 5, scale: 2 }),
+  realized_pnl: decimal("realized_pnl", { precision: 20, scale: 6 }).default("0"), // 已實現盈虧（結算引擎更新）
   
   // 交易特徵
   avg_trade_size: decimal("avg_trade_size", { precision: 20, scale: 6 }),
@@ -216,6 +217,7 @@ export const syncState = mysqlTable("sync_state", {
   
   // 同步狀態
   lastTimestamp: int("lastTimestamp").notNull(), // 最後同步的時間戳
+  lastCursor: varchar("lastCursor", { length: 128 }), // 最後同步的 ID 游標（按 ID 分頁的服務）
   lastSyncAt: timestamp("lastSyncAt").notNull(), // 最後同步時間
   status: mysqlEnum("status", ["idle", "running", "error"]).default("idle").notNull(),
   errorMessage: text("errorMessage"),
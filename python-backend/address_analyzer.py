@@ -11,6 +11,7 @@ from mysql.connector import pooling
 import os
 from datetime import datetime, timedelta
 from typing import Dict, List, Tuple
+from event_bus import EVENT_ADDRESS_SCORE, send_event
 
 logger = logging.getLogger(__name__)
 
@@ -487,7 +488,7 @@ class AddressAnalyzer:
         
         try:
             # 獲取所有地址
-            cursor.execute("SELECT id FROM addresses")
+            cursor.execute("SELECT id, win_rate, total_volume FROM addresses")
             addresses = cursor.fetchall()
             
             logger.info(f"Found {len(addresses)} addresses to analyze")
@@ -510,6 +511,15 @@ class AddressAnalyzer:
                     WHERE id = %s
                 """, (total_score, total_score >= 50, address_id))
                 
+                # 通知主服務的警報引擎（主服務未運行時忽略）
+                send_event(EVENT_ADDRESS_SCORE, {
+                    'id': address_id,
+                    'address': score_data['address'],
+                    'suspicion_score': total_score,
+                    'win_rate': float(address['win_rate'] or 0),
+                    'total_volume': float(address['total_volume'] or 0)
+                })
+                
                 updated_count += 1
                 
                 if updated_count % 10 == 0:
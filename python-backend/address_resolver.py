@@ -0,0 +1,103 @@
+"""
+地址 ID 解析
+地址字符串 → addresses.id 的批量解析：進程內 LRU 緩存命中的直接返回，
+未命中的地址一次 SELECT ... IN 查詢，仍不存在的一次多行 INSERT IGNORE 創建後再查回 ID
+（取代逐條 SELECT + INSERT）
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+class AddressIdResolver:
+    """
+    address → id 的批量解析器（線程安全，可在多個寫入線程間共用）
+    
+    ID 創建後不會改變，緩存不需要失效，只按容量淘汰最久未使用的地址
+    """
+    
+    def __init__(self, capacity: int = 200000, batch_size: int = 1000):
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.ids: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        
+        # 統計
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+    
+    def _remember(self, resolved: Dict[str, int]):
+        with self.lock:
+            for address, address_id in resolved.items():
+                self.ids[address] = address_id
+                self.ids.move_to_end(address)
+            while len(self.ids) > self.capacity:
+                self.ids.popitem(last=False)
+    
+    @staticmethod
+    def _select_ids(cursor, addresses) -> Dict[str, int]:
+        cursor.execute(
+            f"SELECT address, id FROM addresses WHERE address IN ({', '.join(['%s'] * len(addresses))})",
+            tuple(addresses)
+        )
+        return {address: address_id for address, address_id in cursor.fetchall()}
+    
+    def resolve(self, cursor, addresses: Iterable[str]) -> Dict[str, int]:
+        """
+        解析一批地址的 ID，不存在的地址會被創建（在調用方的事務中，由調用方提交）
+        
+        Args:
+            cursor: 普通（非 dictionary）游標
+            addresses: 小寫地址
+        
+        Returns:
+            {address: id}
+        """
+        resolved: Dict[str, int] = {}
+        missing = []
+        
+        with self.lock:
+            for address in dict.fromkeys(addresses):
+                address_id = self.ids.get(address)
+                if address_id is None:
+                    missing.append(address)
+                else:
+                    self.ids.move_to_end(address)
+                    resolved[address] = address_id
+            self.hits += len(resolved)
+            self.misses += len(missing)
+        
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            found = self._select_ids(cursor, batch)
+            
+            unknown = [address for address in batch if address not in found]
+            if unknown:
+                cursor.execute(
+                    "INSERT IGNORE INTO addresses (address, first_seen_at, last_active_at) VALUES "
+                    + ', '.join(['(%s, NOW(), NOW())'] * len(unknown)),
+                    tuple(unknown)
+                )
+                self.created += cursor.rowcount
+                # 併發寫入時其他連接可能已經創建了同一地址，統一按地址查回；
+                # 新建的 ID 在調用方提交前可能被回滾，不放入緩存（下次解析時由 SELECT 查到後再緩存）
+                created = self._select_ids(cursor, unknown)
+                resolved.update(created)
+            
+            self._remember(found)
+            resolved.update(found)
+        
+        return resolved
+    
+    def stats(self) -> Dict[str, int]:
+        return {
+            'cached': len(self.ids),
+            'hits': self.hits,
+            'misses': self.misses,
+            'created': self.created
+        }
@@ -4,13 +4,202 @@
 """
 
 import mysql.connector
-from typing import List, Dict, Any, Optional
+from collections import OrderedDict
+from typing import Callable, List, Dict, Any, Optional
 from datetime import datetime, timedelta
+import hashlib
 import json
 import os
+import time
+
+# 各類警報的去重窗口（小時）
+DEDUP_WINDOW_HOURS = {
+    'high_suspicion_address': 24,
+    'large_trade': 1,
+    'price_spike': 1,
+}
+
+# 寫入失敗的通知最多嘗試的次數，超過後丟棄（不阻塞後面的通知）
+MAX_NOTIFICATION_ATTEMPTS = 3
+
+# 重試也不會成功的寫入錯誤（數據本身有問題）；連接中斷等其他錯誤保留整個隊列下次重試
+PERMANENT_WRITE_ERRORS = (
+    mysql.connector.DataError,
+    mysql.connector.IntegrityError,
+    mysql.connector.ProgrammingError,
+)
+
+# 觸發 price_spike 警報的異常類型（live_ 前綴為實時服務逐筆成交檢測的結果）
+PRICE_SPIKE_ANOMALY_TYPES = ('price_spike', 'live_price_spike')
+
+# dedup_key 有唯一索引，重複的通知被忽略（冪等）
+NOTIFICATION_INSERT_QUERY = """
+    INSERT IGNORE INTO alert_notifications
+    (user_id, subscription_id, alert_type, title, message, metadata, dedup_key, is_read)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, FALSE)
+"""
+
+# 批量寫入：一條多行 INSERT IGNORE
+NOTIFICATION_BULK_INSERT_QUERY = """
+    INSERT IGNORE INTO alert_notifications
+    (user_id, subscription_id, alert_type, title, message, metadata, dedup_key, is_read)
+    VALUES {values}
+"""
+
+# 批次的去重鍵和寫入時間：created_at 不早於本次寫入開始時間的是本次插入的
+# （被 INSERT IGNORE 忽略的重複鍵保留原有行較早的 created_at）
+WRITTEN_KEYS_QUERY = """
+    SELECT dedup_key, created_at >= %s AS inserted, UNIX_TIMESTAMP(created_at) AS created_at
+    FROM alert_notifications
+    WHERE dedup_key IN ({placeholders})
+"""
+
+# 去重窗口內已經寫入的去重鍵（預載入去重緩存）
+RECENT_KEYS_QUERY = """
+    SELECT dedup_key, UNIX_TIMESTAMP(created_at) AS created_at FROM alert_notifications
+    WHERE dedup_key IS NOT NULL
+      AND created_at >= %s
+    ORDER BY created_at DESC
+    LIMIT %s
+"""
+
+
+def dedup_window_seconds(alert_type: str) -> int:
+    """警報類型的去重窗口（秒）"""
+    return DEDUP_WINDOW_HOURS.get(alert_type, 24) * 3600
+
+
+def make_dedup_key(user_id: int, alert_type: str, target_id: str, now: Optional[float] = None) -> str:
+    """
+    通知去重鍵：(user_id, alert_type, target_id, 去重窗口編號) 的 SHA-1
+    
+    同一窗口編號內相同的通知得到相同的鍵（唯一索引保證只寫入一次）
+    """
+    bucket = int((now if now is not None else time.time()) // dedup_window_seconds(alert_type))
+    raw = f"{user_id}:{alert_type}:{target_id}:{bucket}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def dedup_keys(user_id: int, alert_type: str, target_id: str, now: float) -> tuple:
+    """
+    當前和上一個窗口編號的去重鍵 (current_key, previous_key)
+    
+    窗口編號按時間對齊，只比較當前編號時剛跨過邊界的重複通知會再次發送；
+    上一個編號的鍵在 now - 窗口之後寫入時同樣視為重複，去重窗口因此是滾動的
+    """
+    window_seconds = dedup_window_seconds(alert_type)
+    return (
+        make_dedup_key(user_id, alert_type, target_id, now),
+        make_dedup_key(user_id, alert_type, target_id, now - window_seconds),
+    )
+
+
+def trade_target_id(tx_hash: str) -> str:
+    """大額交易警報的 target_id：交易哈希（輪詢和事件驅動一致，同一筆交易得到相同的去重鍵）"""
+    return str(tx_hash)
+
+
+def anomaly_target_id(market_id: int, timestamp: int) -> str:
+    """價格異常警報的 target_id：市場 ID 和異常的 Unix 時間戳"""
+    return f"{market_id}:{int(timestamp)}"
+
+
+class DedupCache:
+    """
+    去重鍵的內存 LRU 緩存（資料庫唯一索引前的快速路徑）
+    
+    命中時直接跳過；未命中的通知交給 INSERT IGNORE，由唯一索引保證不重複
+    
+    只記錄已經提交到資料庫的鍵（寫入失敗的通知下次仍會重試，不會被緩存壓制），
+    每個鍵記錄資料庫中的寫入時間（Unix 時間戳），用於滾動窗口判斷
+    """
+    
+    def __init__(self, capacity: int = 100000):
+        self.capacity = capacity
+        self.keys: OrderedDict = OrderedDict()
+    
+    def seen(self, key: str, since: Optional[float] = None) -> bool:
+        """去重鍵是否已經提交過（指定 since 時只算 since 之後寫入的）"""
+        created_at = self.keys.get(key)
+        if created_at is None:
+            return False
+        self.keys.move_to_end(key)
+        return since is None or created_at >= since
+    
+    def seen_within(self, keys: tuple, since: float) -> bool:
+        """dedup_keys() 的結果是否在滾動窗口內提交過：當前編號的鍵，或 since 之後寫入的上一個編號的鍵"""
+        current_key, previous_key = keys
+        return self.seen(current_key) or self.seen(previous_key, since)
+    
+    def add(self, key: str, created_at: Optional[float] = None):
+        """記錄已提交的去重鍵"""
+        self.keys[key] = float(created_at) if created_at is not None else time.time()
+        self.keys.move_to_end(key)
+        if len(self.keys) > self.capacity:
+            self.keys.popitem(last=False)
+
+
+class AlertCycle:
+    """
+    一次檢測週期的狀態
+    
+    - 所有啟用的訂閱按 (alert_type, subscription_type, target_id) 建立內存索引
+    - 去重鍵緩存（跨週期共用，由 AlertDetector 持有）
+    - 本週期待寫入的通知，週期結束時一次批量插入
+    """
+    
+    def __init__(self, subscriptions: List[Dict[str, Any]], dedup_cache: DedupCache):
+        self.index: Dict[tuple, List[Dict[str, Any]]] = {}
+        for sub in subscriptions:
+            alert_types = sub['alert_types']
+            if isinstance(alert_types, str):
+                alert_types = json.loads(alert_types)
+            target_id = str(sub['target_id']) if sub['target_id'] is not None else None
+            for alert_type in alert_types or []:
+                self.index.setdefault((alert_type, sub['subscription_type'], target_id), []).append(sub)
+        
+        self.loaded_at = time.time()
+        self.dedup_cache = dedup_cache
+        self.pending: List[tuple] = []
+        self.pending_keys = set()
+        self.attempts: Dict[str, int] = {}  # 寫入失敗的去重鍵 -> 已嘗試次數
+    
+    def match(self, alert_type: str, subscription_type: str, target_id: str) -> List[Dict[str, Any]]:
+        """符合條件的訂閱"""
+        return self.index.get((alert_type, subscription_type, target_id), [])
+    
+    def add(self, sub: Dict[str, Any], alert_type: str, title: str, message: str,
+            metadata: Dict[str, Any]) -> bool:
+        """
+        加入待寫入的通知；滾動去重窗口內已經處理過時跳過
+        
+        Returns:
+            是否加入（加入後仍可能因為資料庫中已有相同的去重鍵而被 INSERT IGNORE 忽略）
+        """
+        now = time.time()
+        keys = dedup_keys(sub['user_id'], alert_type, metadata.get('target_id', ''), now)
+        dedup_key = keys[0]
+        if any(key in self.pending_keys for key in keys) or \
+                self.dedup_cache.seen_within(keys, now - dedup_window_seconds(alert_type)):
+            return False
+        
+        self.pending_keys.add(dedup_key)
+        self.pending.append((
+            sub['user_id'],
+            sub['id'],
+            alert_type,
+            title,
+            message,
+            json.dumps(metadata) if metadata else None,
+            dedup_key
+        ))
+        return True
+
 
 class AlertDetector:
     def __init__(self):
+        self.dedup_cache = DedupCache()
+        self.dedup_loaded_at: Optional[datetime] = None  # 上次預載入去重鍵的資料庫時間
         self.db_config = {
             'host': os.getenv('DB_HOST', 'localhost'),
             'user': os.getenv('DB_USER', 'root'),
@@ -94,6 +283,7 @@ class AlertDetector:
             cursor.execute("""
                 SELECT 
                     t.id,
+                    COALESCE(NULLIF(t.transactionHash, ''), t.tradeId) AS tx_hash,
                     t.userId,
                     t.marketId,
                     t.outcome,
@@ -125,11 +315,13 @@ class AlertDetector:
         
         try:
             # 查詢最近檢測到的價格異常
-            cursor.execute("""
+            placeholders = ', '.join(['%s'] * len(PRICE_SPIKE_ANOMALY_TYPES))
+            cursor.execute(f"""
                 SELECT 
                     ma.id,
                     ma.market_id,
                     ma.anomaly_type,
+                    UNIX_TIMESTAMP(ma.timestamp) AS anomaly_timestamp,
                     ma.price_before,
                     ma.price_after,
                     ma.change_percentage,
@@ -138,11 +330,11 @@ class AlertDetector:
                 FROM market_anomalies ma
                 LEFT JOIN markets m ON ma.market_id = m.id
                 WHERE ma.detected_at >= DATE_SUB(NOW(), INTERVAL 1 HOUR)
-                  AND ma.anomaly_type = 'price_spike'
+                  AND ma.anomaly_type IN ({placeholders})
                   AND ABS(ma.change_percentage) >= %s
                 ORDER BY ma.detected_at DESC
                 LIMIT 50
-            """, (threshold * 100,))
+            """, (*PRICE_SPIKE_ANOMALY_TYPES, threshold * 100))
             
             anomalies = cursor.fetchall()
             return anomalies
@@ -202,27 +394,30 @@ class AlertDetector:
         metadata: Optional[Dict[str, Any]] = None
     ) -> bool:
         """
-        創建通知記錄
+        創建通知記錄（同一去重窗口內的重複通知被忽略）
+        
+        Returns:
+            是否實際寫入
         """
+        if self.check_duplicate_notification(user_id, alert_type, metadata or {}):
+            return False
+        
         conn = self.get_connection()
         cursor = conn.cursor()
         
         try:
-            cursor.execute("""
-                INSERT INTO alert_notifications
-                (user_id, subscription_id, alert_type, title, message, metadata, is_read)
-                VALUES (%s, %s, %s, %s, %s, %s, FALSE)
-            """, (
+            cursor.execute(NOTIFICATION_INSERT_QUERY, (
                 user_id,
                 subscription_id,
                 alert_type,
                 title,
                 message,
-                json.dumps(metadata) if metadata else None
+                json.dumps(metadata) if metadata else None,
+                make_dedup_key(user_id, alert_type, (metadata or {}).get('target_id', ''))
             ))
             
             conn.commit()
-            return True
+            return cursor.rowcount > 0
         except Exception as e:
             print(f"Error creating notification: {e}")
             conn.rollback()
@@ -235,127 +430,253 @@ class AlertDetector:
         self,
         user_id: int,
         alert_type: str,
-        metadata: Dict[str, Any],
-        hours: int = 24
+        metadata: Dict[str, Any]
     ) -> bool:
         """
-        檢查是否已經發送過類似的通知（去重）
+        檢查滾動去重窗口內是否已經發送過相同的通知
+        
+        先查內存緩存，未命中時按 dedup_key 唯一索引查詢當前和上一個窗口編號的鍵
         """
+        now = time.time()
+        since = now - dedup_window_seconds(alert_type)
+        current_key, previous_key = dedup_keys(user_id, alert_type, metadata.get('target_id', ''), now)
+        if self.dedup_cache.seen_within((current_key, previous_key), since):
+            return True
+        
         conn = self.get_connection()
         cursor = conn.cursor()
         
         try:
-            # 檢查最近 N 小時內是否有相同的通知
             cursor.execute("""
-                SELECT COUNT(*) as count
-                FROM alert_notifications
-                WHERE user_id = %s
-                  AND alert_type = %s
-                  AND created_at >= DATE_SUB(NOW(), INTERVAL %s HOUR)
-                  AND JSON_EXTRACT(metadata, '$.target_id') = %s
-            """, (
-                user_id,
-                alert_type,
-                hours,
-                metadata.get('target_id', '')
-            ))
+                SELECT 1 FROM alert_notifications
+                WHERE dedup_key = %s
+                   OR (dedup_key = %s AND created_at >= FROM_UNIXTIME(%s))
+                LIMIT 1
+            """, (current_key, previous_key, since))
+            
+            return cursor.fetchone() is not None
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def _preload_dedup_keys(self, cursor):
+        """
+        把資料庫中已有的去重鍵載入去重緩存
+        
+        首次載入最長去重窗口內的所有鍵（重啟後不再依賴 INSERT IGNORE 逐條判斷），
+        之後只載入上次載入以來寫入的鍵（包括其他進程寫入的通知）
+        """
+        cursor.execute("SELECT NOW() AS now")
+        now = cursor.fetchone()['now']
+        since = self.dedup_loaded_at or now - timedelta(hours=max(DEDUP_WINDOW_HOURS.values()))
+        
+        cursor.execute(RECENT_KEYS_QUERY, (since, self.dedup_cache.capacity))
+        for row in reversed(cursor.fetchall()):
+            self.dedup_cache.add(row['dedup_key'], row['created_at'])
+        self.dedup_loaded_at = now
+    
+    def start_cycle(self) -> AlertCycle:
+        """
+        開始一個檢測週期：一次查詢載入所有啟用的訂閱，並預載入去重窗口內的去重鍵
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor(dictionary=True)
+        
+        try:
+            self._preload_dedup_keys(cursor)
+            
+            cursor.execute("""
+                SELECT id, user_id, subscription_type, target_id, alert_types
+                FROM alert_subscriptions
+                WHERE is_active = TRUE
+            """)
+            subscriptions = cursor.fetchall()
+            
+            return AlertCycle(subscriptions, self.dedup_cache)
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def _write_batch(self, conn, cursor, cycle: AlertCycle, batch: List[tuple], flush_start) -> List[tuple]:
+        """
+        一條多行 INSERT IGNORE 寫入一批通知並提交
+        
+        提交後去重鍵連同資料庫中的寫入時間記入去重緩存
+        
+        Returns:
+            本次實際插入的通知
+        """
+        values = ', '.join(['(%s, %s, %s, %s, %s, %s, %s, FALSE)'] * len(batch))
+        cursor.execute(
+            NOTIFICATION_BULK_INSERT_QUERY.format(values=values),
+            tuple(value for row in batch for value in row)
+        )
+        
+        keys = [row[6] for row in batch]
+        cursor.execute(
+            WRITTEN_KEYS_QUERY.format(placeholders=', '.join(['%s'] * len(keys))),
+            (flush_start, *keys)
+        )
+        written_keys = {dedup_key: (inserted, created_at) for dedup_key, inserted, created_at in cursor.fetchall()}
+        conn.commit()
+        
+        inserted_rows = []
+        for row in batch:
+            dedup_key = row[6]
+            inserted, created_at = written_keys.get(dedup_key, (False, None))
+            cycle.pending_keys.discard(dedup_key)
+            cycle.attempts.pop(dedup_key, None)
+            self.dedup_cache.add(dedup_key, created_at)
+            if inserted:
+                inserted_rows.append(row)
+        return inserted_rows
+    
+    def flush_notifications(self, cycle: AlertCycle, batch_size: int = 500) -> List[tuple]:
+        """
+        把週期內的通知寫入，每 batch_size 條一條多行 INSERT IGNORE 並提交一次
+        
+        插入後按 created_at 不早於本次寫入開始時間查詢批次的去重鍵，只有這些是本次插入的；
+        資料庫中已有相同去重鍵的通知（例如輪詢和事件驅動同時處理）不會出現在返回值中，避免重複推送；
+        去重鍵在批次提交後才記入去重緩存
+        
+        批次因數據錯誤失敗時逐條重寫找出失敗的通知，失敗的通知移到隊列末尾下次重試，
+        失敗 MAX_NOTIFICATION_ATTEMPTS 次後丟棄，不會一直阻塞後面的通知
+        
+        Returns:
+            實際插入的通知（NOTIFICATION_INSERT_QUERY 參數）；連接錯誤時未寫入的通知留在 cycle.pending 中下次重試
+        """
+        if not cycle.pending:
+            return []
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        written = []
+        retry = []
+        
+        try:
+            cursor.execute("SELECT NOW()")
+            flush_start = cursor.fetchone()[0]
             
-            result = cursor.fetchone()
-            return result[0] > 0
+            while cycle.pending:
+                batch = cycle.pending[:batch_size]
+                try:
+                    written.extend(self._write_batch(conn, cursor, cycle, batch, flush_start))
+                except PERMANENT_WRITE_ERRORS as e:
+                    conn.rollback()
+                    print(f"Error creating notifications, retrying one by one: {e}")
+                    for row in batch:
+                        try:
+                            written.extend(self._write_batch(conn, cursor, cycle, [row], flush_start))
+                        except PERMANENT_WRITE_ERRORS as row_error:
+                            conn.rollback()
+                            dedup_key = row[6]
+                            attempts = cycle.attempts.get(dedup_key, 0) + 1
+                            if attempts >= MAX_NOTIFICATION_ATTEMPTS:
+                                cycle.attempts.pop(dedup_key, None)
+                                cycle.pending_keys.discard(dedup_key)
+                                print(f"Dropping notification {dedup_key} ({row[2]} for user {row[0]}) "
+                                      f"after {attempts} failed attempts: {row_error}")
+                            else:
+                                cycle.attempts[dedup_key] = attempts
+                                retry.append(row)
+                del cycle.pending[:batch_size]
+            cycle.pending.extend(retry)
+            return written
+        except Exception as e:
+            print(f"Error creating notifications: {e}")
+            conn.rollback()
+            return written
         finally:
             cursor.close()
             conn.close()
     
-    def process_high_suspicion_alerts(self):
+    @staticmethod
+    def build_high_suspicion_alert(addr: Dict[str, Any]) -> tuple:
+        """高可疑度地址警報的 (title, message, metadata)"""
+        title = f"高可疑度地址警報：{addr['address'][:10]}..."
+        message = f"地址 {addr['address']} 的可疑度分數達到 {addr['suspicion_score']}，勝率 {addr['win_rate']:.1f}%，總交易量 ${addr['total_volume']:,.0f}"
+        metadata = {
+            'target_id': str(addr['id']),
+            'address': addr['address'],
+            'suspicion_score': addr['suspicion_score'],
+            'win_rate': float(addr['win_rate']),
+            'total_volume': float(addr['total_volume'])
+        }
+        return title, message, metadata
+    
+    @staticmethod
+    def build_price_spike_alert(target_id: str, anomaly: Dict[str, Any]) -> tuple:
+        """價格異常警報的 (title, message, metadata)"""
+        market_name = anomaly['market_name'] or ''
+        title = f"價格異常警報：{market_name[:50]}..."
+        message = f"市場 {market_name} 價格變動 {anomaly['change_percentage']:.1f}%（從 {anomaly['price_before']:.2f} 到 {anomaly['price_after']:.2f}）"
+        metadata = {
+            'target_id': target_id,
+            'market_id': anomaly['market_id'],
+            'market_name': market_name,
+            'price_before': float(anomaly['price_before']),
+            'price_after': float(anomaly['price_after']),
+            'change_percentage': float(anomaly['change_percentage'])
+        }
+        return title, message, metadata
+    
+    def process_high_suspicion_alerts(self, cycle: Optional[AlertCycle] = None):
         """
         處理高可疑度地址警報
+        
+        不傳入 cycle 時單獨運行（自己載入訂閱並寫入通知）
         """
+        own_cycle = cycle is None
+        if own_cycle:
+            cycle = self.start_cycle()
+        
         print("[AlertDetector] Checking for high suspicion addresses...")
         
         addresses = self.detect_high_suspicion_addresses()
         print(f"[AlertDetector] Found {len(addresses)} high suspicion addresses")
         
         for addr in addresses:
-            # 獲取訂閱了這個地址的用戶
-            subscriptions = self.get_subscriptions_for_alert_type(
-                'high_suspicion_address',
-                subscription_type='address',
-                target_id=str(addr['id'])
-            )
+            # 訂閱了這個地址的用戶
+            subscriptions = cycle.match('high_suspicion_address', 'address', str(addr['id']))
             
             for sub in subscriptions:
-                # 檢查是否已經發送過通知
-                if self.check_duplicate_notification(
-                    sub['user_id'],
-                    'high_suspicion_address',
-                    {'target_id': str(addr['id'])},
-                    hours=24
-                ):
-                    continue
-                
-                # 創建通知
-                title = f"高可疑度地址警報：{addr['address'][:10]}..."
-                message = f"地址 {addr['address']} 的可疑度分數達到 {addr['suspicion_score']}，勝率 {addr['win_rate']:.1f}%，總交易量 ${addr['total_volume']:,.0f}"
-                
-                self.create_notification(
-                    user_id=sub['user_id'],
-                    subscription_id=sub['id'],
-                    alert_type='high_suspicion_address',
-                    title=title,
-                    message=message,
-                    metadata={
-                        'target_id': str(addr['id']),
-                        'address': addr['address'],
-                        'suspicion_score': addr['suspicion_score'],
-                        'win_rate': float(addr['win_rate']),
-                        'total_volume': float(addr['total_volume'])
-                    }
-                )
-                
-                print(f"[AlertDetector] Created notification for user {sub['user_id']}")
+                cycle.add(sub, 'high_suspicion_address', *self.build_high_suspicion_alert(addr))
+        
+        if own_cycle:
+            created = self.flush_notifications(cycle)
+            print(f"[AlertDetector] Created {len(created)} notifications")
     
-    def process_large_trade_alerts(self):
+    def process_large_trade_alerts(self, cycle: Optional[AlertCycle] = None):
         """
         處理大額交易警報
+        
+        不傳入 cycle 時單獨運行（自己載入訂閱並寫入通知）
         """
+        own_cycle = cycle is None
+        if own_cycle:
+            cycle = self.start_cycle()
+        
         print("[AlertDetector] Checking for large trades...")
         
         trades = self.detect_large_trades(threshold=10000)
         print(f"[AlertDetector] Found {len(trades)} large trades")
         
         for trade in trades:
-            # 獲取訂閱了這個市場的用戶
-            market_subs = self.get_subscriptions_for_alert_type(
-                'large_trade',
-                subscription_type='market',
-                target_id=str(trade['marketId'])
-            )
+            # 訂閱了這個市場的用戶
+            subscriptions = cycle.match('large_trade', 'market', str(trade['marketId']))
             
-            all_subs = market_subs
-            
-            for sub in all_subs:
-                # 檢查是否已經發送過通知
-                if self.check_duplicate_notification(
-                    sub['user_id'],
-                    'large_trade',
-                    {'target_id': str(trade['id'])},
-                    hours=1
-                ):
-                    continue
-                
-                # 創建通知
+            for sub in subscriptions:
                 trade_value = trade['amount']
                 title = f"大額交易警報：${trade_value:,.0f}"
                 message = f"檢測到大額交易：{trade['market_name']} - {trade['outcome']}，交易金額 ${trade_value:,.0f}"
                 
-                self.create_notification(
-                    user_id=sub['user_id'],
-                    subscription_id=sub['id'],
-                    alert_type='large_trade',
-                    title=title,
-                    message=message,
-                    metadata={
-                        'target_id': str(trade['id']),
+                cycle.add(
+                    sub,
+                    'large_trade',
+                    title,
+                    message,
+                    {
+                        'target_id': trade_target_id(trade['tx_hash']),
                         'user_id': trade['userId'],
                         'market_id': trade['marketId'],
                         'market_name': trade['market_name'],
@@ -365,74 +686,192 @@ class AlertDetector:
                         'value': float(trade_value)
                     }
                 )
-                
-                print(f"[AlertDetector] Created notification for user {sub['user_id']}")
+        
+        if own_cycle:
+            created = self.flush_notifications(cycle)
+            print(f"[AlertDetector] Created {len(created)} notifications")
     
-    def process_price_spike_alerts(self):
+    def process_price_spike_alerts(self, cycle: Optional[AlertCycle] = None):
         """
         處理價格異常警報
+        
+        不傳入 cycle 時單獨運行（自己載入訂閱並寫入通知）
         """
+        own_cycle = cycle is None
+        if own_cycle:
+            cycle = self.start_cycle()
+        
         print("[AlertDetector] Checking for price spikes...")
         
         anomalies = self.detect_price_spikes(threshold=0.2)
         print(f"[AlertDetector] Found {len(anomalies)} price spikes")
         
         for anomaly in anomalies:
-            # 獲取訂閱了這個市場的用戶
-            subscriptions = self.get_subscriptions_for_alert_type(
-                'price_spike',
-                subscription_type='market',
-                target_id=str(anomaly['market_id'])
-            )
+            # 訂閱了這個市場的用戶
+            subscriptions = cycle.match('price_spike', 'market', str(anomaly['market_id']))
             
             for sub in subscriptions:
-                # 檢查是否已經發送過通知
-                if self.check_duplicate_notification(
-                    sub['user_id'],
-                    'price_spike',
-                    {'target_id': str(anomaly['id'])},
-                    hours=1
-                ):
-                    continue
-                
-                # 創建通知
-                title = f"價格異常警報：{anomaly['market_name'][:50]}..."
-                message = f"市場 {anomaly['market_name']} 價格變動 {anomaly['change_percentage']:.1f}%（從 {anomaly['price_before']:.2f} 到 {anomaly['price_after']:.2f}）"
-                
-                self.create_notification(
-                    user_id=sub['user_id'],
-                    subscription_id=sub['id'],
-                    alert_type='price_spike',
-                    title=title,
-                    message=message,
-                    metadata={
-                        'target_id': str(anomaly['id']),
-                        'market_id': anomaly['market_id'],
-                        'market_name': anomaly['market_name'],
-                        'price_before': float(anomaly['price_before']),
-                        'price_after': float(anomaly['price_after']),
-                        'change_percentage': float(anomaly['change_percentage'])
-                    }
-                )
-                
-                print(f"[AlertDetector] Created notification for user {sub['user_id']}")
+                target_id = anomaly_target_id(anomaly['market_id'], anomaly['anomaly_timestamp'])
+                cycle.add(sub, 'price_spike', *self.build_price_spike_alert(target_id, anomaly))
+        
+        if own_cycle:
+            created = self.flush_notifications(cycle)
+            print(f"[AlertDetector] Created {len(created)} notifications")
     
-    def run_detection_cycle(self):
+    def run_detection_cycle(self, event_driven: bool = False):
         """
         運行一次完整的檢測週期
+        
+        訂閱和去重鍵在週期開始時載入一次，所有檢測結果在內存中匹配，
+        週期結束時一次批量寫入通知
+        
+        Args:
+            event_driven: 主服務的 AlertEngine 已經實時處理交易和價格異常，
+                          只輪詢高可疑度地址（作為分數事件丟失時的兜底）
         """
         print(f"\n[AlertDetector] Starting detection cycle at {datetime.now()}")
         
         try:
-            self.process_high_suspicion_alerts()
-            self.process_large_trade_alerts()
-            self.process_price_spike_alerts()
+            cycle = self.start_cycle()
+            
+            self.process_high_suspicion_alerts(cycle)
+            if not event_driven:
+                self.process_large_trade_alerts(cycle)
+                self.process_price_spike_alerts(cycle)
             
+            created = self.flush_notifications(cycle)
+            print(f"[AlertDetector] Created {len(created)} notifications")
             print(f"[AlertDetector] Detection cycle completed at {datetime.now()}\n")
         except Exception as e:
             print(f"[AlertDetector] Error during detection cycle: {e}")
 
 
+class AlertEngine:
+    """
+    事件驅動警報引擎
+    
+    訂閱事件總線上的交易、價格異常和地址分數事件，收到事件後立即在內存索引中匹配訂閱並寫入通知，
+    不需要等待下一次輪詢。訂閱索引每 refresh_seconds 秒重新載入一次
+    
+    所有回調都在事件總線的分發線程中執行
+    """
+    
+    def __init__(
+        self,
+        detector: Optional[AlertDetector] = None,
+        large_trade_threshold: int = 10000,
+        suspicion_threshold: float = 80,
+        price_spike_threshold: float = 20.0,
+        refresh_seconds: int = 60,
+        on_notifications: Optional[Callable[[List[tuple]], None]] = None
+    ):
+        self.detector = detector or AlertDetector()
+        self.large_trade_threshold = large_trade_threshold  # cents，與 trades.amount 一致
+        self.suspicion_threshold = suspicion_threshold
+        self.price_spike_threshold = price_spike_threshold  # 百分比
+        self.refresh_seconds = refresh_seconds
+        self.on_notifications = on_notifications  # 通知寫入後的回調（例如實時推送）
+        self.cycle: Optional[AlertCycle] = None
+    
+    def attach(self, bus):
+        """訂閱事件總線"""
+        from event_bus import EVENT_TRADE, EVENT_ANOMALY, EVENT_ADDRESS_SCORE
+        bus.subscribe(EVENT_TRADE, self.on_trade)
+        bus.subscribe(EVENT_ANOMALY, self.on_anomaly)
+        bus.subscribe(EVENT_ADDRESS_SCORE, self.on_address_score)
+    
+    def _get_cycle(self) -> AlertCycle:
+        """返回當前訂閱索引，過期時重新載入（去重緩存由 detector 持有，不受影響）"""
+        if self.cycle is None or time.time() - self.cycle.loaded_at >= self.refresh_seconds:
+            cycle = self.detector.start_cycle()
+            if self.cycle is not None:
+                cycle.pending = self.cycle.pending
+                cycle.pending_keys = self.cycle.pending_keys
+                cycle.attempts = self.cycle.attempts
+            self.cycle = cycle
+        return self.cycle
+    
+    def _flush(self, cycle: AlertCycle):
+        created = self.detector.flush_notifications(cycle)
+        if created:
+            print(f"[AlertEngine] Created {len(created)} notifications")
+            if self.on_notifications:
+                self.on_notifications(created)
+    
+    def on_trade(self, event: Dict[str, Any]):
+        """
+        交易事件
+        
+        event: trade_id（交易哈希）, market_id, market_name, outcome, amount（cents）, price（cents）
+        """
+        if event['amount'] < self.large_trade_threshold:
+            return
+        
+        cycle = self._get_cycle()
+        subscriptions = cycle.match('large_trade', 'market', str(event['market_id']))
+        if not subscriptions:
+            return
+        
+        value = event['amount'] / 100
+        title = f"大額交易警報：${value:,.0f}"
+        message = f"檢測到大額交易：{event['market_name']} - {event['outcome']}，交易金額 ${value:,.0f}"
+        metadata = {
+            'target_id': trade_target_id(event['trade_id']),
+            'market_id': event['market_id'],
+            'market_name': event['market_name'],
+            'outcome': event['outcome'],
+            'amount': float(event['amount']),
+            'price': float(event['price']),
+            'value': float(value)
+        }
+        
+        for sub in subscriptions:
+            cycle.add(sub, 'large_trade', title, message, metadata)
+        self._flush(cycle)
+    
+    def on_anomaly(self, event: Dict[str, Any]):
+        """
+        價格異常事件
+        
+        event: market_id, market_name, anomaly_type, timestamp, price_before, price_after, change_percentage
+        （實時服務逐筆檢測的跳變類型為 live_price_spike，與 price_spike 匹配同一類訂閱）
+        """
+        if event['anomaly_type'] not in PRICE_SPIKE_ANOMALY_TYPES or \
+                abs(event['change_percentage']) < self.price_spike_threshold:
+            return
+        
+        cycle = self._get_cycle()
+        subscriptions = cycle.match('price_spike', 'market', str(event['market_id']))
+        if not subscriptions:
+            return
+        
+        target_id = anomaly_target_id(event['market_id'], event['timestamp'])
+        for sub in subscriptions:
+            cycle.add(sub, 'price_spike', *self.detector.build_price_spike_alert(target_id, event))
+        self._flush(cycle)
+    
+    def on_address_score(self, event: Dict[str, Any]):
+        """
+        地址分數更新事件
+        
+        event: id, address, suspicion_score, win_rate, total_volume
+        """
+        if event['suspicion_score'] < self.suspicion_threshold:
+            return
+        
+        cycle = self._get_cycle()
+        subscriptions = cycle.match('high_suspicion_address', 'address', str(event['id']))
+        if not subscriptions:
+            return
+        
+        for sub in subscriptions:
+            cycle.add(sub, 'high_suspicion_address', *self.detector.build_high_suspicion_alert(event))
+        self._flush(cycle)
+
+
 if __name__ == "__main__":
+    import sys
+    
     detector = AlertDetector()
-    detector.run_detection_cycle()
+    # --event-driven：主服務已實時處理交易和價格異常，只輪詢高可疑度地址
+    detector.run_detection_cycle(event_driven='--event-driven' in sys.argv)
@@ -3,21 +3,63 @@
 交易記錄轉換腳本
 將 trades 表的數據轉換成 address_trades 表
 為每筆交易創建兩條記錄（maker 和 taker）
+
+已歸檔的日期從交易歸檔（trade_archive）讀取，其餘時間範圍按時間流式查詢 trades 表
 """
 
 import os
 import sys
+import time
 from dotenv import load_dotenv
 import mysql.connector
 from mysql.connector import pooling
 from datetime import datetime
+from price_series_store import PriceSeriesStore
+from position_ledger import reset_position_ledger
+from market_tokens import MarketTokenSyncer, load_token_outcomes
+from trade_archive import DAY_SECONDS, TradeArchiveReader, day_label
 
 # 加載環境變量
 load_dotenv()
 
+# CTF Exchange 中抵押品（USDC）的 asset ID，其他 asset ID 都是結果 token
+COLLATERAL_ASSET_ID = '0'
+
+# USDC 和結果 token 都是 6 位小數
+TOKEN_DECIMALS = 10**6
+
+# 轉換需要的交易列（歸檔和 trades 表同名）
+TRADE_COLUMNS = [
+    'id', 'marketId', 'makerAddress', 'takerAddress', 'makerAssetId', 'takerAssetId',
+    'makerAmount', 'takerAmount', 'price', 'side', 'timestamp'
+]
+
+
+def trade_directions(maker_asset_id, taker_asset_id):
+    """
+    根據雙方支付的資產判斷方向：支付 USDC 的一方買入結果 token，支付 token 的一方賣出
+    
+    Returns:
+        (maker_side, taker_side)；雙方都是 token（無法判斷方向）時返回 None
+    """
+    if str(maker_asset_id) == COLLATERAL_ASSET_ID:
+        return 'buy', 'sell'
+    if str(taker_asset_id) == COLLATERAL_ASSET_ID:
+        return 'sell', 'buy'
+    return None
+
+
+def outcome_token(maker_asset_id, taker_asset_id):
+    """交易中結果 token 一方的 asset ID（另一方是 USDC）"""
+    if str(maker_asset_id) == COLLATERAL_ASSET_ID:
+        return str(taker_asset_id)
+    return str(maker_asset_id)
+
 class AddressTradesBuilder:
     def __init__(self):
         self.db_pool = self._create_db_pool()
+        self.price_series_store = PriceSeriesStore()
+        self.archive = TradeArchiveReader()
         
     def _parse_database_url(self, url):
         """解析 DATABASE_URL"""
@@ -56,10 +98,10 @@ class AddressTradesBuilder:
             **db_config
         )
     
-    def fetch_all_trades(self):
-        """獲取所有交易記錄"""
+    def _iter_trades_query(self, start_time, end_time, fetch_size=5000):
+        """流式查詢 trades 表中 [start_time, end_time) 的交易（按時間排序）"""
         conn = self.db_pool.get_connection()
-        cursor = conn.cursor(dictionary=True)
+        cursor = conn.cursor(dictionary=True, buffered=False)
         
         try:
             cursor.execute("""
@@ -68,29 +110,69 @@ class AddressTradesBuilder:
                     marketId,
                     makerAddress,
                     takerAddress,
+                    makerAssetId,
+                    takerAssetId,
                     makerAmount,
                     takerAmount,
                     price,
                     side,
-                    timestamp,
-                    createdAt
+                    timestamp
                 FROM trades
                 WHERE makerAddress IS NOT NULL 
                   AND takerAddress IS NOT NULL
+                  AND timestamp >= FROM_UNIXTIME(%s)
+                  AND timestamp < FROM_UNIXTIME(%s)
                 ORDER BY timestamp ASC
-            """)
-            
-            trades = cursor.fetchall()
-            print(f"✅ Fetched {len(trades)} trades from database")
-            return trades
+            """, (start_time, end_time))
             
-        except Exception as e:
-            print(f"❌ Error fetching trades: {e}")
-            return []
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield from rows
         finally:
             cursor.close()
             conn.close()
     
+    def _iter_archived_day(self, day):
+        """
+        讀取一天的歸檔交易（按時間排序，與 trades 表的查詢結果格式一致）
+        
+        較早導出、沒有 asset ID 列的文件無法判斷方向，改為查詢 trades 表
+        """
+        table = self.archive.read_day(day, columns=TRADE_COLUMNS)
+        if table.num_rows and table.column('makerAssetId').null_count == table.num_rows:
+            print(f"⚠️  Archive for {day_label(day)} has no asset IDs, reading it from the database")
+            yield from self._iter_trades_query(day, day + DAY_SECONDS)
+            return
+        
+        table = table.sort_by([('timestamp', 'ascending'), ('id', 'ascending')])
+        for trade in table.to_pylist():
+            if trade['makerAddress'] is None or trade['takerAddress'] is None:
+                continue
+            trade['timestamp'] = datetime.fromtimestamp(trade['timestamp'])
+            yield trade
+    
+    def iter_trades(self):
+        """
+        按時間順序逐條讀取所有交易（不把整個 trades 表讀入內存）
+        
+        已歸檔的日期從本地 Parquet 文件讀取，第一個歸檔日期之前和未歸檔的日期查詢 trades 表
+        """
+        end_time = int(time.time()) + 1
+        days = self.archive.archived_days()
+        if not days:
+            yield from self._iter_trades_query(0, end_time)
+            return
+        
+        yield from self._iter_trades_query(0, days[0])
+        for range_from, range_to, archived in self.archive.split_range(days[0], end_time):
+            if archived:
+                yield from self._iter_archived_day(range_from)
+            else:
+                yield from self._iter_trades_query(range_from, range_to)
+        print(f"✅ Read {len(days)} day(s) of trades from the archive")
+    
     def build_address_map(self):
         """批量獲取所有地址 ID"""
         conn = self.db_pool.get_connection()
@@ -114,7 +196,25 @@ class AddressTradesBuilder:
             cursor.close()
             conn.close()
     
-    def build_address_trades(self, trades, address_map):
+    def build_token_map(self):
+        """同步缺少的市場結果 token，然後批量獲取 token_id -> (market_id, outcome)"""
+        try:
+            MarketTokenSyncer().run()
+        except Exception as e:
+            print(f"⚠️  Error syncing market tokens: {e}")
+        
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            token_map = load_token_outcomes(cursor)
+            print(f"✅ Built token map with {len(token_map)} outcome tokens")
+            return token_map
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def build_address_trades(self, trades, address_map, token_map):
         """將交易轉換成地址交易記錄"""
         conn = self.db_pool.get_connection()
         cursor = conn.cursor()
@@ -124,31 +224,46 @@ class AddressTradesBuilder:
             cursor.execute("TRUNCATE TABLE address_trades")
             print("✅ Cleared existing address_trades table")
             
+            # address_trades 的 id 重新開始，持倉賬本需要從頭重建
+            reset_position_ledger(cursor)
+            
             address_trades = []
             skipped = 0
+            unmapped = 0
+            processed = 0
             
-            print(f"Processing {len(trades)} trades...")
+            print("Processing trades...")
             
             for trade in trades:
+                processed += 1
                 trade_id = trade['id']
                 market_id = trade['marketId']
                 maker_address = trade['makerAddress']
                 taker_address = trade['takerAddress']
                 maker_amount = float(trade['makerAmount']) if trade['makerAmount'] else 0
                 taker_amount = float(trade['takerAmount']) if trade['takerAmount'] else 0
-                price = float(trade['price']) if trade['price'] else 0
-                side = trade['side']  # 'BUY' or 'SELL'
                 timestamp = trade['timestamp']
                 
                 # 為 maker 和 taker 生成不同的 tx_hash
                 maker_tx_hash = f"0x{trade_id:064x}"
                 taker_tx_hash = f"0x{(trade_id + 1000000):064x}"
                 
-                # 跳過 market_id 為 NULL 的交易
-                if not market_id:
+                directions = trade_directions(trade['makerAssetId'], trade['takerAssetId'])
+                if directions is None:
+                    skipped += 1
+                    print(f"Skipped trade {trade_id}: no collateral leg, direction unknown")
+                    continue
+                maker_side, taker_side = directions
+                
+                # 成交的結果 token 決定 outcome（trades.side 由 asset ID 大小推測，不可靠）；
+                # orderbook 收集的交易沒有 marketId，同樣從 token 所屬的市場獲取
+                token = token_map.get(outcome_token(trade['makerAssetId'], trade['takerAssetId']))
+                if token is None:
                     skipped += 1
-                    print(f"Skipped trade {trade_id}: market_id is NULL")
+                    unmapped += 1
                     continue
+                token_market_id, outcome = token
+                market_id = market_id or token_market_id
                 
                 # 獲取地址 ID
                 maker_address_id = address_map.get(maker_address)
@@ -159,61 +274,74 @@ class AddressTradesBuilder:
                     print(f"Skipped trade {trade_id}: maker={maker_address} (ID={maker_address_id}), taker={taker_address} (ID={taker_address_id})")
                     continue
                 
+                # 與 split / merge / redemption 行的單位一致（持倉賬本按此計算）：
+                # amount 為成交的 USDC 金額，price 為每份價格（0-1）
+                if maker_side == 'buy':
+                    usdc_amount, share_amount = maker_amount, taker_amount
+                else:
+                    usdc_amount, share_amount = taker_amount, maker_amount
+                if usdc_amount <= 0 or share_amount <= 0:
+                    skipped += 1
+                    print(f"Skipped trade {trade_id}: empty fill")
+                    continue
+                amount = usdc_amount / TOKEN_DECIMALS
+                price = usdc_amount / share_amount
+                
+                # 當時的市場價格（本地價格序列，cents → 0-1），沒有數據時使用成交價
+                market_price = self.price_series_store.price_at(market_id, int(timestamp.timestamp()))
+                market_price = market_price / 100 if market_price is not None else price
+                
                 # Maker 記錄
-                # 如果 side 是 'BUY'，maker 是賣方（sell）
-                # 如果 side 是 'SELL'，maker 是買方（buy）
-                maker_side = 'sell' if side == 'BUY' else 'buy'
                 maker_trade = (
                     maker_address_id,
                     market_id,
                     maker_tx_hash,
                     None,  # trade_type
-                    maker_amount,
+                    amount,
                     price,
                     maker_side,
                     timestamp,
-                    price,  # market_price_at_time
+                    market_price,  # market_price_at_time
                     0,  # is_whale
+                    outcome,
                     datetime.now()
                 )
                 address_trades.append(maker_trade)
                 
                 # Taker 記錄
-                # 如果 side 是 'BUY'，taker 是買方（buy）
-                # 如果 side 是 'SELL'，taker 是賣方（sell）
-                taker_side = 'buy' if side == 'BUY' else 'sell'
                 taker_trade = (
                     taker_address_id,
                     market_id,
                     taker_tx_hash,
                     None,  # trade_type
-                    taker_amount,
+                    amount,
                     price,
                     taker_side,
                     timestamp,
-                    price,  # market_price_at_time
+                    market_price,  # market_price_at_time
                     0,  # is_whale
+                    outcome,
                     datetime.now()
                 )
                 address_trades.append(taker_trade)
             
             print(f"\nTotal trades to insert: {len(address_trades)}")
-            print(f"Skipped: {skipped}")
+            print(f"Skipped: {skipped} ({unmapped} with unknown outcome token)")
             
             # 批量插入
             if address_trades:
                 cursor.executemany("""
                     INSERT INTO address_trades (
                         address_id, market_id, tx_hash, trade_type, amount, price, side, 
-                        timestamp, market_price_at_time, is_whale, created_at
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        timestamp, market_price_at_time, is_whale, outcome, created_at
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 """, address_trades)
                 
                 conn.commit()
                 print(f"✅ Inserted {len(address_trades)} address trades")
-                print(f"   - Expected: {len(trades) * 2}")
+                print(f"   - Expected: {processed * 2}")
                 print(f"   - Actual: {len(address_trades)}")
-                print(f"   - Skipped: {skipped} trades (address not found)")
+                print(f"   - Skipped: {skipped} trades (address not found, direction or outcome unknown)")
             
         except Exception as e:
             conn.rollback()
@@ -265,12 +393,12 @@ class AddressTradesBuilder:
         # 批量獲取所有地址 ID
         address_map = self.build_address_map()
         
-        # 獲取所有交易
-        trades = self.fetch_all_trades()
+        # 結果 token 映射（交易的 outcome 和 orderbook 交易的市場）
+        token_map = self.build_token_map()
         
-        if trades and address_map:
-            # 轉換成地址交易記錄
-            self.build_address_trades(trades, address_map)
+        if address_map:
+            # 逐條讀取所有交易並轉換成地址交易記錄
+            self.build_address_trades(self.iter_trades(), address_map, token_map)
             
             # 驗證數據
             self.verify_data()
@@ -0,0 +1,174 @@
+"""
+實時 K 線構建器
+由 RTDS 交易流直接構建每個市場當前時間間隔的 OHLCV，
+間隔結束後批量寫入 market_price_history（price_sync_service.py 只用於回填）
+"""
+
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+
+class LiveCandleBuilder:
+    """
+    實時 K 線構建器
+    
+    每個市場佔用一個槽位，當前間隔的 OHLCV 存放在按槽位索引的定長數組中，
+    每筆交易 O(1) 更新，不為每筆交易創建對象。
+    線程安全：交易回調線程寫入，事件循環線程定期調用 roll / drain_closed
+    
+    構建器啟動前已經開始的間隔只看到部分交易，不會寫入資料庫，
+    留給 PriceSyncService 從 trades 表回填，避免用不完整的數據覆蓋
+    """
+    
+    def __init__(self, interval_seconds: int = 900):
+        self.interval_seconds = interval_seconds
+        self.slots: Dict[int, int] = {}       # market_id -> 槽位
+        self.market_ids = array('q')
+        self.condition_ids: List[str] = []
+        self.bucket_start = array('q')        # 0 表示槽位當前沒有未完成的間隔
+        self.open = array('q')
+        self.high = array('q')
+        self.low = array('q')
+        self.close = array('q')
+        self.volume = array('q')
+        self.notional = array('d')
+        self.trade_count = array('q')
+        
+        # 已完成、等待寫入資料庫的間隔（price_sync_service.PRICE_HISTORY_UPSERT_QUERY 參數）
+        self.closed_rows: List[Tuple] = []
+        self.lock = threading.Lock()
+        self.started_at = int(time.time())
+    
+    def _get_slot(self, market_id: int, condition_id: str) -> int:
+        slot = self.slots.get(market_id)
+        if slot is None:
+            slot = len(self.market_ids)
+            self.slots[market_id] = slot
+            self.market_ids.append(market_id)
+            self.condition_ids.append(condition_id)
+            for column in (self.bucket_start, self.open, self.high, self.low,
+                           self.close, self.volume, self.trade_count):
+                column.append(0)
+            self.notional.append(0.0)
+        return slot
+    
+    def _close_slot(self, slot: int):
+        """把槽位當前的間隔移到待寫入隊列"""
+        if self.bucket_start[slot] < self.started_at:
+            # 啟動前已開始的間隔數據不完整
+            self.bucket_start[slot] = 0
+            return
+        
+        count = self.trade_count[slot]
+        volume = self.volume[slot]
+        if volume > 0:
+            vwap = self.notional[slot] / volume
+        else:
+            vwap = self.close[slot]
+        
+        self.closed_rows.append((
+            self.market_ids[slot],
+            self.condition_ids[slot],
+            int(vwap),
+            self.open[slot],
+            self.high[slot],
+            self.low[slot],
+            self.close[slot],
+            volume,
+            count,
+            self.bucket_start[slot]
+        ))
+        self.bucket_start[slot] = 0
+    
+    def on_trade(self, market_id: int, condition_id: str, timestamp: int,
+                 price: int, volume: int) -> Dict:
+        """
+        處理一筆交易
+        
+        Args:
+            market_id: 市場 ID
+            condition_id: 市場條件 ID
+            timestamp: 交易時間（Unix 時間戳，秒）
+            price: 價格（cents）
+            volume: 成交金額（cents，與 trades.amount 一致）
+        
+        Returns:
+            更新後的當前 K 線
+        """
+        bucket = (timestamp // self.interval_seconds) * self.interval_seconds
+        
+        with self.lock:
+            slot = self._get_slot(market_id, condition_id)
+            current = self.bucket_start[slot]
+            
+            # 遲到的交易屬於已完成的間隔，交給回填任務處理
+            if current and bucket < current:
+                return self._candle(slot)
+            
+            if current and bucket > current:
+                self._close_slot(slot)
+                current = 0
+            
+            if not current:
+                self.bucket_start[slot] = bucket
+                self.open[slot] = price
+                self.high[slot] = price
+                self.low[slot] = price
+                self.volume[slot] = 0
+                self.notional[slot] = 0.0
+                self.trade_count[slot] = 0
+            else:
+                if price > self.high[slot]:
+                    self.high[slot] = price
+                if price < self.low[slot]:
+                    self.low[slot] = price
+            
+            self.close[slot] = price
+            self.volume[slot] += volume
+            self.notional[slot] += price * volume
+            self.trade_count[slot] += 1
+            
+            return self._candle(slot)
+    
+    def _candle(self, slot: int) -> Dict:
+        volume = self.volume[slot]
+        return {
+            'marketId': self.market_ids[slot],
+            'conditionId': self.condition_ids[slot],
+            'interval': self.interval_seconds,
+            'timestamp': self.bucket_start[slot],
+            'open': self.open[slot],
+            'high': self.high[slot],
+            'low': self.low[slot],
+            'close': self.close[slot],
+            'vwap': self.notional[slot] / volume if volume > 0 else self.close[slot],
+            'volume': volume,
+            'tradeCount': self.trade_count[slot]
+        }
+    
+    def roll(self, now: int):
+        """關閉所有已經結束、但之後沒有新交易的間隔"""
+        current_bucket = (now // self.interval_seconds) * self.interval_seconds
+        with self.lock:
+            for slot in range(len(self.market_ids)):
+                start = self.bucket_start[slot]
+                if start and start < current_bucket:
+                    self._close_slot(slot)
+    
+    def drain_closed(self, max_rows: Optional[int] = None) -> List[Tuple]:
+        """取出待寫入的已完成間隔"""
+        with self.lock:
+            if max_rows is None or max_rows >= len(self.closed_rows):
+                rows = self.closed_rows
+                self.closed_rows = []
+            else:
+                rows = self.closed_rows[:max_rows]
+                del self.closed_rows[:max_rows]
+            return rows
+    
+    def requeue(self, rows: List[Tuple]):
+        """寫入失敗時把數據放回隊列，下次重試"""
+        with self.lock:
+            self.closed_rows[:0] = rows
@@ -68,6 +68,39 @@ IGNORE_SPORTS_KEYWORDS = [
     "score", "win", "lose", "defeat", "victory", "champion", "sports"
 ]
 
+# ============ Anomaly Detection ============
+# 實時異常檢測（逐筆成交，異常類型帶 live_ 前綴）：相鄰成交價格變動閾值（百分比）
+ANOMALY_SPIKE_THRESHOLD_PERCENT = float(os.getenv("ANOMALY_SPIKE_THRESHOLD_PERCENT", "20"))
+
+# ============ Live Candles ============
+# 實時 K 線間隔（秒），與 PriceSyncService 的聚合間隔一致
+CANDLE_INTERVAL_SECONDS = int(os.getenv("CANDLE_INTERVAL_SECONDS", "900"))
+
+# 已完成 K 線的寫入間隔（秒）
+CANDLE_FLUSH_INTERVAL_SECONDS = int(os.getenv("CANDLE_FLUSH_INTERVAL_SECONDS", "10"))
+
+# ============ Price Charts ============
+# 價格圖表請求（request_price_series）的默認時間範圍和最多返回的點數
+PRICE_SERIES_DEFAULT_RANGE_SECONDS = int(os.getenv("PRICE_SERIES_DEFAULT_RANGE_SECONDS", str(7 * 86400)))
+PRICE_SERIES_MAX_POINTS = int(os.getenv("PRICE_SERIES_MAX_POINTS", "2000"))
+
+# ============ Alerts ============
+# 大額交易警報閾值（cents，與 trades.amount 及 AlertDetector 輪詢的閾值一致）
+ALERT_LARGE_TRADE_THRESHOLD_CENTS = int(os.getenv("ALERT_LARGE_TRADE_THRESHOLD_CENTS", "10000"))
+
+# 通知推送：每個用戶最多連續推送 NOTIFICATION_BURST 次，之後每分鐘 NOTIFICATION_RATE_PER_MINUTE 次，
+# 被限流的通知合併到下一次摘要
+NOTIFICATION_DELIVERY_INTERVAL_SECONDS = float(os.getenv("NOTIFICATION_DELIVERY_INTERVAL_SECONDS", "2"))
+NOTIFICATION_BURST = int(os.getenv("NOTIFICATION_BURST", "3"))
+NOTIFICATION_RATE_PER_MINUTE = float(os.getenv("NOTIFICATION_RATE_PER_MINUTE", "6"))
+
+# 事件總線的本地 socket，其他進程（地址分析等定時任務）通過它發布事件
+EVENT_BUS_SOCKET = os.getenv("EVENT_BUS_SOCKET", "/tmp/polymarket_insights_events.sock")
+
+# 通知訂閱的身份驗證：與 Node 服務器相同的會話 JWT 密鑰和 appId（server/_core/env.ts）
+SESSION_JWT_SECRET = os.getenv("JWT_SECRET", "")
+SESSION_APP_ID = os.getenv("VITE_APP_ID", "")
+
 # ============ WebSocket Server Configuration ============
 WS_SERVER_HOST = os.getenv("WS_SERVER_HOST", "localhost")
 WS_SERVER_PORT = int(os.getenv("WS_SERVER_PORT", "8765"))
@@ -100,6 +133,9 @@ LOG_FILE_PATH = os.getenv("LOG_FILE_PATH", "logs/polymarket_backend.log")
 ENABLE_AI_PREDICTION = os.getenv("ENABLE_AI_PREDICTION", "true").lower() == "true"
 ENABLE_WHALE_DETECTION = os.getenv("ENABLE_WHALE_DETECTION", "true").lower() == "true"
 ENABLE_MARKET_FILTERING = os.getenv("ENABLE_MARKET_FILTERING", "true").lower() == "true"
+ENABLE_REALTIME_ANOMALY_DETECTION = os.getenv("ENABLE_REALTIME_ANOMALY_DETECTION", "true").lower() == "true"
+ENABLE_LIVE_CANDLES = os.getenv("ENABLE_LIVE_CANDLES", "true").lower() == "true"
+ENABLE_EVENT_DRIVEN_ALERTS = os.getenv("ENABLE_EVENT_DRIVEN_ALERTS", "true").lower() == "true"
 
 
 # ============ Validation ============
@@ -1,15 +1,26 @@
 """
 定時任務調度器
-每 5 分鐘運行 Orderbook 收集器和地址發現系統
+各定時任務按自己的間隔併發運行（job_scheduler.AsyncJobScheduler），慢任務不會推遲其他任務：
+Orderbook 收集、地址發現、地址分析、價格同步、價格彙總、價格異常檢測、市場結算同步、市場結果 token 同步、警報檢測和交易歸檔
 """
 
 import os
 import sys
+import asyncio
 import logging
-import time
 from datetime import datetime
 from orderbook_collector import OrderbookCollector
 from address_discovery import AddressDiscovery
+from address_analyzer import AddressAnalyzer
+from price_sync_service import PriceSyncService
+from price_rollup_service import PriceRollupService
+from price_movement_detector import PriceMovementDetector
+from sync_market_resolution import MarketResolutionSyncer
+from market_tokens import MarketTokenSyncer
+from settlement_engine import SettlementEngine
+from alert_detector import AlertDetector
+from trade_archive import TradeArchiveExporter
+from job_scheduler import AsyncJobScheduler
 
 logger = logging.getLogger(__name__)
 
@@ -20,20 +31,51 @@ class CronScheduler:
     def __init__(self):
         self.orderbook_collector = OrderbookCollector()
         self.address_discovery = AddressDiscovery()
+        self.address_analyzer = AddressAnalyzer()
+        self.price_sync_service = PriceSyncService()
+        self.price_rollup_service = PriceRollupService()
+        self.price_movement_detector = PriceMovementDetector()
+        self.market_resolution_syncer = MarketResolutionSyncer()
+        self.market_token_syncer = MarketTokenSyncer()
+        self.settlement_engine = SettlementEngine()
+        self.alert_detector = AlertDetector()
+        self.trade_archive_exporter = TradeArchiveExporter()
         
         # 定時任務間隔（秒）
         self.collection_interval = 5 * 60  # 5 分鐘
         self.address_discovery_interval = 30 * 60  # 30 分鐘（地址發現較慢，不需要太頻繁）
+        self.analyzer_interval = 30 * 60
+        self.price_sync_interval = 15 * 60  # 與價格 K 線間隔一致
+        self.price_rollup_interval = 5 * 60  # 每次重建最近 2 小時，間隔遠小於回看範圍
+        self.anomaly_interval = 15 * 60
+        self.resolution_interval = 60 * 60
+        self.market_token_interval = 60 * 60  # 只同步還沒有 token 記錄的市場
+        self.alert_interval = 5 * 60
+        self.trade_archive_interval = 60 * 60  # 只導出已結束的日期，大部分運行沒有新的日期
         
-        # 上次執行時間
-        self.last_collection_time = 0
-        self.last_discovery_time = 0
+        # 每個任務獨立運行，同一任務不重疊；任務在線程池中執行
+        self.scheduler = AsyncJobScheduler(max_workers=int(os.getenv('SCHEDULER_MAX_WORKERS', '4')))
+        self.scheduler.add_job('orderbook_collection', self.run_collection_task, self.collection_interval)
+        self.scheduler.add_job('address_discovery', self.run_address_discovery_task,
+                               self.address_discovery_interval, initial_delay=60)
+        self.scheduler.add_job('address_analyzer', self.run_analyzer_task, self.analyzer_interval, initial_delay=120)
+        self.scheduler.add_job('price_sync', self.run_price_sync_task, self.price_sync_interval)
+        self.scheduler.add_job('price_rollup', self.run_price_rollup_task, self.price_rollup_interval,
+                               initial_delay=90)
+        self.scheduler.add_job('anomaly_detection', self.run_anomaly_detection_task,
+                               self.anomaly_interval, initial_delay=60)
+        self.scheduler.add_job('resolution_sync', self.run_resolution_sync_task, self.resolution_interval)
+        self.scheduler.add_job('market_token_sync', self.run_market_token_task, self.market_token_interval,
+                               initial_delay=45)
+        self.scheduler.add_job('alert_detection', self.run_alert_task, self.alert_interval, initial_delay=30)
+        self.scheduler.add_job('trade_archive', self.run_trade_archive_task, self.trade_archive_interval,
+                               initial_delay=300)
         
         logger.info("CronScheduler initialized")
         logger.info(f"Collection interval: {self.collection_interval} seconds")
         logger.info(f"Address discovery interval: {self.address_discovery_interval} seconds")
     
-    def run_collection_task(self):
+    async def run_collection_task(self):
         """運行數據收集任務"""
         try:
             logger.info("=" * 60)
@@ -41,7 +83,7 @@ class CronScheduler:
             logger.info("=" * 60)
             
             # 運行 Orderbook 收集器
-            result = self.orderbook_collector.run_collection()
+            result = await self.orderbook_collector.run_collection()
             
             logger.info(f"Collection task completed: {result}")
             logger.info("=" * 60)
@@ -71,20 +113,49 @@ class CronScheduler:
             logger.error(f"Error in address discovery task: {e}")
             return None
     
+    def run_analyzer_task(self):
+        """更新所有地址的可疑度分數"""
+        return self.address_analyzer.update_all_suspicion_scores()
+    
+    def run_price_sync_task(self):
+        """同步活躍市場的價格 K 線"""
+        return self.price_sync_service.sync_all_active_markets()
+    
+    def run_price_rollup_task(self):
+        """更新多級價格彙總（價格圖表的數據來源）"""
+        return self.price_rollup_service.run()
+    
+    def run_anomaly_detection_task(self):
+        """檢測並保存價格異常"""
+        return self.price_movement_detector.detect_and_save_all_markets()
+    
+    async def run_resolution_sync_task(self):
+        """同步市場結算狀態，然後結算新結算的市場"""
+        await self.market_resolution_syncer.run()
+        return self.settlement_engine.run()
+    
+    def run_market_token_task(self):
+        """同步新市場的結果 token（交易 asset ID → 市場和 YES / NO）"""
+        return self.market_token_syncer.run()
+    
+    def run_alert_task(self):
+        """運行一次警報檢測"""
+        return self.alert_detector.run_detection_cycle()
+    
+    def run_trade_archive_task(self):
+        """把已結束的日期導出到交易歸檔"""
+        return self.trade_archive_exporter.run()
+    
     def run_once(self):
-        """運行一次所有任務（用於測試）"""
+        """併發運行一次所有任務（用於測試）"""
         logger.info("Running all tasks once...")
         
-        # 運行數據收集
-        collection_result = self.run_collection_task()
-        
-        # 運行地址發現
-        discovery_result = self.run_address_discovery_task()
-        
-        return {
-            'collection': collection_result,
-            'address_discovery': discovery_result
-        }
+        try:
+            return asyncio.run(self.scheduler.run_once())
+        finally:
+            for stats in self.scheduler.stats():
+                logger.info(f"Job stats: {stats}")
+            self.scheduler.shutdown()
     
     def run_forever(self):
         """持續運行定時任務"""
@@ -92,27 +163,14 @@ class CronScheduler:
         logger.info("Press Ctrl+C to stop")
         
         try:
-            while True:
-                current_time = time.time()
-                
-                # 檢查是否需要運行數據收集任務
-                if current_time - self.last_collection_time >= self.collection_interval:
-                    self.run_collection_task()
-                    self.last_collection_time = current_time
-                
-                # 檢查是否需要運行地址發現任務
-                if current_time - self.last_discovery_time >= self.address_discovery_interval:
-                    self.run_address_discovery_task()
-                    self.last_discovery_time = current_time
-                
-                # 休眠 30 秒再檢查
-                time.sleep(30)
-                
+            asyncio.run(self.scheduler.run_forever())
         except KeyboardInterrupt:
             logger.info("Cron scheduler stopped by user")
         except Exception as e:
             logger.error(f"Fatal error in cron scheduler: {e}")
             raise
+        finally:
+            self.scheduler.shutdown()
 
 
 def main():
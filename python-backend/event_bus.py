@@ -0,0 +1,156 @@
+"""
+進程內事件總線
+交易寫入、異常檢測、分數更新發布事件，警報引擎等消費者訂閱後立即處理，不再輪詢資料庫
+
+其他進程（例如 address_analyzer.py 定時任務）可以通過本地 Unix socket 用 send_event 發布事件，
+由主服務的總線接收後分發
+"""
+
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 事件類型
+EVENT_TRADE = 'trade'
+EVENT_ANOMALY = 'anomaly'
+EVENT_ADDRESS_SCORE = 'address_score'
+
+DEFAULT_SOCKET_PATH = os.getenv('EVENT_BUS_SOCKET', '/tmp/polymarket_insights_events.sock')
+
+# Unix datagram 單條消息的大小上限
+MAX_DATAGRAM_SIZE = 65536
+
+
+def send_event(event_type: str, data: Dict[str, Any], socket_path: str = DEFAULT_SOCKET_PATH) -> bool:
+    """
+    從其他進程向主服務的事件總線發布事件（盡力而為，主服務未運行時直接返回 False）
+    """
+    message = json.dumps({'type': event_type, 'data': data}, default=str).encode('utf-8')
+    if len(message) > MAX_DATAGRAM_SIZE:
+        logger.warning(f"Event {event_type} too large to send ({len(message)} bytes)")
+        return False
+    
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(message, socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+class EventBus:
+    """
+    進程內發布 / 訂閱
+    
+    publish 可以在任意線程調用（例如 RTDS 的 websocket 線程），只把事件放入隊列；
+    由一個分發線程按順序調用訂閱者，因此訂閱者內部不需要加鎖，
+    也不會阻塞交易流和事件循環
+    """
+    
+    def __init__(self, max_queue_size: int = 10000):
+        self.handlers: Dict[str, List[Callable[[Dict[str, Any]], None]]] = defaultdict(list)
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self.dropped = 0
+        self.dispatcher: Optional[threading.Thread] = None
+        self.listener: Optional[threading.Thread] = None
+        self.socket: Optional[socket.socket] = None
+        self.running = False
+    
+    def subscribe(self, event_type: str, handler: Callable[[Dict[str, Any]], None]):
+        """訂閱某類事件"""
+        self.handlers[event_type].append(handler)
+    
+    def publish(self, event_type: str, data: Dict[str, Any]) -> bool:
+        """
+        發布事件（不阻塞）
+        
+        Returns:
+            隊列已滿時返回 False（事件被丟棄）
+        """
+        try:
+            self.queue.put_nowait((event_type, data))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Event queue full, dropped {self.dropped} events so far")
+            return False
+    
+    def _dispatch_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            
+            event_type, data = item
+            for handler in self.handlers.get(event_type, []):
+                try:
+                    handler(data)
+                except Exception as e:
+                    logger.error(f"Error handling {event_type} event: {e}")
+    
+    def _listen_loop(self):
+        while self.running:
+            try:
+                message = self.socket.recv(MAX_DATAGRAM_SIZE)
+            except OSError:
+                break
+            
+            if not self.running:
+                break
+            
+            try:
+                event = json.loads(message)
+                self.publish(event['type'], event['data'])
+            except (ValueError, KeyError) as e:
+                logger.warning(f"Invalid event received on socket: {e}")
+    
+    def start(self, socket_path: Optional[str] = DEFAULT_SOCKET_PATH):
+        """
+        啟動分發線程；socket_path 不為 None 時同時監聽本地 socket 接收其他進程的事件
+        """
+        if self.running:
+            return
+        
+        self.running = True
+        self.dispatcher = threading.Thread(target=self._dispatch_loop, name='event-bus', daemon=True)
+        self.dispatcher.start()
+        
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.socket.bind(socket_path)
+            self.listener = threading.Thread(target=self._listen_loop, name='event-bus-socket', daemon=True)
+            self.listener.start()
+            logger.info(f"Event bus listening on {socket_path}")
+    
+    def stop(self):
+        """停止分發和監聽（隊列中剩餘的事件會先處理完）"""
+        if not self.running:
+            return
+        
+        self.running = False
+        
+        if self.socket:
+            socket_path = self.socket.getsockname()
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)  # 喚醒阻塞在 recv 的監聽線程
+            except OSError:
+                pass
+            self.socket.close()
+            self.socket = None
+            if socket_path and os.path.exists(socket_path):
+                os.remove(socket_path)
+        
+        self.queue.put(None)
+        self.dispatcher.join(timeout=5)
@@ -0,0 +1,195 @@
+"""
+異步定時任務調度
+每個任務按自己的間隔獨立運行，互不阻塞；同一任務不會重疊運行（上一次未完成時跳過錯過的週期）
+
+任務默認放到線程池中執行（資料庫和計算密集的任務不阻塞事件循環，也不阻塞其他任務），
+協程任務在各自長期運行的事件循環線程中執行（每次運行使用同一個事件循環，
+aiohttp session 等綁定事件循環的資源可以跨運行複用）；
+記錄每個任務的運行耗時和延遲（實際開始時間 - 計劃時間）
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduledJob:
+    """單個定時任務的配置和運行統計"""
+    
+    def __init__(self, name: str, func: Callable, interval_seconds: float,
+                 run_in_thread: bool = True, initial_delay: float = 0):
+        self.name = name
+        self.func = func
+        self.interval_seconds = interval_seconds
+        self.run_in_thread = run_in_thread
+        self.initial_delay = initial_delay
+        self.is_coroutine = asyncio.iscoroutinefunction(func)
+        
+        self.running = False
+        # 協程任務的事件循環（第一次運行時創建，之後一直複用）
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread: Optional[threading.Thread] = None
+        
+        # 統計
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_started_at: Optional[float] = None
+        self.last_duration: Optional[float] = None
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_lag: Optional[float] = None
+        self.max_lag = 0.0
+        self.last_error: Optional[str] = None
+    
+    def record(self, duration: float, lag: float, error: Optional[BaseException] = None):
+        self.runs += 1
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        if error is not None:
+            self.failures += 1
+            self.last_error = repr(error)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'job': self.name,
+            'interval_seconds': self.interval_seconds,
+            'running': self.running,
+            'runs': self.runs,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'last_duration': self.last_duration,
+            'avg_duration': self.total_duration / self.runs if self.runs else None,
+            'max_duration': self.max_duration,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+            'last_error': self.last_error
+        }
+
+
+class AsyncJobScheduler:
+    """按間隔併發運行多個任務的調度器"""
+    
+    def __init__(self, max_workers: int = 4, stats_interval_seconds: float = 600):
+        self.jobs: List[ScheduledJob] = []
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.stats_interval_seconds = stats_interval_seconds
+    
+    def add_job(self, name: str, func: Callable, interval_seconds: float,
+                run_in_thread: bool = True, initial_delay: float = 0) -> ScheduledJob:
+        """
+        註冊任務
+        
+        Args:
+            name: 任務名稱
+            func: 無參數的函數或協程函數
+            interval_seconds: 運行間隔（按計劃時間計算，不受運行耗時影響）
+            run_in_thread: 是否放到線程池執行；輕量的協程任務可以直接在事件循環中運行
+            initial_delay: 首次運行前的延遲（錯開啟動時同時開始的任務）
+        """
+        job = ScheduledJob(name, func, interval_seconds, run_in_thread, initial_delay)
+        self.jobs.append(job)
+        logger.info(f"Registered job {name} every {interval_seconds}s")
+        return job
+    
+    def _job_loop_for(self, job: ScheduledJob) -> asyncio.AbstractEventLoop:
+        """協程任務的長期事件循環（在專用線程中運行）"""
+        if job.loop is None:
+            job.loop = asyncio.new_event_loop()
+            job.loop_thread = threading.Thread(
+                target=job.loop.run_forever, name=f'job-{job.name}', daemon=True
+            )
+            job.loop_thread.start()
+        return job.loop
+    
+    async def _run_on_job_loop(self, job: ScheduledJob):
+        future = asyncio.run_coroutine_threadsafe(job.func(), self._job_loop_for(job))
+        return await asyncio.wrap_future(future)
+    
+    async def run_job(self, job: ScheduledJob, scheduled_at: Optional[float] = None):
+        """運行一次任務並記錄耗時和延遲，異常只記錄不拋出"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        lag = max(0.0, started - scheduled_at) if scheduled_at is not None else 0.0
+        
+        job.running = True
+        job.last_started_at = time.time()
+        error = None
+        result = None
+        
+        try:
+            if job.run_in_thread and job.is_coroutine:
+                result = await self._run_on_job_loop(job)
+            elif job.run_in_thread:
+                result = await loop.run_in_executor(self.executor, job.func)
+            elif job.is_coroutine:
+                result = await job.func()
+            else:
+                result = job.func()
+        except Exception as e:
+            error = e
+            logger.error(f"Job {job.name} failed: {e}")
+        finally:
+            job.running = False
+        
+        duration = loop.time() - started
+        job.record(duration, lag, error)
+        logger.info(f"Job {job.name} finished in {duration:.1f}s (lag {lag:.1f}s)")
+        return result
+    
+    async def _job_loop(self, job: ScheduledJob):
+        loop = asyncio.get_running_loop()
+        next_run = loop.time() + job.initial_delay
+        
+        while True:
+            await asyncio.sleep(max(0.0, next_run - loop.time()))
+            await self.run_job(job, next_run)
+            
+            # 運行期間錯過的週期直接跳過，不補跑、不重疊
+            next_run += job.interval_seconds
+            now = loop.time()
+            if next_run <= now:
+                missed = int((now - next_run) // job.interval_seconds) + 1
+                job.skipped += missed
+                next_run += missed * job.interval_seconds
+                logger.warning(f"Job {job.name} overran its interval, skipped {missed} run(s)")
+    
+    async def _stats_loop(self):
+        while True:
+            await asyncio.sleep(self.stats_interval_seconds)
+            for stats in self.stats():
+                logger.info(f"Job stats: {stats}")
+    
+    def stats(self) -> List[Dict[str, Any]]:
+        return [job.stats() for job in self.jobs]
+    
+    async def run_once(self) -> Dict[str, Any]:
+        """所有任務併發運行一次（用於測試）"""
+        results = await asyncio.gather(*(self.run_job(job) for job in self.jobs))
+        return {job.name: result for job, result in zip(self.jobs, results)}
+    
+    async def run_forever(self):
+        """持續運行所有任務"""
+        tasks = [asyncio.create_task(self._job_loop(job), name=job.name) for job in self.jobs]
+        tasks.append(asyncio.create_task(self._stats_loop()))
+        
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for job in self.jobs:
+            if job.loop is not None:
+                job.loop.call_soon_threadsafe(job.loop.stop)
@@ -4,6 +4,7 @@ Polymarket Insights - Python Backend Service
 """
 import asyncio
 import json
+import time
 import mysql.connector
 from datetime import datetime
 from termcolor import cprint, colored
@@ -12,6 +13,17 @@ import traceback
 
 from config import *
 from agents.polymarket_agent import PolymarketAgent
+from rolling_anomaly_detector import (
+    MultiWindowAnomalyDetector, ANOMALY_UPSERT_QUERY, LIVE_ANOMALY_PREFIX, anomaly_to_row
+)
+from candle_builder import LiveCandleBuilder
+from price_sync_service import PRICE_HISTORY_UPSERT_QUERY
+from price_series_store import PriceSeriesStore
+from price_rollup_service import PriceRollupService
+from event_bus import EventBus, EVENT_TRADE, EVENT_ANOMALY
+from alert_detector import AlertEngine
+from notification_delivery import NotificationDelivery
+from session_auth import verify_session_token, session_token_from_cookie
 
 
 class PolymarketBackendService:
@@ -24,6 +36,33 @@ class PolymarketBackendService:
         self.swarm_agent = None
         self.prediction_cache = {}  # 緩存最近的預測，避免重複分析
         
+        # 實時價格異常檢測（每個市場的滾動窗口狀態保存在內存中）；
+        # 逐筆成交檢測，成交後立即推送。輸入與按 K 線檢測的批量檢測器不同，
+        # 異常類型帶 live_ 前綴（例如 live_price_spike），兩者的結果分開保存
+        self.anomaly_detector = MultiWindowAnomalyDetector(
+            spike_threshold_percent=ANOMALY_SPIKE_THRESHOLD_PERCENT,
+            type_prefix=LIVE_ANOMALY_PREFIX
+        )
+        self.anomaly_warmed_markets = set()
+        
+        # 實時 K 線（由交易流構建，定期寫入 market_price_history）
+        self.candle_builder = LiveCandleBuilder(interval_seconds=CANDLE_INTERVAL_SECONDS)
+        self.market_subscribers = {}  # market_id -> 訂閱該市場的前端連接
+        self.price_series_store = PriceSeriesStore()
+        # 價格圖表查詢（讀取多級價格彙總，連接資料庫後創建）
+        self.price_rollup_service = None
+        
+        # 事件總線：交易和價格異常發布後由警報引擎立即匹配訂閱
+        self.event_bus = EventBus()
+        self.alert_engine = None
+        
+        # 通知實時推送（按用戶合併、限流）
+        self.notification_delivery = NotificationDelivery(
+            burst=NOTIFICATION_BURST,
+            rate_per_minute=NOTIFICATION_RATE_PER_MINUTE
+        )
+        self.user_clients = {}  # user_id -> 該用戶的前端連接
+        
         cprint("=" * 60, "cyan")
         cprint("🌙 Polymarket Insights - Python Backend Service", "cyan", attrs=['bold'])
         cprint("=" * 60, "cyan")
@@ -169,13 +208,28 @@ class PolymarketBackendService:
             if conn:
                 conn.close()
     
+    @staticmethod
+    def _trade_outcome(trade_data: dict) -> str:
+        """交易的結果方向（YES / NO，與 trades.side 一致）"""
+        raw_side = trade_data.get("side", "BUY").upper()
+        # 將 BUY/SELL 轉換為 YES/NO，或直接使用 outcome 欄位
+        if raw_side in ["BUY", "SELL"]:
+            # 如果有 outcome 欄位，優先使用
+            side = trade_data.get("outcome", "YES" if raw_side == "BUY" else "NO").upper()
+        else:
+            side = raw_side
+        # 確保 side 只能是 YES 或 NO
+        if side not in ["YES", "NO"]:
+            side = "YES"  # 預設值
+        return side
+    
     def save_trade_to_db(self, trade_data: dict, market_data: dict):
-        """保存交易數據到資料庫"""
+        """保存交易數據到資料庫，返回市場 ID（失敗時返回 None）"""
         conn = None
         cursor = None
         try:
             if not hasattr(self, 'db_pool'):
-                return
+                return None
             
             conn = self.get_db_connection()
             cursor = conn.cursor()
@@ -186,23 +240,13 @@ class PolymarketBackendService:
             result = cursor.fetchone()
             
             if not result:
-                cursor.close()
-                return
+                return None
             
             market_id = result[0]
             
             # 提取交易信息
             trade_id = trade_data.get("transactionHash", f"trade_{int(datetime.now().timestamp())}")
-            raw_side = trade_data.get("side", "BUY").upper()
-            # 將 BUY/SELL 轉換為 YES/NO，或直接使用 outcome 欄位
-            if raw_side in ["BUY", "SELL"]:
-                # 如果有 outcome 欄位，優先使用
-                side = trade_data.get("outcome", "YES" if raw_side == "BUY" else "NO").upper()
-            else:
-                side = raw_side
-            # 確保 side 只能是 YES 或 NO
-            if side not in ["YES", "NO"]:
-                side = "YES"  # 預設值
+            side = self._trade_outcome(trade_data)
             
             price = trade_data.get("price", 0)
             size = trade_data.get("size", 0)
@@ -239,9 +283,12 @@ class PolymarketBackendService:
                 # 觸發 AI 預測
                 self.trigger_ai_prediction(market_id, market_data)
             
+            return market_id
+            
         except Exception as e:
             cprint(f"❌ Error saving trade: {e}", "red")
             traceback.print_exc()
+            return None
         finally:
             if cursor:
                 cursor.close()
@@ -286,11 +333,30 @@ class PolymarketBackendService:
             
             # 保存到資料庫
             self.save_market_to_db(market_data)
-            self.save_trade_to_db(trade_data, market_data)
+            market_id = self.save_trade_to_db(trade_data, market_data)
+            
+            # 實時價格異常檢測（逐筆）
+            if market_id and ENABLE_REALTIME_ANOMALY_DETECTION:
+                self.detect_realtime_anomalies(market_id, market_data, trade_data)
+            
+            # 更新實時 K 線
+            if market_id and ENABLE_LIVE_CANDLES:
+                self.update_live_candle(market_id, market_data, trade_data)
             
             # 計算交易金額
             amount = trade_data["price"] * trade_data["size"]
             
+            # 發布交易事件（警報引擎在分發線程中處理）
+            if market_id and ENABLE_EVENT_DRIVEN_ALERTS:
+                self.event_bus.publish(EVENT_TRADE, {
+                    "trade_id": trade_data["transactionHash"],
+                    "market_id": market_id,
+                    "market_name": market_data["title"],
+                    "outcome": self._trade_outcome(trade_data),
+                    "amount": int(amount * 100),  # 與 trades.amount 一致，以 cents 為單位
+                    "price": int(trade_data["price"] * 100)
+                })
+            
             # 廣播到前端客戶端（使用線程安全的方式）
             if hasattr(self, '_event_loop') and self._event_loop:
                 asyncio.run_coroutine_threadsafe(
@@ -314,6 +380,180 @@ class PolymarketBackendService:
             cprint(f"❌ Error processing trade: {e}", "red")
             traceback.print_exc()
     
+    def _warm_up_anomaly_detector(self, market_id: int, current_trade_id: str, max_trades: int = 20000):
+        """
+        首次看到市場時，用最近的成交預熱滾動窗口（不產生異常）
+        
+        與實時輸入一致使用逐筆成交（trades 表，cents），不包含剛保存的當前成交；
+        成交很多的市場只取窗口內最近的 max_trades 筆
+        """
+        self.anomaly_warmed_markets.add(market_id)
+        
+        conn = None
+        cursor = None
+        try:
+            conn = self.get_db_connection()
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute("""
+                SELECT price, amount, timestamp
+                FROM trades
+                WHERE marketId = %s
+                    AND tradeId <> %s
+                    AND timestamp >= DATE_SUB(NOW(), INTERVAL %s SECOND)
+                ORDER BY timestamp DESC
+                LIMIT %s
+            """, (market_id, current_trade_id, self.anomaly_detector.max_window_seconds, max_trades))
+            
+            for trade in reversed(cursor.fetchall()):
+                self.anomaly_detector.process(
+                    market_id, trade['timestamp'], trade['price'], trade['amount'] or 0, emit=False
+                )
+        except Exception as e:
+            cprint(f"⚠️ Anomaly detector warm-up failed for market {market_id}: {e}", "yellow")
+        finally:
+            if cursor:
+                cursor.close()
+            if conn:
+                conn.close()
+    
+    def detect_realtime_anomalies(self, market_id: int, market_data: dict, trade_data: dict):
+        """用最新成交更新市場的滾動窗口，並立即保存和推送檢測到的異常（live_ 類型）"""
+        try:
+            if market_id not in self.anomaly_warmed_markets:
+                self._warm_up_anomaly_detector(market_id, trade_data["transactionHash"][:255])
+            
+            price = trade_data["price"] * 100  # 與 trades.price 一致，以 cents 為單位
+            volume = trade_data["price"] * trade_data["size"] * 100  # 與 trades.amount 一致
+            anomalies = self.anomaly_detector.process(market_id, datetime.now(), price, volume)
+            
+            if not anomalies:
+                return
+            
+            self.save_anomalies_to_db(anomalies)
+            
+            if ENABLE_EVENT_DRIVEN_ALERTS:
+                for anomaly in anomalies:
+                    self.event_bus.publish(EVENT_ANOMALY, {
+                        "market_id": market_id,
+                        "market_name": market_data["title"],
+                        "anomaly_type": anomaly["anomaly_type"],
+                        "timestamp": int(anomaly["timestamp"].timestamp()),
+                        "price_before": anomaly["price_before"],
+                        "price_after": anomaly["price_after"],
+                        "change_percentage": anomaly["price_change_percent"]
+                    })
+            
+            if hasattr(self, '_event_loop') and self._event_loop:
+                for anomaly in anomalies:
+                    asyncio.run_coroutine_threadsafe(
+                        self.broadcast_to_clients({
+                            "type": "anomaly",
+                            "data": {
+                                "marketId": market_id,
+                                "market": market_data["title"],
+                                "conditionId": market_data["conditionId"],
+                                "anomalyType": anomaly["anomaly_type"],
+                                "priceBefore": anomaly["price_before"],
+                                "priceAfter": anomaly["price_after"],
+                                "changePercent": anomaly["price_change_percent"],
+                                "timestamp": anomaly["timestamp"].isoformat()
+                            }
+                        }),
+                        self._event_loop
+                    )
+            
+            cprint(f"📈 {len(anomalies)} price anomalies on {market_data.get('title', 'Unknown')[:50]}", "magenta")
+            
+        except Exception as e:
+            cprint(f"❌ Error detecting anomalies: {e}", "red")
+            traceback.print_exc()
+    
+    def save_anomalies_to_db(self, anomalies: list):
+        """保存價格異常到資料庫（與批量檢測器使用同一條冪等寫入語句）"""
+        conn = None
+        cursor = None
+        try:
+            if not hasattr(self, 'db_pool'):
+                return
+            
+            conn = self.get_db_connection()
+            cursor = conn.cursor()
+            cursor.executemany(ANOMALY_UPSERT_QUERY, [anomaly_to_row(a) for a in anomalies])
+            
+        except Exception as e:
+            cprint(f"❌ Error saving anomalies: {e}", "red")
+            traceback.print_exc()
+        finally:
+            if cursor:
+                cursor.close()
+            if conn:
+                conn.close()
+    
+    def update_live_candle(self, market_id: int, market_data: dict, trade_data: dict):
+        """用最新成交更新市場的當前 K 線，並推送給訂閱該市場的前端"""
+        try:
+            price = trade_data["price"]
+            candle = self.candle_builder.on_trade(
+                market_id,
+                market_data["conditionId"],
+                int(time.time()),
+                int(price * 100),  # 與 trades.price 一致，以 cents 為單位
+                int(price * trade_data["size"] * 100)  # 與 trades.amount 一致
+            )
+            
+            if market_id in self.market_subscribers and hasattr(self, '_event_loop') and self._event_loop:
+                asyncio.run_coroutine_threadsafe(
+                    self.send_to_market_subscribers(market_id, {
+                        "type": "candle",
+                        "data": candle
+                    }),
+                    self._event_loop
+                )
+            
+        except Exception as e:
+            cprint(f"❌ Error updating candle: {e}", "red")
+            traceback.print_exc()
+    
+    def flush_closed_candles(self, batch_size: int = 500):
+        """把已完成的 K 線批量寫入 market_price_history"""
+        if not hasattr(self, 'db_pool'):
+            return
+        
+        while True:
+            rows = self.candle_builder.drain_closed(max_rows=batch_size)
+            if not rows:
+                return
+            
+            conn = None
+            cursor = None
+            try:
+                conn = self.get_db_connection()
+                cursor = conn.cursor()
+                cursor.executemany(PRICE_HISTORY_UPSERT_QUERY, rows)
+            except Exception as e:
+                cprint(f"❌ Error flushing candles: {e}", "red")
+                self.candle_builder.requeue(rows)
+                return
+            finally:
+                if cursor:
+                    cursor.close()
+                if conn:
+                    conn.close()
+            
+            # 已完成的 K 線追加到本地價格序列
+            self.price_series_store.append_price_history_rows(rows)
+    
+    async def candle_flush_loop(self):
+        """定期關閉已結束的 K 線並寫入資料庫（在線程池中執行，不阻塞事件循環）"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(CANDLE_FLUSH_INTERVAL_SECONDS)
+            try:
+                self.candle_builder.roll(int(time.time()))
+                await loop.run_in_executor(None, self.flush_closed_candles)
+            except Exception as e:
+                cprint(f"❌ Candle flush failed: {e}", "red")
+    
     def initialize_swarm_agent(self):
         """初始化 SwarmAgent（多模型 AI 共識）"""
         try:
@@ -522,6 +762,56 @@ Respond with ONLY a JSON object in this format:
         finally:
             if self.agent:
                 self.agent.remove_ws_client(websocket)
+            self._unsubscribe_all(websocket)
+            self._remove_user_client(websocket)
+    
+    def _remove_user_client(self, websocket):
+        """移除連接的通知訂閱"""
+        for user_id in list(self.user_clients):
+            clients = self.user_clients[user_id]
+            clients.discard(websocket)
+            if not clients:
+                del self.user_clients[user_id]
+                self.notification_delivery.forget_user(user_id)
+    
+    async def _authenticate_user(self, websocket, token=None):
+        """
+        驗證會話 JWT 並返回 users.id
+        
+        token 未在消息中提供時使用握手請求中的會話 cookie；驗證失敗或用戶不存在時返回 None
+        """
+        if not token:
+            headers = getattr(websocket, "request_headers", None)
+            token = session_token_from_cookie(headers.get("Cookie") if headers else None)
+        
+        session = verify_session_token(token, SESSION_JWT_SECRET, SESSION_APP_ID)
+        if session is None:
+            return None
+        
+        def lookup():
+            conn = self.get_db_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT id FROM users WHERE openId = %s", (session["openId"],))
+                row = cursor.fetchone()
+                return row[0] if row else None
+            finally:
+                cursor.close()
+                conn.close()
+        
+        try:
+            return await asyncio.to_thread(lookup)
+        except Exception as e:
+            cprint(f"❌ Error looking up session user: {e}", "red")
+            return None
+    
+    def _unsubscribe_all(self, websocket):
+        """移除連接的所有市場訂閱"""
+        for market_id in list(self.market_subscribers):
+            subscribers = self.market_subscribers[market_id]
+            subscribers.discard(websocket)
+            if not subscribers:
+                del self.market_subscribers[market_id]
     
     async def handle_client_message(self, websocket, data: dict):
         """處理來自前端的消息"""
@@ -532,12 +822,107 @@ Respond with ONLY a JSON object in this format:
         
         elif msg_type == "subscribe_market":
             market_id = data.get("market_id")
+            if market_id is not None:
+                self.market_subscribers.setdefault(int(market_id), set()).add(websocket)
             cprint(f"📡 Client subscribed to market {market_id}", "cyan")
         
+        elif msg_type == "unsubscribe_market":
+            market_id = data.get("market_id")
+            if market_id is not None:
+                subscribers = self.market_subscribers.get(int(market_id))
+                if subscribers:
+                    subscribers.discard(websocket)
+                    if not subscribers:
+                        del self.market_subscribers[int(market_id)]
+        
+        elif msg_type == "subscribe_notifications":
+            # 用戶身份只取自已驗證的會話 token（消息中的 token 或握手時的會話 cookie），忽略客戶端傳來的 user_id
+            user_id = await self._authenticate_user(websocket, data.get("token"))
+            if user_id is None:
+                await websocket.send(json.dumps({
+                    "type": "notifications_error",
+                    "message": "Invalid or missing session token"
+                }))
+                cprint(f"⚠️ Rejected notification subscription from {websocket.remote_address}", "yellow")
+                return
+            
+            self.user_clients.setdefault(user_id, set()).add(websocket)
+            await websocket.send(json.dumps({"type": "notifications_subscribed", "user_id": user_id}))
+            cprint(f"🔔 Client subscribed to notifications for user {user_id}", "cyan")
+        
+        elif msg_type == "unsubscribe_notifications":
+            self._remove_user_client(websocket)
+        
+        elif msg_type == "request_price_series":
+            await self._send_price_series(websocket, data)
+        
         elif msg_type == "request_analysis":
             market_id = data.get("market_id")
             cprint(f"🧠 AI analysis requested for market {market_id}", "cyan")
     
+    async def _send_price_series(self, websocket, data: dict):
+        """
+        返回市場的價格圖表數據（PriceRollupService.get_price_series，使用滿足粒度的最粗彙總級別）
+        
+        請求字段：market_id，可選 start_time / end_time（Unix 時間戳，秒）和 granularity_seconds；
+        粒度會放大到範圍內最多 PRICE_SERIES_MAX_POINTS 個點
+        """
+        try:
+            market_id = int(data["market_id"])
+            end_time = int(data.get("end_time") or time.time())
+            start_time = int(data.get("start_time") or end_time - PRICE_SERIES_DEFAULT_RANGE_SECONDS)
+            granularity = int(data.get("granularity_seconds") or 3600)
+        except (KeyError, TypeError, ValueError):
+            await websocket.send(json.dumps({
+                "type": "price_series_error",
+                "message": "market_id is required; start_time, end_time and granularity_seconds must be integers"
+            }))
+            return
+        
+        if self.price_rollup_service is None:
+            await websocket.send(json.dumps({
+                "type": "price_series_error",
+                "market_id": market_id,
+                "message": "Price series unavailable"
+            }))
+            return
+        
+        granularity = max(granularity, (end_time - start_time) // PRICE_SERIES_MAX_POINTS)
+        
+        try:
+            points = await asyncio.to_thread(
+                self.price_rollup_service.get_price_series, market_id, start_time, end_time, granularity
+            )
+        except Exception as e:
+            cprint(f"❌ Error loading price series for market {market_id}: {e}", "red")
+            await websocket.send(json.dumps({
+                "type": "price_series_error",
+                "market_id": market_id,
+                "message": "Failed to load price series"
+            }))
+            return
+        
+        await websocket.send(json.dumps({
+            "type": "price_series",
+            "market_id": market_id,
+            "start_time": start_time,
+            "end_time": end_time,
+            "resolution": points[0]["resolution"] if points else None,
+            "points": [
+                {
+                    "timestamp": int(point["timestamp"]),
+                    "open": int(point["open"]),
+                    "high": int(point["high"]),
+                    "low": int(point["low"]),
+                    "close": int(point["close"]),
+                    "vwap": float(point["vwap"]),
+                    "volume": int(point["volume"]),
+                    "trade_count": int(point["trade_count"])
+                }
+                for point in points
+            ]
+        }))
+    
     async def broadcast_to_clients(self, message: dict):
         """向所有連接的前端客戶端廣播消息"""
         if not self.agent or not self.agent.ws_clients:
@@ -555,6 +940,54 @@ Respond with ONLY a JSON object in this format:
         # Remove disconnected clients
         self.agent.ws_clients -= disconnected_clients
     
+    async def send_to_user(self, user_id: int, message: dict):
+        """向用戶的所有前端連接推送消息"""
+        clients = self.user_clients.get(user_id)
+        if not clients:
+            return
+        
+        disconnected_clients = set()
+        message_json = json.dumps(message)
+        
+        for client in list(clients):
+            try:
+                await client.send(message_json)
+            except Exception:
+                disconnected_clients.add(client)
+        
+        for client in disconnected_clients:
+            self._remove_user_client(client)
+    
+    async def notification_delivery_loop(self):
+        """定期把新通知推送給在線用戶"""
+        while True:
+            await asyncio.sleep(NOTIFICATION_DELIVERY_INTERVAL_SECONDS)
+            try:
+                await self.notification_delivery.flush(
+                    lambda user_id: user_id in self.user_clients,
+                    self.send_to_user
+                )
+            except Exception as e:
+                cprint(f"❌ Notification delivery failed: {e}", "red")
+    
+    async def send_to_market_subscribers(self, market_id: int, message: dict):
+        """向訂閱了某個市場的前端客戶端推送消息"""
+        subscribers = self.market_subscribers.get(market_id)
+        if not subscribers:
+            return
+        
+        disconnected_clients = set()
+        message_json = json.dumps(message)
+        
+        for client in list(subscribers):
+            try:
+                await client.send(message_json)
+            except Exception:
+                disconnected_clients.add(client)
+        
+        for client in disconnected_clients:
+            self._unsubscribe_all(client)
+    
     async def start_websocket_server(self):
         """啟動 WebSocket 服務器"""
         try:
@@ -568,6 +1001,14 @@ Respond with ONLY a JSON object in this format:
             )
             cprint(f"✅ WebSocket server started on {WS_SERVER_HOST}:{WS_SERVER_PORT}", "green", attrs=['bold'])
             
+            # 定期寫入已完成的 K 線
+            if ENABLE_LIVE_CANDLES:
+                asyncio.create_task(self.candle_flush_loop())
+            
+            # 定期推送通知
+            if ENABLE_EVENT_DRIVEN_ALERTS:
+                asyncio.create_task(self.notification_delivery_loop())
+            
             # Keep server running
             await asyncio.Future()  # Run forever
             
@@ -583,17 +1024,28 @@ Respond with ONLY a JSON object in this format:
         if not self.connect_database():
             cprint("❌ Failed to start: Database connection error", "red")
             return
+        self.price_rollup_service = PriceRollupService()
         
         # 2. Initialize agent
         if not self.initialize_agent():
             cprint("❌ Failed to start: Agent initialization error", "red")
             return
         
-        # 3. Start Polymarket Agent
+        # 3. Start event-driven alert engine
+        if ENABLE_EVENT_DRIVEN_ALERTS:
+            self.alert_engine = AlertEngine(
+                large_trade_threshold=ALERT_LARGE_TRADE_THRESHOLD_CENTS,
+                on_notifications=self.notification_delivery.enqueue
+            )
+            self.alert_engine.attach(self.event_bus)
+            self.event_bus.start(socket_path=EVENT_BUS_SOCKET)
+            cprint("🔔 Event-driven alert engine started", "green")
+        
+        # 4. Start Polymarket Agent
         cprint("\n📡 Connecting to Polymarket RTDS...", "cyan")
         self.agent.start()
         
-        # 4. Start WebSocket server for frontend
+        # 5. Start WebSocket server for frontend
         cprint("\n🌐 Starting WebSocket server for frontend...", "cyan")
         try:
             asyncio.run(self.start_websocket_server())
@@ -607,6 +1059,12 @@ Respond with ONLY a JSON object in this format:
         if self.agent:
             self.agent.stop()
         
+        cprint("🛑 Stopping event bus...", "yellow")
+        self.event_bus.stop()
+        
+        cprint("💾 Flushing closed candles...", "yellow")
+        self.flush_closed_candles()
+        
         cprint("🛑 Closing database connection pool...", "yellow")
         if hasattr(self, 'db_pool'):
             # 連接池會自動關閉所有連接
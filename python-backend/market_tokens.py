@@ -0,0 +1,195 @@
+"""
+市場結果 token 同步
+從 Polymarket Gamma API 獲取每個市場的結果 token（clobTokenIds）和對應的結果（outcomes），
+寫入 market_tokens，交易的 asset ID 通過它映射到市場和 YES / NO
+"""
+
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+import requests
+from mysql.connector import pooling
+
+logger = logging.getLogger(__name__)
+
+GAMMA_API_BASE = "https://gamma-api.polymarket.com"
+
+# 還沒有 token 記錄的市場
+MISSING_MARKETS_QUERY = """
+    SELECT m.id, m.condition_id
+    FROM markets m
+    LEFT JOIN market_tokens t ON t.market_id = m.id
+    WHERE m.condition_id IS NOT NULL
+      AND t.market_id IS NULL
+    ORDER BY m.id DESC
+    LIMIT %s
+"""
+
+
+def outcome_side(outcome: Optional[str]) -> Optional[str]:
+    """Gamma 的結果名稱（'Yes' / 'No'）轉換為 YES / NO，與 settlement_engine.winning_side 一致"""
+    if not outcome:
+        return None
+    side = outcome.strip().upper()
+    return side if side in ('YES', 'NO') else None
+
+
+def parse_market_tokens(market: Dict) -> List[Tuple[str, str, int]]:
+    """
+    解析 Gamma 市場的結果 token
+    
+    clobTokenIds 和 outcomes 是 JSON 字符串，按位置一一對應
+    
+    Returns:
+        [(token_id, outcome, outcome_index)]；非 Yes / No 市場返回空列表
+    """
+    try:
+        token_ids = json.loads(market.get('clobTokenIds') or '[]')
+        outcomes = json.loads(market.get('outcomes') or '[]')
+    except (TypeError, ValueError):
+        return []
+    
+    if len(token_ids) != len(outcomes):
+        return []
+    
+    tokens = []
+    for index, (token_id, outcome) in enumerate(zip(token_ids, outcomes)):
+        side = outcome_side(outcome)
+        if side is None:
+            return []
+        tokens.append((str(token_id), side, index))
+    return tokens
+
+
+def load_token_outcomes(cursor) -> Dict[str, Tuple[int, str]]:
+    """一次讀取所有結果 token：token_id -> (market_id, outcome)"""
+    cursor.execute("SELECT token_id, market_id, outcome FROM market_tokens")
+    return {str(token_id): (market_id, outcome) for token_id, market_id, outcome in cursor.fetchall()}
+
+
+class MarketTokenSyncer:
+    """為還沒有 token 記錄的市場同步結果 token"""
+    
+    def __init__(self, batch_size: int = 50, max_markets: int = 5000, request_timeout: int = 30):
+        self.batch_size = batch_size
+        self.max_markets = max_markets
+        self.request_timeout = request_timeout
+        self.db_pool = self._create_db_pool()
+    
+    def _create_db_pool(self):
+        """創建資料庫連接池"""
+        db_config = {
+            'host': os.getenv('DB_HOST', 'localhost'),
+            'user': os.getenv('DB_USER', 'root'),
+            'password': os.getenv('DB_PASSWORD', ''),
+            'database': os.getenv('DB_NAME', 'polymarket_insights'),
+            'pool_name': 'market_tokens_pool',
+            'pool_size': 2
+        }
+        
+        # 從 DATABASE_URL 解析配置
+        database_url = os.getenv('DATABASE_URL')
+        if database_url:
+            import re
+            match = re.match(r'mysql://([^:]+):([^@]+)@([^:]+):(\d+)/([^?]+)', database_url)
+            if match:
+                db_config['user'] = match.group(1)
+                db_config['password'] = match.group(2)
+                db_config['host'] = match.group(3)
+                db_config['port'] = int(match.group(4))
+                db_config['database'] = match.group(5)
+        
+        return pooling.MySQLConnectionPool(**db_config)
+    
+    def _get_db_connection(self):
+        """從連接池獲取資料庫連接"""
+        return self.db_pool.get_connection()
+    
+    def get_missing_markets(self) -> List[Tuple[int, str]]:
+        """還沒有 token 記錄的市場 [(market_id, condition_id)]，新市場優先"""
+        conn = self._get_db_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute(MISSING_MARKETS_QUERY, (self.max_markets,))
+            return [(market_id, condition_id) for market_id, condition_id in cursor.fetchall()]
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def fetch_markets(self, condition_ids: Sequence[str]) -> Dict[str, Dict]:
+        """
+        按 condition ID 批量獲取 Gamma 市場
+        
+        Gamma 默認只返回未關閉的市場，沒找到的再按 closed=true 查詢一次
+        """
+        found = {}
+        missing = list(condition_ids)
+        for closed in (None, 'true'):
+            if not missing:
+                break
+            params = {'condition_ids': missing, 'limit': len(missing)}
+            if closed:
+                params['closed'] = closed
+            response = requests.get(f"{GAMMA_API_BASE}/markets", params=params, timeout=self.request_timeout)
+            response.raise_for_status()
+            for market in response.json():
+                condition_id = market.get('conditionId')
+                if condition_id:
+                    found[condition_id] = market
+            missing = [condition_id for condition_id in missing if condition_id not in found]
+        return found
+    
+    def save_tokens(self, rows: Sequence[Tuple[str, int, str, int]]) -> None:
+        """批量寫入 (token_id, market_id, outcome, outcome_index)"""
+        if not rows:
+            return
+        conn = self._get_db_connection()
+        cursor = conn.cursor()
+        
+        try:
+            placeholders = ', '.join(['(%s, %s, %s, %s)'] * len(rows))
+            cursor.execute(f"""
+                INSERT INTO market_tokens (token_id, market_id, outcome, outcome_index)
+                VALUES {placeholders}
+                ON DUPLICATE KEY UPDATE
+                    market_id = VALUES(market_id),
+                    outcome = VALUES(outcome),
+                    outcome_index = VALUES(outcome_index)
+            """, tuple(value for row in rows for value in row))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def run(self) -> Dict[str, int]:
+        """同步一輪，返回統計"""
+        markets = self.get_missing_markets()
+        stats = {'markets': len(markets), 'synced': 0, 'tokens': 0}
+        if not markets:
+            return stats
+        
+        logger.info(f"🚀 Syncing outcome tokens for {len(markets)} markets...")
+        for start in range(0, len(markets), self.batch_size):
+            batch = markets[start:start + self.batch_size]
+            try:
+                gamma_markets = self.fetch_markets([condition_id for _, condition_id in batch])
+            except requests.RequestException as e:
+                logger.error(f"Error fetching Gamma markets: {e}")
+                continue
+            
+            rows = []
+            for market_id, condition_id in batch:
+                tokens = parse_market_tokens(gamma_markets.get(condition_id) or {})
+                if tokens:
+                    stats['synced'] += 1
+                    rows.extend((token_id, market_id, outcome, index) for token_id, outcome, index in tokens)
+            self.save_tokens(rows)
+            stats['tokens'] += len(rows)
+        
+        logger.info(f"✅ Outcome tokens synced: {stats['synced']}/{stats['markets']} markets, {stats['tokens']} tokens")
+        return stats
@@ -0,0 +1,136 @@
+"""
+通知推送服務
+把已寫入 alert_notifications 的通知按用戶合併成摘要，通過前端 WebSocket 實時推送，
+每個用戶有獨立的推送頻率限制；被限流的通知合併到下一次摘要中
+"""
+
+import json
+import threading
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Sequence
+
+
+class TokenBucket:
+    """令牌桶：最多連續推送 burst 次，之後每分鐘恢復 rate_per_minute 次"""
+    
+    __slots__ = ('capacity', 'refill_per_second', 'tokens', 'updated_at')
+    
+    def __init__(self, burst: int, rate_per_minute: float):
+        self.capacity = burst
+        self.refill_per_second = rate_per_minute / 60
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+    
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class NotificationDelivery:
+    """
+    通知推送
+    
+    enqueue 可以在任意線程調用（警報引擎在事件總線的分發線程中寫入通知後調用）；
+    flush 在事件循環中定期調用，每個用戶每次最多推送一條消息：
+    只有一條通知時推送 notification，多條時推送 notification_digest
+    
+    沒有在線連接的用戶不保留待推送通知，上線後由前端從 alert_notifications 讀取
+    """
+    
+    def __init__(self, burst: int = 3, rate_per_minute: float = 6, max_pending_per_user: int = 50):
+        self.burst = burst
+        self.rate_per_minute = rate_per_minute
+        self.max_pending_per_user = max_pending_per_user
+        self.pending: Dict[int, List[Dict[str, Any]]] = {}
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def _row_to_notification(row: Sequence) -> Dict[str, Any]:
+        """NOTIFICATION_INSERT_QUERY 參數轉換為推送格式"""
+        _, subscription_id, alert_type, title, message, metadata = row[:6]
+        return {
+            "subscriptionId": subscription_id,
+            "alertType": alert_type,
+            "title": title,
+            "message": message,
+            "metadata": json.loads(metadata) if metadata else None,
+            "createdAt": datetime.now().isoformat()
+        }
+    
+    def enqueue(self, rows: Sequence[Sequence]):
+        """加入已寫入資料庫的通知（NOTIFICATION_INSERT_QUERY 參數格式）"""
+        with self.lock:
+            for row in rows:
+                user_pending = self.pending.setdefault(row[0], [])
+                user_pending.append(self._row_to_notification(row))
+                # 長時間被限流時只保留最新的通知
+                if len(user_pending) > self.max_pending_per_user:
+                    del user_pending[:-self.max_pending_per_user]
+    
+    async def flush(self, is_online: Callable[[int], bool],
+                    send: Callable[[int, Dict[str, Any]], Awaitable[None]]) -> int:
+        """
+        推送待發送的通知
+        
+        Args:
+            is_online: user_id -> 是否有在線的前端連接
+            send: 向用戶的所有連接發送消息
+        
+        Returns:
+            推送的消息數量
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        
+        deliveries = []
+        held = {}
+        
+        for user_id, notifications in pending.items():
+            if not is_online(user_id):
+                continue
+            
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                bucket = TokenBucket(self.burst, self.rate_per_minute)
+                self.buckets[user_id] = bucket
+            
+            if not bucket.try_acquire():
+                held[user_id] = notifications
+                continue
+            
+            if len(notifications) == 1:
+                message = {"type": "notification", "data": notifications[0]}
+            else:
+                message = {
+                    "type": "notification_digest",
+                    "data": {
+                        "count": len(notifications),
+                        "notifications": notifications
+                    }
+                }
+            deliveries.append((user_id, message))
+        
+        # 被限流的通知放回隊列，和之後的通知合併
+        if held:
+            with self.lock:
+                for user_id, notifications in held.items():
+                    self.pending[user_id] = notifications + self.pending.get(user_id, [])
+        
+        for user_id, message in deliveries:
+            await send(user_id, message)
+        
+        return len(deliveries)
+    
+    def forget_user(self, user_id: int):
+        """用戶的所有連接都斷開後清理限流狀態"""
+        with self.lock:
+            self.pending.pop(user_id, None)
+        self.buckets.pop(user_id, None)
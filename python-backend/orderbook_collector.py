@@ -4,8 +4,7 @@ Polymarket Orderbook Collector
 解決數據時效性、地址覆蓋率和數據完整性問題
 """
 
-from gql import gql, Client
-from gql.transport.aiohttp import AIOHTTPTransport
+from gql import gql
 import os
 import logging
 import asyncio
@@ -13,6 +12,8 @@ from datetime import datetime
 from typing import List, Dict, Optional
 import mysql.connector
 from mysql.connector import Error
+from subgraph_cache import default_cache
+from subgraph_http import SubgraphEndpoint
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +48,9 @@ class OrderbookCollector:
         # GraphQL client
         self.client = None
         
+        # Local response cache for finalized history (None when disabled)
+        self.cache = default_cache()
+        
         # Service name for sync_state tracking
         self.service_name = 'orderbook_collector'
         
@@ -81,9 +85,14 @@ class OrderbookCollector:
             logger.error(f"Error parsing DATABASE_URL: {e}")
     
     def _create_client(self):
-        """創建 GraphQL 客戶端"""
-        transport = AIOHTTPTransport(url=self.orderbook_endpoint)
-        return Client(transport=transport, fetch_schema_from_transport=False)
+        """創建端點客戶端（長連接 session，失敗時自動重試）"""
+        return SubgraphEndpoint(
+            self.orderbook_endpoint,
+            name='orderbook',
+            rate_per_second=float(os.getenv('SUBGRAPH_RATE_PER_SECOND', '10')),
+            burst=int(os.getenv('SUBGRAPH_BURST', '10')),
+            cache=self.cache
+        )
     
     async def _ensure_client(self):
         """確保客戶端已初始化"""
@@ -220,11 +229,12 @@ class OrderbookCollector:
         }
         
         try:
-            async with self.client as session:
-                result = await session.execute(query, variable_values=params)
-                events = result.get('orderFilledEvents', [])
-                logger.info(f"Retrieved {len(events)} order filled events from timestamp {start_timestamp}")
-                return events
+            # 滿頁且最後一條已過最終性窗口時結果不再變化，重跑回填直接讀緩存
+            cacheable = self.cache.full_page_is_final('orderFilledEvents', limit) if self.cache else None
+            result = await self.client.execute(query, params, cacheable)
+            events = result.get('orderFilledEvents', [])
+            logger.info(f"Retrieved {len(events)} order filled events from timestamp {start_timestamp}")
+            return events
         except Exception as e:
             logger.error(f"Error fetching order filled events: {e}")
             raise
@@ -454,6 +464,7 @@ class OrderbookCollector:
             )
             
             logger.info(f"Collection completed: {total_processed} events processed")
+            logger.info(f"Orderbook endpoint stats: {self.client.stats()}")
             logger.info("=" * 60)
             
             return total_processed
@@ -471,6 +482,11 @@ class OrderbookCollector:
             )
             
             raise
+    
+    async def close(self):
+        """關閉端點 session（在運行收集的事件循環結束前調用）"""
+        if self.client is not None:
+            await self.client.close()
 
 
 # 測試代碼
@@ -496,6 +512,8 @@ if __name__ == "__main__":
         except Exception as e:
             print(f"\n❌ Collection failed: {e}")
             sys.exit(1)
+        finally:
+            await collector.close()
     
     # 運行測試
     asyncio.run(test())
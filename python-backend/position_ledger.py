@@ -0,0 +1,453 @@
+"""
+持倉賬本
+按 (地址, 市場, 結果) 維護持倉數量、成本、已實現盈虧和首次建倉時間，
+每筆新交易在內存中 O(1) 更新後批量寫入 position_ledger 表
+
+評分、結算和 API 直接讀取 position_ledger，不再對 address_trades 做聚合查詢
+
+交易來源：address_trades 中未應用的行（買賣、split / merge、redemption），
+每行的應用狀態記錄在 address_trades.ledger_state，與持倉變化在同一個事務中提交；
+應用後被原地修改的行（例如 split / merge 金額更新）所在市場的持倉按交易重建
+"""
+
+import logging
+import os
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from mysql.connector import pooling
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = 'position_ledger'
+
+OUTCOMES = ('YES', 'NO')
+
+# address_trades.ledger_state
+LEDGER_NEW = 0        # 未應用
+LEDGER_APPLIED = 1    # 已應用
+LEDGER_CHANGED = 2    # 應用後被修改（寫入方在金額變化時設置）
+
+# 小於此值的持倉視為已平倉
+POSITION_EPSILON = 1e-9
+
+LEDGER_UPSERT_QUERY = """
+    INSERT INTO position_ledger
+        (address_id, market_id, outcome, size, cost_basis, realized_pnl,
+         first_entry_at, last_trade_at, trade_count)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        size = VALUES(size),
+        cost_basis = VALUES(cost_basis),
+        realized_pnl = VALUES(realized_pnl),
+        first_entry_at = VALUES(first_entry_at),
+        last_trade_at = VALUES(last_trade_at),
+        trade_count = VALUES(trade_count)
+"""
+
+# 鎖定讀取：事務提交前寫入方不能修改這些行，應用的金額和標記為已應用的金額一致
+NEW_TRADES_QUERY = """
+    SELECT id, address_id, market_id, trade_type, side, outcome, amount, price, timestamp
+    FROM address_trades
+    WHERE ledger_state = %s
+    ORDER BY id
+    LIMIT %s
+    FOR UPDATE
+"""
+
+# 有被修改的已應用行的市場
+CHANGED_MARKETS_QUERY = """
+    SELECT DISTINCT market_id
+    FROM address_trades
+    WHERE ledger_state = %s
+    LIMIT %s
+"""
+
+# 市場所有已應用（包括應用後被修改）的行，用於重建持倉
+MARKET_TRADES_QUERY = """
+    SELECT id, address_id, market_id, trade_type, side, outcome, amount, price, timestamp
+    FROM address_trades
+    WHERE market_id IN ({placeholders})
+      AND ledger_state <> %s
+    ORDER BY id
+    FOR UPDATE
+"""
+
+
+class Position:
+    """
+    單個 (地址, 市場, 結果) 的持倉（平均成本法）
+    
+    size 為份數（可以為負，表示賣出多於已記錄的買入），
+    cost_basis 為當前持倉的淨成本（USDC），realized_pnl 為平倉部分的已實現盈虧
+    """
+    
+    __slots__ = ('size', 'cost_basis', 'realized_pnl', 'first_entry_at', 'last_trade_at', 'trade_count')
+    
+    def __init__(self, size: float = 0.0, cost_basis: float = 0.0, realized_pnl: float = 0.0,
+                 first_entry_at: Optional[datetime] = None, last_trade_at: Optional[datetime] = None,
+                 trade_count: int = 0):
+        self.size = size
+        self.cost_basis = cost_basis
+        self.realized_pnl = realized_pnl
+        self.first_entry_at = first_entry_at
+        self.last_trade_at = last_trade_at
+        self.trade_count = trade_count
+    
+    def apply(self, shares: float, cash: float, timestamp: datetime):
+        """
+        應用一筆交易
+        
+        Args:
+            shares: 份數變化（買入為正，賣出為負）
+            cash: 現金流（支付為正，收到為負）
+            timestamp: 交易時間
+        """
+        if self.first_entry_at is None or timestamp < self.first_entry_at:
+            self.first_entry_at = timestamp
+        if self.last_trade_at is None or timestamp > self.last_trade_at:
+            self.last_trade_at = timestamp
+        self.trade_count += 1
+        
+        if abs(self.size) < POSITION_EPSILON or (self.size > 0) == (shares > 0):
+            # 開倉或加倉
+            self.size += shares
+            self.cost_basis += cash
+            return
+        
+        # 減倉：平掉的部分按平均成本實現盈虧，超出持倉的部分反向開倉
+        closing = min(abs(shares), abs(self.size))
+        ratio = closing / abs(shares)
+        released = self.cost_basis * closing / abs(self.size)
+        
+        self.realized_pnl += -cash * ratio - released
+        self.cost_basis -= released
+        self.size += shares * ratio
+        
+        if ratio < 1:
+            self.size += shares * (1 - ratio)
+            self.cost_basis += cash * (1 - ratio)
+        
+        if abs(self.size) < POSITION_EPSILON:
+            self.size = 0.0
+            self.cost_basis = 0.0
+    
+    def close(self, proceeds: float, timestamp: datetime):
+        """兌付後全部平倉"""
+        self.realized_pnl += proceeds - self.cost_basis
+        self.size = 0.0
+        self.cost_basis = 0.0
+        if self.last_trade_at is None or timestamp > self.last_trade_at:
+            self.last_trade_at = timestamp
+        self.trade_count += 1
+
+
+class PositionLedger:
+    """
+    內存中的持倉賬本
+    
+    由 PositionLedgerService 按市場加載已有持倉，應用新交易後通過 dirty_rows 取出變化的持倉寫回
+    """
+    
+    def __init__(self):
+        self.positions: Dict[Tuple[int, int, str], Position] = {}
+        self.loaded_markets: Set[int] = set()
+        self.dirty: Set[Tuple[int, int, str]] = set()
+    
+    def get(self, address_id: int, market_id: int, outcome: str) -> Position:
+        key = (address_id, market_id, outcome)
+        position = self.positions.get(key)
+        if position is None:
+            position = Position()
+            self.positions[key] = position
+        self.dirty.add(key)
+        return position
+    
+    def apply_buy(self, address_id: int, market_id: int, outcome: str,
+                  amount: float, price: float, timestamp: datetime):
+        """以 price 買入價值 amount USDC 的 outcome"""
+        self.get(address_id, market_id, outcome).apply(amount / price, amount, timestamp)
+    
+    def apply_sell(self, address_id: int, market_id: int, outcome: str,
+                   amount: float, price: float, timestamp: datetime):
+        """以 price 賣出價值 amount USDC 的 outcome"""
+        self.get(address_id, market_id, outcome).apply(-amount / price, -amount, timestamp)
+    
+    def apply_split(self, address_id: int, market_id: int, amount: float, timestamp: datetime):
+        """split：支付 amount USDC 得到 YES 和 NO 各 amount 份，成本平均分攤到兩個結果"""
+        for outcome in OUTCOMES:
+            self.get(address_id, market_id, outcome).apply(amount, amount / 2, timestamp)
+    
+    def apply_merge(self, address_id: int, market_id: int, amount: float, timestamp: datetime):
+        """merge：YES 和 NO 各 amount 份換回 amount USDC"""
+        for outcome in OUTCOMES:
+            self.get(address_id, market_id, outcome).apply(-amount, -amount / 2, timestamp)
+    
+    def apply_redemption(self, address_id: int, market_id: int, payout: float, timestamp: datetime):
+        """
+        redemption：市場結算後兌付 payout USDC，該市場的持倉全部平倉
+        
+        兌付金額等於獲勝結果的份數，因此兌付歸入份數最接近 payout 的結果
+        """
+        positions = [self.get(address_id, market_id, outcome) for outcome in OUTCOMES]
+        winner = min(positions, key=lambda position: abs(position.size - payout))
+        for position in positions:
+            position.close(payout if position is winner else 0.0, timestamp)
+    
+    def apply_trade_row(self, row: Sequence):
+        """應用一行 NEW_TRADES_QUERY 結果"""
+        _, address_id, market_id, trade_type, side, outcome, amount, price, timestamp = row
+        amount = float(amount or 0)
+        if amount <= 0:
+            return
+        
+        if trade_type == 'split':
+            self.apply_split(address_id, market_id, amount, timestamp)
+        elif trade_type == 'merge':
+            self.apply_merge(address_id, market_id, amount, timestamp)
+        elif trade_type == 'redemption' or side == 'redeem':
+            self.apply_redemption(address_id, market_id, amount, timestamp)
+        elif outcome in OUTCOMES and price and 0 < float(price) <= 1:
+            # 買賣行的 amount 為 USDC、price 為每份價格（0-1）；其他單位的舊數據不計入
+            if side == 'buy':
+                self.apply_buy(address_id, market_id, outcome, amount, float(price), timestamp)
+            elif side == 'sell':
+                self.apply_sell(address_id, market_id, outcome, amount, float(price), timestamp)
+    
+    def dirty_rows(self) -> List[Tuple]:
+        """變化的持倉（LEDGER_UPSERT_QUERY 參數格式）"""
+        rows = []
+        for key in self.dirty:
+            position = self.positions[key]
+            rows.append((
+                *key,
+                round(position.size, 6),
+                round(position.cost_basis, 6),
+                round(position.realized_pnl, 6),
+                position.first_entry_at,
+                position.last_trade_at,
+                position.trade_count
+            ))
+        return rows
+    
+    def drop_markets(self, market_ids: Iterable[int]):
+        """丟棄市場在內存中的持倉（重建前調用）"""
+        market_ids = set(market_ids)
+        for key in [key for key in self.positions if key[1] in market_ids]:
+            del self.positions[key]
+            self.dirty.discard(key)
+        self.loaded_markets.difference_update(market_ids)
+    
+    def clear(self):
+        """釋放內存中的持倉（只在沒有未寫入的變化時調用）"""
+        self.positions.clear()
+        self.loaded_markets.clear()
+        self.dirty.clear()
+
+
+class PositionLedgerService:
+    """把 address_trades 的新行增量應用到 position_ledger"""
+    
+    def __init__(self, db_pool=None, max_cached_markets: int = 5000):
+        self.db_pool = db_pool or self._create_db_pool()
+        self.ledger = PositionLedger()
+        self.max_cached_markets = max_cached_markets
+    
+    def _create_db_pool(self):
+        """創建資料庫連接池"""
+        db_config = {
+            'host': os.getenv('DB_HOST', 'localhost'),
+            'user': os.getenv('DB_USER', 'root'),
+            'password': os.getenv('DB_PASSWORD', ''),
+            'database': os.getenv('DB_NAME', 'polymarket_insights'),
+            'pool_name': 'position_ledger_pool',
+            'pool_size': 2
+        }
+        
+        # 從 DATABASE_URL 解析配置
+        database_url = os.getenv('DATABASE_URL')
+        if database_url:
+            import re
+            match = re.match(r'mysql://([^:]+):([^@]+)@([^:]+):(\d+)/([^?]+)', database_url)
+            if match:
+                db_config['user'] = match.group(1)
+                db_config['password'] = match.group(2)
+                db_config['host'] = match.group(3)
+                db_config['port'] = int(match.group(4))
+                db_config['database'] = match.group(5)
+        
+        return pooling.MySQLConnectionPool(**db_config)
+    
+    def _get_db_connection(self):
+        """從連接池獲取資料庫連接"""
+        return self.db_pool.get_connection()
+    
+    def _load_markets(self, cursor, market_ids: Iterable[int]):
+        """把市場已有的持倉加載到內存"""
+        market_ids = [market_id for market_id in market_ids if market_id not in self.ledger.loaded_markets]
+        if not market_ids:
+            return
+        
+        cursor.execute(f"""
+            SELECT address_id, market_id, outcome, size, cost_basis, realized_pnl,
+                   first_entry_at, last_trade_at, trade_count
+            FROM position_ledger
+            WHERE market_id IN ({', '.join(['%s'] * len(market_ids))})
+        """, tuple(market_ids))
+        
+        for address_id, market_id, outcome, size, cost, realized, first_entry, last_trade, count in cursor.fetchall():
+            self.ledger.positions[(address_id, market_id, outcome)] = Position(
+                float(size), float(cost), float(realized), first_entry, last_trade, count or 0
+            )
+        self.ledger.loaded_markets.update(market_ids)
+    
+    def _write_positions(self, cursor, trade_ids: Sequence[int]):
+        """寫入內存中變化的持倉，並把應用的行標記為已應用（調用方提交）"""
+        dirty_rows = self.ledger.dirty_rows()
+        for i in range(0, len(dirty_rows), 1000):
+            cursor.executemany(LEDGER_UPSERT_QUERY, dirty_rows[i:i + 1000])
+        for i in range(0, len(trade_ids), 1000):
+            chunk = trade_ids[i:i + 1000]
+            cursor.execute(f"""
+                UPDATE address_trades SET ledger_state = %s
+                WHERE id IN ({', '.join(['%s'] * len(chunk))})
+            """, (LEDGER_APPLIED, *chunk))
+    
+    def _rebuild_changed_markets(self, conn, cursor, market_batch_size: int = 50) -> int:
+        """
+        重建有應用後被修改的行的市場
+        
+        平均成本法的持倉依賴交易順序，無法只撤銷被修改的一行，
+        因此清空這些市場的持倉，按 id 順序重放所有已應用的行（使用修改後的金額）
+        
+        Returns:
+            重建的市場數量
+        """
+        rebuilt = 0
+        while True:
+            cursor.execute(CHANGED_MARKETS_QUERY, (LEDGER_CHANGED, market_batch_size))
+            market_ids = [row[0] for row in cursor.fetchall()]
+            if not market_ids:
+                return rebuilt
+            
+            placeholders = ', '.join(['%s'] * len(market_ids))
+            try:
+                cursor.execute(MARKET_TRADES_QUERY.format(placeholders=placeholders), (*market_ids, LEDGER_NEW))
+                rows = cursor.fetchall()
+                
+                cursor.execute(f"DELETE FROM position_ledger WHERE market_id IN ({placeholders})", tuple(market_ids))
+                self.ledger.drop_markets(market_ids)
+                self.ledger.loaded_markets.update(market_ids)
+                for row in rows:
+                    self.ledger.apply_trade_row(row)
+                
+                self._write_positions(cursor, [row[0] for row in rows])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                # 內存狀態已包含未提交的交易，丟棄後下次從資料庫重新加載
+                self.ledger.clear()
+                raise
+            
+            self.ledger.dirty.clear()
+            rebuilt += len(market_ids)
+            logger.info(f"Rebuilt positions of {len(market_ids)} markets from {len(rows)} trades")
+    
+    def run(self, batch_size: int = 10000) -> int:
+        """
+        應用所有未應用的交易
+        
+        先重建有應用後被修改的行的市場，再按 id 順序應用未應用的行。
+        按每行的狀態而不是 id 游標讀取，亂序提交的 id 不會被跳過；
+        每批交易的持倉變化和行的應用狀態在同一個事務中提交，重複運行不會重複計入
+        
+        Returns:
+            應用的交易數量
+        """
+        conn = self._get_db_connection()
+        cursor = conn.cursor()
+        applied = 0
+        
+        try:
+            self._rebuild_changed_markets(conn, cursor)
+            
+            while True:
+                try:
+                    cursor.execute(NEW_TRADES_QUERY, (LEDGER_NEW, batch_size))
+                    rows = cursor.fetchall()
+                    if not rows:
+                        conn.commit()
+                        break
+                    
+                    self._load_markets(cursor, {row[2] for row in rows})
+                    for row in rows:
+                        self.ledger.apply_trade_row(row)
+                    last_id = rows[-1][0]
+                    
+                    self._write_positions(cursor, [row[0] for row in rows])
+                    cursor.execute("""
+                        INSERT INTO sync_state
+                            (serviceName, lastTimestamp, lastCursor, lastSyncAt, status, errorMessage,
+                             totalProcessed, lastBatchSize, createdAt, updatedAt)
+                        VALUES
+                            (%s, UNIX_TIMESTAMP(), %s, NOW(), 'idle', NULL, %s, %s, NOW(), NOW())
+                        ON DUPLICATE KEY UPDATE
+                            lastTimestamp = VALUES(lastTimestamp),
+                            lastCursor = VALUES(lastCursor),
+                            lastSyncAt = VALUES(lastSyncAt),
+                            status = VALUES(status),
+                            errorMessage = NULL,
+                            totalProcessed = totalProcessed + VALUES(lastBatchSize),
+                            lastBatchSize = VALUES(lastBatchSize),
+                            updatedAt = NOW()
+                    """, (SERVICE_NAME, str(last_id), len(rows), len(rows)))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    # 內存狀態已包含未提交的交易，丟棄後下次從資料庫重新加載
+                    self.ledger.clear()
+                    raise
+                
+                self.ledger.dirty.clear()
+                applied += len(rows)
+                
+                if len(self.ledger.loaded_markets) > self.max_cached_markets:
+                    self.ledger.clear()
+            
+            if applied:
+                logger.info(f"✅ Applied {applied} trades to position ledger")
+            return applied
+        finally:
+            cursor.close()
+            conn.close()
+
+
+def reset_position_ledger(cursor):
+    """address_trades 被重建時清空賬本和統計，所有行標記為未應用，下次運行從頭應用"""
+    cursor.execute("DELETE FROM position_ledger")
+    cursor.execute("DELETE FROM sync_state WHERE serviceName = %s", (SERVICE_NAME,))
+    cursor.execute("UPDATE address_trades SET ledger_state = %s WHERE ledger_state <> %s", (LEDGER_NEW, LEDGER_NEW))
+
+
+# 測試代碼
+if __name__ == "__main__":
+    import sys
+    
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    
+    service = PositionLedgerService()
+    
+    # --rebuild：清空賬本後從頭應用所有交易
+    if len(sys.argv) > 1 and sys.argv[1] == '--rebuild':
+        conn = service._get_db_connection()
+        cursor = conn.cursor()
+        try:
+            reset_position_ledger(cursor)
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+    
+    service.run()
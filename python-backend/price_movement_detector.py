@@ -1,14 +1,20 @@
 """
 價格變動檢測器
 檢測市場價格的大幅變動，用於識別早期交易者
+檢測規則由 rolling_anomaly_detector.MultiWindowAnomalyDetector 提供，與實時檢測共用
 """
 
 import logging
 import mysql.connector
 from mysql.connector import pooling
 import os
+import time
 from datetime import datetime, timedelta
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
+from rolling_anomaly_detector import (
+    MultiWindowAnomalyDetector, DEFAULT_WINDOWS, ANOMALY_UPSERT_QUERY, anomaly_to_row
+)
+from price_sync_service import PriceSyncService, PRICE_INTERVAL_SECONDS, CLOSE_GRACE_SECONDS
 
 logger = logging.getLogger(__name__)
 
@@ -16,8 +22,9 @@ logger = logging.getLogger(__name__)
 class PriceMovementDetector:
     """價格變動檢測器 - 識別市場價格的異常變動"""
     
-    def __init__(self):
+    def __init__(self, windows: Tuple[int, ...] = DEFAULT_WINDOWS):
         self.db_pool = self._create_db_pool()
+        self.windows = windows
         
     def _create_db_pool(self):
         """創建資料庫連接池"""
@@ -48,22 +55,90 @@ class PriceMovementDetector:
         """從連接池獲取資料庫連接"""
         return self.db_pool.get_connection()
     
-    def detect_price_movements(self, market_id: int, threshold_percent: float = 20.0) -> List[Dict]:
+    def _create_engine(self, threshold_percent: float) -> MultiWindowAnomalyDetector:
+        """創建多窗口檢測引擎"""
+        return MultiWindowAnomalyDetector(
+            windows=self.windows,
+            spike_threshold_percent=threshold_percent
+        )
+    
+    def detect_price_movements(self, market_id: int, threshold_percent: float = 20.0,
+                               watermark: Optional[Dict] = None) -> List[Dict]:
         """
         檢測市場價格的大幅變動
         
         Args:
             market_id: 市場 ID
-            threshold_percent: 價格變動閾值（百分比），默認 20%
+            threshold_percent: 相鄰價格點變動閾值（百分比），默認 20%
+            watermark: 上次處理到的價格點（last_timestamp, last_price），
+                       提供時只對之後的新數據產生異常
         
         Returns:
-            價格異常變動列表
+            價格異常變動列表（price_spike、zscore_breakout_*、range_breakout_*）
+        """
+        engine = self._create_engine(threshold_percent)
+        last_closed = PriceSyncService._last_closed_bucket(
+            int(time.time()), PRICE_INTERVAL_SECONDS, CLOSE_GRACE_SECONDS
+        )
+        price_history = self._closed_points(
+            self._fetch_price_points(market_id, watermark, engine.max_window_seconds),
+            last_closed
+        )
+        
+        if len(price_history) < 2:
+            logger.warning(f"Not enough price data for market {market_id}")
+            return []
+        
+        warmup_until = watermark['last_timestamp'] if watermark else None
+        return engine.process_history(market_id, price_history, warmup_until=warmup_until)
+    
+    @staticmethod
+    def _closed_points(points: List[Dict], last_closed_bucket: int) -> List[Dict]:
+        """
+        只保留已完成間隔的價格點
+        
+        仍在進行的間隔的 VWAP 會隨新交易變化，不參與檢測也不推進水位，完成後的下一次運行再處理
+        """
+        return [point for point in points if int(point['timestamp'].timestamp()) <= last_closed_bucket]
+    
+    def _fetch_price_points(self, market_id: int, watermark: Optional[Dict] = None,
+                            warmup_seconds: int = 0) -> List[Dict]:
+        """
+        獲取市場的價格點（按時間排序）
+        
+        有水位時只讀取水位前 warmup_seconds 秒之後的數據：水位之前的部分用於預熱滾動窗口，
+        使跨批次邊界的價格變動也能被檢測到
         """
         conn = self._get_db_connection()
         cursor = conn.cursor(dictionary=True)
         
         try:
-            # 獲取市場的價格歷史（按時間排序）
+            if watermark:
+                cursor.execute("""
+                    SELECT 
+                        id,
+                        price,
+                        volume,
+                        timestamp
+                    FROM market_price_history
+                    WHERE market_id = %s
+                        AND timestamp > DATE_SUB(%s, INTERVAL %s SECOND)
+                    ORDER BY timestamp ASC
+                """, (market_id, watermark['last_timestamp'], warmup_seconds))
+                
+                points = cursor.fetchall()
+                
+                # 水位點已不在表中時，用記錄的最後價格銜接
+                if not points or points[0]['timestamp'] > watermark['last_timestamp']:
+                    bridge_point = {
+                        'id': None,
+                        'price': watermark['last_price'],
+                        'volume': 0,
+                        'timestamp': watermark['last_timestamp']
+                    }
+                    points = [bridge_point] + points
+                return points
+            
             cursor.execute("""
                 SELECT 
                     id,
@@ -75,53 +150,57 @@ class PriceMovementDetector:
                 ORDER BY timestamp ASC
             """, (market_id,))
             
-            price_history = cursor.fetchall()
-            
-            if len(price_history) < 2:
-                logger.warning(f"Not enough price data for market {market_id}")
-                return []
-            
-            # 檢測價格變動
-            anomalies = []
-            
-            for i in range(1, len(price_history)):
-                prev_point = price_history[i - 1]
-                curr_point = price_history[i]
-                
-                prev_price = prev_point['price']
-                curr_price = curr_point['price']
-                
-                # 避免除以零
-                if prev_price == 0:
-                    continue
-                
-                # 計算價格變動百分比
-                price_change_percent = ((curr_price - prev_price) / prev_price) * 100
-                
-                # 檢查是否超過閾值
-                if abs(price_change_percent) >= threshold_percent:
-                    anomalies.append({
-                        'market_id': market_id,
-                        'timestamp': curr_point['timestamp'],
-                        'price_before': prev_price,
-                        'price_after': curr_price,
-                        'price_change_percent': price_change_percent,
-                        'volume': curr_point['volume']
-                    })
-                    
-                    logger.info(f"Detected price movement: Market {market_id}, "
-                              f"Change: {price_change_percent:.2f}%, "
-                              f"Time: {curr_point['timestamp']}")
-            
-            return anomalies
+            return cursor.fetchall()
             
         except Exception as e:
-            logger.error(f"Error detecting price movements: {e}")
+            logger.error(f"Error fetching price history for market {market_id}: {e}")
             return []
         finally:
             cursor.close()
             conn.close()
     
+    def _load_watermarks(self) -> Dict[int, Dict]:
+        """一次性讀取所有市場的處理水位"""
+        conn = self._get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        
+        try:
+            cursor.execute("""
+                SELECT market_id, last_timestamp, last_price
+                FROM price_anomaly_watermarks
+            """)
+            return {row['market_id']: row for row in cursor.fetchall()}
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def _save_watermark(self, market_id: int, last_point: Dict):
+        """
+        更新市場的處理水位
+        
+        必須在異常保存成功後調用：如果中途失敗，下次運行會重新處理同一批數據，
+        而異常寫入是冪等的（ON DUPLICATE KEY UPDATE）
+        """
+        conn = self._get_db_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute("""
+                INSERT INTO price_anomaly_watermarks (market_id, last_timestamp, last_price)
+                VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                    last_timestamp = VALUES(last_timestamp),
+                    last_price = VALUES(last_price)
+            """, (market_id, last_point['timestamp'], last_point['price']))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error saving watermark for market {market_id}: {e}")
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+    
     def save_price_anomalies(self, anomalies: List[Dict]):
         """
         將價格異常保存到資料庫
@@ -138,26 +217,9 @@ class PriceMovementDetector:
         
         try:
             # 批量插入異常數據
-            insert_query = """
-                INSERT INTO market_anomalies 
-                (market_id, anomaly_type, timestamp, price_change_percent, detected_at)
-                VALUES (%s, %s, %s, %s, NOW())
-                ON DUPLICATE KEY UPDATE
-                    price_change_percent = VALUES(price_change_percent),
-                    detected_at = NOW()
-            """
-            
-            values = [
-                (
-                    anomaly['market_id'],
-                    'price_spike',
-                    anomaly['timestamp'],
-                    int(anomaly['price_change_percent'] * 100)  # 轉換為整數（以分為單位）
-                )
-                for anomaly in anomalies
-            ]
+            values = [anomaly_to_row(anomaly) for anomaly in anomalies]
             
-            cursor.executemany(insert_query, values)
+            cursor.executemany(ANOMALY_UPSERT_QUERY, values)
             conn.commit()
             
             logger.info(f"✅ Saved {len(anomalies)} price anomalies")
@@ -170,27 +232,47 @@ class PriceMovementDetector:
             cursor.close()
             conn.close()
     
-    def detect_and_save_all_markets(self, threshold_percent: float = 20.0):
+    def detect_and_save_all_markets(self, threshold_percent: float = 20.0, full_rescan: bool = False):
         """
         檢測所有市場的價格異常並保存
         
+        默認只處理每個市場水位之後的新價格點，成本與新增數據量成正比；
+        full_rescan=True 時忽略水位，重新掃描全部歷史
+        
         Args:
             threshold_percent: 價格變動閾值（百分比）
+            full_rescan: 是否忽略水位重新掃描
         """
-        logger.info(f"Detecting price movements for all markets (threshold: {threshold_percent}%)")
+        logger.info(f"Detecting price movements for all markets (threshold: {threshold_percent}%, "
+                    f"mode: {'full rescan' if full_rescan else 'incremental'})")
+        
+        watermarks = {} if full_rescan else self._load_watermarks()
+        engine = self._create_engine(threshold_percent)
+        last_closed = PriceSyncService._last_closed_bucket(
+            int(time.time()), PRICE_INTERVAL_SECONDS, CLOSE_GRACE_SECONDS
+        )
         
         conn = self._get_db_connection()
         cursor = conn.cursor(dictionary=True)
         
         try:
-            # 獲取所有有價格歷史的市場
-            cursor.execute("""
-                SELECT DISTINCT market_id
-                FROM market_price_history
-            """)
+            # 只獲取水位之後有新價格點的市場
+            if full_rescan:
+                cursor.execute("""
+                    SELECT DISTINCT market_id
+                    FROM market_price_history
+                """)
+            else:
+                cursor.execute("""
+                    SELECT DISTINCT h.market_id
+                    FROM market_price_history h
+                    LEFT JOIN price_anomaly_watermarks w ON w.market_id = h.market_id
+                    WHERE w.market_id IS NULL
+                        OR h.timestamp > w.last_timestamp
+                """)
             
             markets = cursor.fetchall()
-            logger.info(f"Found {len(markets)} markets with price history")
+            logger.info(f"Found {len(markets)} markets with new price data")
             
             total_anomalies = 0
             
@@ -198,14 +280,32 @@ class PriceMovementDetector:
                 market_id = market['market_id']
                 
                 try:
+                    # 只讀取水位之後的價格點（水位前一個最長窗口的數據用於預熱）
+                    watermark = watermarks.get(market_id)
+                    price_history = self._closed_points(
+                        self._fetch_price_points(market_id, watermark, engine.max_window_seconds),
+                        last_closed
+                    )
+                    
+                    if not price_history:
+                        continue
+                    
                     # 檢測價格變動
-                    anomalies = self.detect_price_movements(market_id, threshold_percent)
+                    anomalies = engine.process_history(
+                        market_id,
+                        price_history,
+                        warmup_until=watermark['last_timestamp'] if watermark else None
+                    )
+                    engine.reset(market_id)
                     
                     if anomalies:
                         # 保存異常
                         self.save_price_anomalies(anomalies)
                         total_anomalies += len(anomalies)
                     
+                    # 推進水位到最後一個已完成間隔的價格點
+                    self._save_watermark(market_id, price_history[-1])
+                    
                 except Exception as e:
                     logger.error(f"Error processing market {market_id}: {e}")
                     continue
@@ -257,7 +357,12 @@ if __name__ == "__main__":
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     )
     
+    import sys
+    
     detector = PriceMovementDetector()
     
-    # 檢測所有市場的價格異常（閾值 20%）
-    detector.detect_and_save_all_markets(threshold_percent=20.0)
+    # 檢測所有市場的價格異常（閾值 20%），--full-rescan 忽略水位重新掃描
+    detector.detect_and_save_all_markets(
+        threshold_percent=20.0,
+        full_rescan='--full-rescan' in sys.argv
+    )
@@ -0,0 +1,357 @@
+"""
+多級價格彙總服務
+維護 1 分鐘 / 15 分鐘 / 1 小時 / 1 天 四級 OHLC + VWAP + 成交筆數，
+只有 1 分鐘級別讀取原始交易，較粗的級別由上一級彙總而來
+"""
+
+import logging
+from mysql.connector import pooling
+import os
+import time
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
+from price_sync_service import OhlcvBucket
+from trade_archive import DAY_SECONDS, TradeArchiveReader, day_start
+
+logger = logging.getLogger(__name__)
+
+# 彙總級別（秒），由細到粗
+RESOLUTIONS = (60, 900, 3600, 86400)
+
+ROLLUP_UPSERT_QUERY = """
+    INSERT INTO market_price_rollups
+    (market_id, resolution, bucket_start, open_price, high_price, low_price, close_price,
+     vwap, volume, trade_count)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        open_price = VALUES(open_price),
+        high_price = VALUES(high_price),
+        low_price = VALUES(low_price),
+        close_price = VALUES(close_price),
+        vwap = VALUES(vwap),
+        volume = VALUES(volume),
+        trade_count = VALUES(trade_count)
+"""
+
+
+def choose_resolution(granularity_seconds: int) -> int:
+    """選擇不超過所需粒度的最粗級別（請求粒度比 1 分鐘還細時返回 1 分鐘）"""
+    chosen = RESOLUTIONS[0]
+    for resolution in RESOLUTIONS:
+        if resolution <= granularity_seconds:
+            chosen = resolution
+    return chosen
+
+
+class PriceRollupService:
+    """多級價格彙總服務"""
+    
+    TRADES_QUERY = """
+        SELECT
+            marketId,
+            UNIX_TIMESTAMP(timestamp),
+            price,
+            amount
+        FROM trades
+        WHERE marketId > 0
+            AND timestamp >= FROM_UNIXTIME(%s)
+            AND timestamp < FROM_UNIXTIME(%s)
+        ORDER BY marketId, timestamp
+    """
+    
+    def __init__(self, archive: Optional[TradeArchiveReader] = None):
+        self.db_pool = self._create_db_pool()
+        self.archive = archive or TradeArchiveReader()
+    
+    def _create_db_pool(self):
+        """創建資料庫連接池"""
+        db_config = {
+            'host': os.getenv('DB_HOST', 'localhost'),
+            'user': os.getenv('DB_USER', 'root'),
+            'password': os.getenv('DB_PASSWORD', ''),
+            'database': os.getenv('DB_NAME', 'polymarket_insights'),
+            'pool_name': 'price_rollup_pool',
+            'pool_size': 3
+        }
+        
+        # 從 DATABASE_URL 解析配置
+        database_url = os.getenv('DATABASE_URL')
+        if database_url:
+            import re
+            match = re.match(r'mysql://([^:]+):([^@]+)@([^:]+):(\d+)/([^?]+)', database_url)
+            if match:
+                db_config['user'] = match.group(1)
+                db_config['password'] = match.group(2)
+                db_config['host'] = match.group(3)
+                db_config['port'] = int(match.group(4))
+                db_config['database'] = match.group(5)
+        
+        return pooling.MySQLConnectionPool(**db_config)
+    
+    def _get_db_connection(self):
+        """從連接池獲取資料庫連接"""
+        return self.db_pool.get_connection()
+    
+    @staticmethod
+    def _bucket_to_row(market_id: int, resolution: int, bucket: OhlcvBucket) -> Tuple:
+        point = bucket.to_point()
+        return (
+            market_id,
+            resolution,
+            point['timestamp'],
+            point['open'],
+            point['high'],
+            point['low'],
+            point['close'],
+            point['vwap'],
+            point['volume'],
+            point['trade_count']
+        )
+    
+    def _iter_query(self, query: str, params: Tuple, fetch_size: int = 5000) -> Iterator[Tuple]:
+        """流式讀取查詢結果（不緩衝整個結果集）"""
+        conn = self._get_db_connection()
+        cursor = conn.cursor(buffered=False)
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def _stream_buckets(self, rows: Iterable[Tuple], resolution: int, add_row,
+                        write_batch_size: int = 1000) -> int:
+        """
+        邊讀邊把按 (market_id, 時間) 排序的數據聚合到 resolution 級別並批量寫入
+        
+        Args:
+            rows: (market_id, 時間戳, ...) 行，同一個 bucket 的行必須相鄰
+            resolution: 目標級別（秒）
+            add_row: (bucket, row, bucket_start) -> bucket，把一行累加到 bucket（bucket 為 None 時新建）
+        
+        Returns:
+            寫入的 bucket 數量
+        """
+        write_conn = self._get_db_connection()
+        write_cursor = write_conn.cursor()
+        
+        pending_rows = []
+        written = 0
+        
+        try:
+            current_market = None
+            bucket = None
+            
+            for row in rows:
+                market_id = row[0]
+                bucket_start = (int(row[1]) // resolution) * resolution
+                
+                if market_id == current_market and bucket.start == bucket_start:
+                    add_row(bucket, row, bucket_start)
+                    continue
+                
+                if bucket is not None:
+                    pending_rows.append(self._bucket_to_row(current_market, resolution, bucket))
+                    
+                    if len(pending_rows) >= write_batch_size:
+                        write_cursor.executemany(ROLLUP_UPSERT_QUERY, pending_rows)
+                        write_conn.commit()
+                        written += len(pending_rows)
+                        pending_rows.clear()
+                
+                current_market = market_id
+                bucket = add_row(None, row, bucket_start)
+            
+            if bucket is not None:
+                pending_rows.append(self._bucket_to_row(current_market, resolution, bucket))
+            
+            if pending_rows:
+                write_cursor.executemany(ROLLUP_UPSERT_QUERY, pending_rows)
+                write_conn.commit()
+                written += len(pending_rows)
+            
+            return written
+        
+        except Exception as e:
+            write_conn.rollback()
+            logger.error(f"Error building {resolution}s rollups: {e}")
+            raise
+        finally:
+            write_cursor.close()
+            write_conn.close()
+    
+    def _iter_trades(self, start_time: int, end_time: int, use_archive: bool) -> Iterator[Tuple]:
+        """
+        按天讀取 (marketId, 時間戳, price, amount)
+        
+        已歸檔的日期從本地 Parquet 文件讀取，其餘日期（通常只有最近一兩天）查詢 trades 表
+        """
+        if not use_archive:
+            yield from self._iter_query(self.TRADES_QUERY, (start_time, end_time))
+            return
+        
+        columns = ['marketId', 'timestamp', 'price', 'amount']
+        archived = 0
+        
+        for day in range(day_start(start_time), end_time, DAY_SECONDS):
+            day_from = max(day, start_time)
+            day_to = min(day + DAY_SECONDS, end_time)
+            
+            if self.archive.has_day(day):
+                archived += 1
+                for row in self.archive.iter_rows(day_from, day_to, columns):
+                    if row[0]:
+                        yield row
+            else:
+                yield from self._iter_query(self.TRADES_QUERY, (day_from, day_to))
+        
+        logger.info(f"Read {archived} day(s) of trades from the archive")
+    
+    def rollup_trades(self, start_time: int, end_time: int, use_archive: bool = False) -> int:
+        """
+        從原始交易構建最細級別（1 分鐘）的彙總
+        
+        use_archive=True 時已歸檔的日期從交易歸檔讀取，用於大範圍回填
+        """
+        resolution = RESOLUTIONS[0]
+        start_time = (start_time // resolution) * resolution
+        
+        def add_trade(bucket, row, bucket_start):
+            _, _, price, amount = row
+            if bucket is None:
+                return OhlcvBucket(bucket_start, price, amount)
+            bucket.add(price, amount)
+            return bucket
+        
+        return self._stream_buckets(
+            self._iter_trades(start_time, end_time, use_archive), resolution, add_trade
+        )
+    
+    def rollup_level(self, finer: int, coarser: int, start_time: int, end_time: int) -> int:
+        """由較細級別的彙總構建較粗級別，不讀取原始交易"""
+        start_time = (start_time // coarser) * coarser
+        
+        def add_point(bucket, row, bucket_start):
+            _, _, open_price, high, low, close, vwap, volume, trade_count = row
+            point = {
+                'open': open_price,
+                'high': high,
+                'low': low,
+                'close': close,
+                'vwap': float(vwap),
+                'volume': volume,
+                'trade_count': trade_count
+            }
+            if bucket is None:
+                return OhlcvBucket.from_point(bucket_start, point)
+            bucket.merge(point)
+            return bucket
+        
+        return self._stream_buckets(self._iter_query("""
+            SELECT
+                market_id,
+                bucket_start,
+                open_price,
+                high_price,
+                low_price,
+                close_price,
+                vwap,
+                volume,
+                trade_count
+            FROM market_price_rollups
+            WHERE resolution = %s
+                AND bucket_start >= %s
+                AND bucket_start < %s
+            ORDER BY market_id, bucket_start
+        """, (finer, start_time, end_time)), coarser, add_point)
+    
+    def run(self, lookback_seconds: int = 2 * 3600, use_archive: bool = False):
+        """
+        更新所有級別的彙總
+        
+        1 分鐘級別只重建最近 lookback_seconds 的數據；每個較粗級別從其 bucket 邊界開始
+        由上一級重新彙總，因此未完成的粗粒度 bucket 總是由完整的細粒度數據構成
+        
+        use_archive=True 時 1 分鐘級別從交易歸檔讀取已歸檔的日期（回填時使用）
+        """
+        end_time = int(time.time()) + 1
+        start_time = end_time - lookback_seconds
+        
+        written = self.rollup_trades(start_time, end_time, use_archive=use_archive)
+        logger.info(f"Built {written} rollups at {RESOLUTIONS[0]}s resolution")
+        
+        for finer, coarser in zip(RESOLUTIONS, RESOLUTIONS[1:]):
+            written = self.rollup_level(finer, coarser, start_time, end_time)
+            logger.info(f"Built {written} rollups at {coarser}s resolution from {finer}s")
+        
+        logger.info("✅ Price rollups updated")
+    
+    def get_price_series(self, market_id: int, start_time: int, end_time: int,
+                         granularity_seconds: int = 3600) -> List[Dict]:
+        """
+        查詢市場在時間範圍內的 OHLC 序列
+        
+        使用不超過所需粒度的最粗級別，例如 90 天的日線圖只讀取約 90 行
+        
+        Args:
+            market_id: 市場 ID
+            start_time: 開始時間（Unix 時間戳，秒）
+            end_time: 結束時間（Unix 時間戳，秒）
+            granularity_seconds: 所需的最大數據點間隔（秒）
+        
+        Returns:
+            價格點列表（timestamp, open, high, low, close, vwap, volume, trade_count）
+        """
+        resolution = choose_resolution(granularity_seconds)
+        
+        conn = self._get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        
+        try:
+            cursor.execute("""
+                SELECT
+                    bucket_start AS timestamp,
+                    open_price AS open,
+                    high_price AS high,
+                    low_price AS low,
+                    close_price AS close,
+                    vwap,
+                    volume,
+                    trade_count
+                FROM market_price_rollups
+                WHERE market_id = %s
+                    AND resolution = %s
+                    AND bucket_start >= %s
+                    AND bucket_start <= %s
+                ORDER BY bucket_start ASC
+            """, (market_id, resolution, (start_time // resolution) * resolution, end_time))
+            
+            points = cursor.fetchall()
+            for point in points:
+                point['resolution'] = resolution
+            return points
+        
+        finally:
+            cursor.close()
+            conn.close()
+
+
+# 測試代碼
+if __name__ == "__main__":
+    import sys
+    
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    
+    service = PriceRollupService()
+    
+    # 默認更新最近 2 小時；--backfill-days N 回填 N 天（已歸檔的日期從交易歸檔讀取）
+    if len(sys.argv) > 2 and sys.argv[1] == '--backfill-days':
+        service.run(lookback_seconds=int(sys.argv[2]) * 24 * 3600, use_archive=True)
+    else:
+        service.run()
@@ -0,0 +1,328 @@
+"""
+本地價格序列存儲
+每個市場的已完成 K 線按列保存為定長二進制文件（timestamp int64 / price int32 / volume int64），
+通過 mmap 映射後用二分查找回答「市場 M 在時間 T 的價格」，不需要查詢資料庫
+
+目錄結構：<PRICE_SERIES_DIR>/<market_id>.ts / .price / .volume
+由 PriceSyncService 和實時 K 線寫入時調用 append，時間戳（K 線開始時間）嚴格遞增；
+新數據直接追加，晚到的回填數據合併後重寫尾部
+"""
+
+import fcntl
+import logging
+import mmap
+import os
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SERIES_DIR = os.getenv(
+    'PRICE_SERIES_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'price_series')
+)
+
+# (文件後綴, array 類型)
+SERIES_COLUMNS = (('ts', 'q'), ('price', 'i'), ('volume', 'q'))
+
+
+def _count_records(paths: List[str]) -> int:
+    """各列文件中完整對齊的記錄數（寫入中途退出時各列長度可能不一致，以最短的列為準）"""
+    counts = []
+    for path, (_, code) in zip(paths, SERIES_COLUMNS):
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        counts.append(size // array(code).itemsize)
+    return min(counts)
+
+
+class MappedSeries:
+    """單個市場的只讀映射"""
+    
+    __slots__ = ('maps', 'timestamps', 'prices', 'volumes', 'count')
+    
+    def __init__(self, paths: List[str]):
+        self.count = _count_records(paths)
+        self.maps = []
+        views = []
+        
+        for path, (_, code) in zip(paths, SERIES_COLUMNS):
+            if self.count == 0:
+                views.append(memoryview(array(code)))
+                continue
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), self.count * array(code).itemsize, access=mmap.ACCESS_READ)
+            self.maps.append(mapped)
+            views.append(memoryview(mapped).cast(code))
+        
+        self.timestamps, self.prices, self.volumes = views
+    
+    @property
+    def last_timestamp(self) -> Optional[int]:
+        return self.timestamps[self.count - 1] if self.count else None
+
+
+class PriceSeriesStore:
+    """
+    每個市場一組 mmap 列文件的價格序列存儲
+    
+    查詢：price_at / window，O(log n) 二分查找，映射在進程內緩存
+    寫入：append 追加或合併數據，用文件鎖防止多個進程同時寫入
+    """
+    
+    def __init__(self, base_dir: str = DEFAULT_SERIES_DIR, interval_seconds: int = 900):
+        self.base_dir = base_dir
+        self.interval_seconds = interval_seconds
+        os.makedirs(base_dir, exist_ok=True)
+        self.series: Dict[int, MappedSeries] = {}
+        self.lock = threading.Lock()
+    
+    def _paths(self, market_id: int) -> List[str]:
+        return [os.path.join(self.base_dir, f"{market_id}.{suffix}") for suffix, _ in SERIES_COLUMNS]
+    
+    def _get(self, market_id: int, refresh: bool = False) -> Optional[MappedSeries]:
+        """
+        獲取市場的映射
+        
+        refresh=True 時如果文件被追加過（本進程或其他進程）則重新映射；
+        舊映射不主動關閉，正在使用它的線程仍可安全讀取
+        """
+        with self.lock:
+            series = self.series.get(market_id)
+            if series is not None and not refresh:
+                return series
+            
+            paths = self._paths(market_id)
+            if not os.path.exists(paths[0]):
+                return None
+            
+            if series is not None and os.path.getsize(paths[0]) == series.count * 8:
+                return series
+            
+            series = MappedSeries(paths)
+            self.series[market_id] = series
+            return series
+    
+    def price_at(self, market_id: int, timestamp: int) -> Optional[int]:
+        """
+        市場在某個時間的價格（在 timestamp 或之前已經結束的最後一根 K 線，
+        不使用 timestamp 所在、尚未結束的 K 線，避免用到之後的成交）
+        
+        Args:
+            market_id: 市場 ID
+            timestamp: Unix 時間戳（秒）
+        
+        Returns:
+            價格（cents），沒有更早的數據時返回 None
+        """
+        series = self._get(market_id)
+        if series is None:
+            return None
+        
+        # 點的時間戳是 K 線開始時間，開始時間不晚於 latest_start 的 K 線都已結束
+        latest_start = timestamp - self.interval_seconds
+        
+        # 查詢時間在已映射數據之後時，先檢查是否有新追加的數據
+        if not series.count or latest_start > series.last_timestamp:
+            series = self._get(market_id, refresh=True)
+        
+        index = bisect_right(series.timestamps, latest_start)
+        if index == 0:
+            return None
+        return series.prices[index - 1]
+    
+    def window(self, market_id: int, start_time: int, end_time: int) -> List[Tuple[int, int, int]]:
+        """時間範圍 [start_time, end_time] 內的 (timestamp, price, volume)"""
+        series = self._get(market_id)
+        if series is None:
+            return []
+        
+        if not series.count or end_time > series.last_timestamp:
+            series = self._get(market_id, refresh=True)
+        
+        lo = bisect_left(series.timestamps, start_time)
+        hi = bisect_right(series.timestamps, end_time)
+        return list(zip(
+            series.timestamps[lo:hi].tolist(),
+            series.prices[lo:hi].tolist(),
+            series.volumes[lo:hi].tolist()
+        ))
+    
+    def last_timestamp(self, market_id: int) -> Optional[int]:
+        series = self._get(market_id, refresh=True)
+        return series.last_timestamp if series is not None else None
+    
+    def append(self, market_id: int, points: Iterable[Tuple[int, int, int]]) -> int:
+        """
+        寫入 (timestamp, price, volume) 點
+        
+        比最後一個點新的數據直接追加；晚到的點（例如實時 K 線寫入後才回填的空缺）
+        從第一個亂序的時間戳開始與已有數據合併後重寫尾部。
+        同一時間戳以新數據為準，重複同步同一段數據是安全的
+        
+        Returns:
+            新增或更新的點數
+        """
+        incoming: Dict[int, Tuple[int, int]] = {}
+        for ts, price, volume in points:
+            incoming[int(ts)] = (int(price), int(volume or 0))
+        if not incoming:
+            return 0
+        
+        paths = self._paths(market_id)
+        first = min(incoming)
+        
+        with open(paths[0], 'ab') as ts_file:
+            fcntl.flock(ts_file, fcntl.LOCK_EX)
+            try:
+                count = _count_records(paths)
+                
+                # 找到需要重寫的起點：全部比最後一個點新時為 count（純追加）
+                start = count
+                if count:
+                    with open(paths[0], 'rb') as f:
+                        f.seek((count - 1) * 8)
+                        tail = array('q')
+                        tail.fromfile(f, 1)
+                        if first <= tail[0]:
+                            f.seek(0)
+                            existing_ts = array('q')
+                            existing_ts.fromfile(f, count)
+                            start = bisect_left(existing_ts, first)
+                
+                # 讀出起點之後的已有數據，與新數據合併
+                existing = [array(code) for _, code in SERIES_COLUMNS]
+                for path, column in zip(paths, existing):
+                    if start < count:
+                        with open(path, 'rb') as f:
+                            f.seek(start * column.itemsize)
+                            column.fromfile(f, count - start)
+                
+                merged = dict(zip(existing[0], zip(existing[1], existing[2])))
+                written = 0
+                for ts, value in incoming.items():
+                    if merged.get(ts) != value:
+                        merged[ts] = value
+                        written += 1
+                
+                if not written:
+                    return 0
+                
+                columns = [array(code) for _, code in SERIES_COLUMNS]
+                for ts in sorted(merged):
+                    price, volume = merged[ts]
+                    columns[0].append(ts)
+                    columns[1].append(price)
+                    columns[2].append(volume)
+                
+                # 截掉上次中途退出留下的不完整數據，保證各列對齊；
+                # 合併後的尾部不會比原來短，從起點覆蓋寫入，已映射的範圍不會被截斷
+                for path, column in zip(paths, columns):
+                    with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                        f.truncate(count * column.itemsize)
+                        f.seek(start * column.itemsize)
+                        column.tofile(f)
+            finally:
+                fcntl.flock(ts_file, fcntl.LOCK_UN)
+        
+        # 重寫了已有數據時丟棄進程內的映射，下次查詢重新映射
+        if start < count:
+            with self.lock:
+                self.series.pop(market_id, None)
+        
+        return written
+    
+    def append_price_history_rows(self, rows: Sequence[Tuple], until: Optional[int] = None) -> int:
+        """
+        追加 PRICE_HISTORY_UPSERT_QUERY 參數格式的行
+        （market_id, condition_id, price, open, high, low, close, volume, trade_count, timestamp）
+        
+        Args:
+            rows: 價格歷史行
+            until: 只寫入時間戳不晚於此值的行（未完成的間隔之後還會變化，不寫入）
+        
+        Returns:
+            新增或更新的點數
+        """
+        by_market: Dict[int, List[Tuple[int, int, int]]] = {}
+        for row in rows:
+            ts = int(row[9])
+            if until is not None and ts > until:
+                continue
+            by_market.setdefault(row[0], []).append((ts, row[2], row[7]))
+        
+        appended = 0
+        for market_id, points in by_market.items():
+            try:
+                appended += self.append(market_id, points)
+            except OSError as e:
+                logger.error(f"Error appending price series for market {market_id}: {e}")
+        return appended
+    
+    def close(self):
+        """釋放所有映射"""
+        with self.lock:
+            for series in self.series.values():
+                for view in (series.timestamps, series.prices, series.volumes):
+                    view.release()
+                for mapped in series.maps:
+                    mapped.close()
+            self.series.clear()
+
+
+# 測試代碼
+if __name__ == "__main__":
+    import sys
+    import time
+    from price_sync_service import PriceSyncService
+    
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    
+    store = PriceSeriesStore()
+    
+    # --rebuild：從 market_price_history 重建所有市場的序列（只包含已完成的間隔）
+    if len(sys.argv) > 1 and sys.argv[1] == '--rebuild':
+        service = PriceSyncService()
+        cutoff = PriceSyncService._last_closed_bucket(int(time.time()), 900, 300)
+        
+        for name in os.listdir(store.base_dir):
+            os.remove(os.path.join(store.base_dir, name))
+        
+        conn = service._get_db_connection()
+        cursor = conn.cursor(buffered=False)
+        try:
+            cursor.execute("""
+                SELECT market_id, UNIX_TIMESTAMP(timestamp), price, volume
+                FROM market_price_history
+                WHERE timestamp <= FROM_UNIXTIME(%s)
+                ORDER BY market_id, timestamp
+            """, (cutoff,))
+            
+            total = 0
+            current_market = None
+            points = []
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                for market_id, ts, price, volume in rows:
+                    if market_id != current_market and points:
+                        total += store.append(current_market, points)
+                        points = []
+                    current_market = market_id
+                    points.append((int(ts), price, volume))
+            if points:
+                total += store.append(current_market, points)
+            
+            logger.info(f"✅ Rebuilt price series with {total} points")
+        finally:
+            cursor.close()
+            conn.close()
+    
+    elif len(sys.argv) > 3 and sys.argv[1] == '--price-at':
+        market_id, timestamp = int(sys.argv[2]), int(sys.argv[3])
+        print(f"Market {market_id} @ {timestamp}: {store.price_at(market_id, timestamp)}")
@@ -9,18 +9,117 @@ import mysql.connector
 from mysql.connector import pooling
 import os
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from typing import Iterator, List, Dict, Optional, Tuple
 import time
+from price_series_store import PriceSeriesStore
+from trade_archive import TradeArchiveReader
 
 logger = logging.getLogger(__name__)
 
+# 價格 K 線的默認間隔，以及間隔結束後多久視為已完成（留給延遲寫入的交易）
+PRICE_INTERVAL_SECONDS = 900
+CLOSE_GRACE_SECONDS = 300
+
+
+# market_price_history 寫入語句（price 為 VWAP）
+PRICE_HISTORY_UPSERT_QUERY = """
+    INSERT INTO market_price_history 
+    (market_id, condition_id, price, open_price, high_price, low_price, close_price,
+     volume, trade_count, timestamp)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, FROM_UNIXTIME(%s))
+    ON DUPLICATE KEY UPDATE
+        price = VALUES(price),
+        open_price = VALUES(open_price),
+        high_price = VALUES(high_price),
+        low_price = VALUES(low_price),
+        close_price = VALUES(close_price),
+        volume = VALUES(volume),
+        trade_count = VALUES(trade_count)
+"""
+
+
+class OhlcvBucket:
+    """單個時間間隔的 OHLCV 累加器，每筆交易 O(1) 更新"""
+    
+    __slots__ = ('start', 'open', 'high', 'low', 'close', 'volume', 'notional', 'price_sum', 'count')
+    
+    def __init__(self, start: int, price: int, volume: int):
+        self.start = start
+        self.open = price
+        self.high = price
+        self.low = price
+        self.close = price
+        self.volume = volume
+        self.notional = price * volume
+        self.price_sum = price
+        self.count = 1
+    
+    def add(self, price: int, volume: int):
+        """累加一筆交易（需按時間順序調用）"""
+        if price > self.high:
+            self.high = price
+        if price < self.low:
+            self.low = price
+        self.close = price
+        self.volume += volume
+        self.notional += price * volume
+        self.price_sum += price
+        self.count += 1
+    
+    def merge(self, point: Dict):
+        """合併一個較細時間間隔的價格點（需按時間順序調用），用於多級彙總"""
+        if point['high'] > self.high:
+            self.high = point['high']
+        if point['low'] < self.low:
+            self.low = point['low']
+        self.close = point['close']
+        self.volume += point['volume']
+        self.notional += point['vwap'] * point['volume']
+        self.price_sum += point['vwap'] * point['trade_count']
+        self.count += point['trade_count']
+    
+    @classmethod
+    def from_point(cls, start: int, point: Dict) -> 'OhlcvBucket':
+        """以一個較細時間間隔的價格點作為新間隔的起點"""
+        bucket = cls(start, point['open'], 0)
+        bucket.count = 0
+        bucket.price_sum = 0
+        bucket.merge(point)
+        return bucket
+    
+    def to_point(self) -> Dict:
+        """轉換為價格點：price 為成交量加權平均價（無成交量時為算術平均）"""
+        if self.volume > 0:
+            vwap = self.notional / self.volume
+        elif self.count > 0:
+            vwap = self.price_sum / self.count
+        else:
+            vwap = self.close
+        
+        return {
+            'price': int(vwap),
+            'vwap': vwap,
+            'open': self.open,
+            'high': self.high,
+            'low': self.low,
+            'close': self.close,
+            'volume': self.volume,
+            'trade_count': self.count,
+            'timestamp': self.start
+        }
+
 
 class PriceSyncService:
     """價格同步服務 - 從 Polymarket 同步市場歷史價格"""
     
-    def __init__(self):
+    def __init__(self, price_series_store: Optional[PriceSeriesStore] = None,
+                 archive: Optional[TradeArchiveReader] = None):
         self.db_pool = self._create_db_pool()
         self.clob_api_base = "https://clob.polymarket.com"
+        # 已完成的間隔同時追加到本地價格序列，供按時間點查價使用
+        self.price_series_store = price_series_store or PriceSeriesStore()
+        # 已歸檔的日期從交易歸檔讀取，不掃描 trades 表
+        self.archive = archive or TradeArchiveReader()
         
     def _create_db_pool(self):
         """創建資料庫連接池"""
@@ -85,29 +184,41 @@ class PriceSyncService:
                 
                 market_id = market['id']
                 
-                # 從 trades 表獲取價格數據
-                cursor.execute("""
-                    SELECT 
-                        price,
-                        amount,
-                        timestamp
-                    FROM trades
-                    WHERE marketId = %s
-                        AND timestamp >= FROM_UNIXTIME(%s)
-                        AND timestamp <= FROM_UNIXTIME(%s)
-                    ORDER BY timestamp ASC
-                """, (market_id, start_time, end_time))
-                
-                trades = cursor.fetchall()
-                
-                # 將交易數據轉換為價格歷史
+                # 已歸檔的日期從交易歸檔讀取，其餘從 trades 表獲取價格數據
                 price_history = []
-                for trade in trades:
-                    price_history.append({
-                        'price': trade['price'],
-                        'volume': trade['amount'],
-                        'timestamp': int(trade['timestamp'].timestamp())
-                    })
+                for range_from, range_to, archived in self.archive.split_range(start_time, end_time + 1):
+                    if archived:
+                        table = self.archive.scan(
+                            range_from, range_to,
+                            columns=['price', 'amount', 'timestamp'],
+                            market_ids=[market_id]
+                        ).sort_by('timestamp')
+                        for trade in table.to_pylist():
+                            price_history.append({
+                                'price': trade['price'],
+                                'volume': trade['amount'],
+                                'timestamp': trade['timestamp']
+                            })
+                        continue
+                    
+                    cursor.execute("""
+                        SELECT 
+                            price,
+                            amount,
+                            UNIX_TIMESTAMP(timestamp) AS timestamp
+                        FROM trades
+                        WHERE marketId = %s
+                            AND timestamp >= FROM_UNIXTIME(%s)
+                            AND timestamp < FROM_UNIXTIME(%s)
+                        ORDER BY timestamp ASC
+                    """, (market_id, range_from, range_to))
+                    
+                    for trade in cursor.fetchall():
+                        price_history.append({
+                            'price': trade['price'],
+                            'volume': trade['amount'],
+                            'timestamp': int(trade['timestamp'])
+                        })
                 
                 logger.info(f"Retrieved {len(price_history)} price points for condition {condition_id}")
                 return price_history
@@ -129,60 +240,30 @@ class PriceSyncService:
             interval_seconds: 時間間隔（秒），默認 3600 = 1 小時
         
         Returns:
-            聚合後的價格歷史
+            聚合後的價格歷史（price 為 VWAP，另含 open/high/low/close/trade_count）
         """
         if not price_history:
             return []
         
         aggregated = []
-        current_interval_start = None
-        interval_trades = []
+        bucket = None
         
         for price_point in price_history:
-            timestamp = price_point['timestamp']
-            
             # 計算當前時間點所屬的時間間隔
-            interval_start = (timestamp // interval_seconds) * interval_seconds
+            interval_start = (price_point['timestamp'] // interval_seconds) * interval_seconds
             
-            if current_interval_start is None:
-                current_interval_start = interval_start
-            
-            if interval_start == current_interval_start:
+            if bucket is not None and bucket.start == interval_start:
                 # 同一個時間間隔，累積數據
-                interval_trades.append(price_point)
+                bucket.add(price_point['price'], price_point['volume'])
             else:
-                # 新的時間間隔，處理上一個間隔的數據
-                if interval_trades:
-                    # 計算加權平均價格（按交易量加權）
-                    total_volume = sum(t['volume'] for t in interval_trades)
-                    if total_volume > 0:
-                        weighted_avg_price = sum(t['price'] * t['volume'] for t in interval_trades) / total_volume
-                    else:
-                        weighted_avg_price = sum(t['price'] for t in interval_trades) / len(interval_trades)
-                    
-                    aggregated.append({
-                        'price': int(weighted_avg_price),
-                        'volume': total_volume,
-                        'timestamp': current_interval_start
-                    })
-                
-                # 開始新的時間間隔
-                current_interval_start = interval_start
-                interval_trades = [price_point]
+                # 新的時間間隔，輸出上一個間隔
+                if bucket is not None:
+                    aggregated.append(bucket.to_point())
+                bucket = OhlcvBucket(interval_start, price_point['price'], price_point['volume'])
         
         # 處理最後一個時間間隔
-        if interval_trades:
-            total_volume = sum(t['volume'] for t in interval_trades)
-            if total_volume > 0:
-                weighted_avg_price = sum(t['price'] * t['volume'] for t in interval_trades) / total_volume
-            else:
-                weighted_avg_price = sum(t['price'] for t in interval_trades) / len(interval_trades)
-            
-            aggregated.append({
-                'price': int(weighted_avg_price),
-                'volume': total_volume,
-                'timestamp': current_interval_start
-            })
+        if bucket is not None:
+            aggregated.append(bucket.to_point())
         
         return aggregated
     
@@ -215,21 +296,12 @@ class PriceSyncService:
             market_id = market['id']
             
             # 批量插入價格數據
-            insert_query = """
-                INSERT INTO market_price_history 
-                (market_id, condition_id, price, volume, timestamp)
-                VALUES (%s, %s, %s, %s, FROM_UNIXTIME(%s))
-                ON DUPLICATE KEY UPDATE
-                    price = VALUES(price),
-                    volume = VALUES(volume)
-            """
-            
             values = [
-                (market_id, condition_id, point['price'], point['volume'], point['timestamp'])
+                self._price_point_to_row(market_id, condition_id, point)
                 for point in price_history
             ]
             
-            cursor.executemany(insert_query, values)
+            cursor.executemany(PRICE_HISTORY_UPSERT_QUERY, values)
             conn.commit()
             
             logger.info(f"✅ Saved {len(price_history)} price points for condition {condition_id}")
@@ -242,82 +314,319 @@ class PriceSyncService:
             cursor.close()
             conn.close()
     
-    def sync_market_price_history(self, condition_id: str, days_back: int = 30):
+    @staticmethod
+    def _price_point_to_row(market_id: int, condition_id: str, point: Dict) -> tuple:
+        """把聚合後的價格點轉換為 PRICE_HISTORY_UPSERT_QUERY 的參數"""
+        return (
+            market_id,
+            condition_id,
+            point['price'],
+            point.get('open', point['price']),
+            point.get('high', point['price']),
+            point.get('low', point['price']),
+            point.get('close', point['price']),
+            point['volume'],
+            point.get('trade_count', 0),
+            point['timestamp']
+        )
+    
+    @staticmethod
+    def _last_closed_bucket(now: int, interval_seconds: int, grace_seconds: int) -> int:
+        """
+        最後一個已完成的時間間隔起點
+        
+        間隔結束後再等待 grace_seconds 才視為完成，留給延遲寫入 trades 表的交易
+        """
+        return ((now - grace_seconds) // interval_seconds) * interval_seconds - interval_seconds
+    
+    def _get_sync_watermark(self, condition_id: str, interval_seconds: int) -> Optional[int]:
+        """獲取市場最後一個已完成並同步的時間間隔起點"""
+        conn = self._get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        
+        try:
+            cursor.execute("""
+                SELECT w.last_closed_bucket
+                FROM price_sync_watermarks w
+                JOIN markets m ON m.id = w.market_id
+                WHERE m.conditionId = %s
+                    AND w.interval_seconds = %s
+            """, (condition_id, interval_seconds))
+            
+            result = cursor.fetchone()
+            return result['last_closed_bucket'] if result else None
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def _save_sync_watermarks(self, cursor, interval_seconds: int, last_closed_bucket: int,
+                              condition_id: Optional[str] = None):
+        """
+        推進同步水位（只前進不後退）
+        
+        指定 condition_id 時只更新該市場，否則更新所有活躍市場
+        """
+        query = """
+            INSERT INTO price_sync_watermarks (market_id, interval_seconds, last_closed_bucket)
+            SELECT id, %s, %s FROM markets
+            WHERE {condition}
+            ON DUPLICATE KEY UPDATE
+                last_closed_bucket = GREATEST(last_closed_bucket, VALUES(last_closed_bucket))
+        """
+        if condition_id:
+            cursor.execute(query.format(condition='conditionId = %s'),
+                           (interval_seconds, last_closed_bucket, condition_id))
+        else:
+            cursor.execute(query.format(condition='isActive = TRUE'),
+                           (interval_seconds, last_closed_bucket))
+    
+    def sync_market_price_history(self, condition_id: str, days_back: int = 30,
+                                  interval_seconds: int = PRICE_INTERVAL_SECONDS,
+                                  grace_seconds: int = CLOSE_GRACE_SECONDS,
+                                  full_resync: bool = False):
         """
-        同步市場的價格歷史（從當前時間往回 N 天）
+        同步市場的價格歷史
+        
+        首次同步往回 days_back 天；之後只重新聚合最後一個已完成間隔之後的交易
+        （即仍在進行的間隔和更新的數據），已完成的間隔不再重寫
         
         Args:
             condition_id: 市場條件 ID
-            days_back: 往回同步的天數
+            days_back: 首次同步往回的天數
+            interval_seconds: 聚合時間間隔（秒）
+            grace_seconds: 間隔結束後多久視為已完成
+            full_resync: 忽略水位，重新同步 days_back 天
         """
-        logger.info(f"Syncing price history for condition {condition_id} (last {days_back} days)")
-        
-        # 計算時間範圍
         end_time = int(time.time())
         start_time = end_time - (days_back * 24 * 3600)
         
+        watermark = None if full_resync else self._get_sync_watermark(condition_id, interval_seconds)
+        if watermark is not None:
+            start_time = max(start_time, watermark + interval_seconds)
+        
+        logger.info(f"Syncing price history for condition {condition_id} "
+                    f"(from {datetime.fromtimestamp(start_time)})")
+        
         # 獲取價格數據
         price_history = self.get_market_price_from_trades(condition_id, start_time, end_time)
         
-        if not price_history:
-            logger.warning(f"No price data found for condition {condition_id}")
-            return
+        # 聚合價格數據（默認每 15 分鐘一個數據點）
+        aggregated_prices = self.aggregate_price_by_interval(price_history, interval_seconds=interval_seconds)
         
-        # 聚合價格數據（每 15 分鐘一個數據點，獲取更多數據點）
-        aggregated_prices = self.aggregate_price_by_interval(price_history, interval_seconds=900)
+        last_closed = self._last_closed_bucket(end_time, interval_seconds, grace_seconds)
         
         # 保存到資料庫
-        self.save_price_history(condition_id, aggregated_prices)
+        if aggregated_prices:
+            self.save_price_history(condition_id, aggregated_prices)
+        else:
+            logger.info(f"No new price data for condition {condition_id}")
+        
+        # 推進水位
+        conn = self._get_db_connection()
+        cursor = conn.cursor()
+        try:
+            self._save_sync_watermarks(
+                cursor,
+                interval_seconds,
+                last_closed,
+                condition_id=condition_id
+            )
+            conn.commit()
+            
+            if aggregated_prices:
+                cursor.execute("SELECT id FROM markets WHERE conditionId = %s", (condition_id,))
+                market = cursor.fetchone()
+                if market:
+                    self.price_series_store.append_price_history_rows(
+                        [self._price_point_to_row(market[0], condition_id, point) for point in aggregated_prices],
+                        until=last_closed
+                    )
+        finally:
+            cursor.close()
+            conn.close()
         
         logger.info(f"✅ Synced {len(aggregated_prices)} price points for condition {condition_id}")
     
-    def sync_all_active_markets(self, days_back: int = 7):
+    def _iter_active_market_trades(self, start_time: int, end_time: int, interval_seconds: int,
+                                   full_resync: bool, fetch_size: int) -> Iterator[Tuple]:
+        """
+        讀取所有活躍市場在 [start_time, end_time] 內、各自水位之後的交易
+        
+        每個區間內按 (marketId, timestamp) 排序；區間按天對齊，聚合間隔不會跨區間。
+        已歸檔的日期從交易歸檔讀取，其餘日期查詢 trades 表；
+        所有市場的水位都比較新時（增量同步的常見情況）只讀取最近的未歸檔數據
+        
+        Yields:
+            (market_id, condition_id, price, amount, timestamp)
+        """
+        conn = self._get_db_connection()
+        cursor = conn.cursor(buffered=False)
+        
+        try:
+            cursor.execute("""
+                SELECT m.id, m.conditionId, w.last_closed_bucket
+                FROM markets m
+                LEFT JOIN price_sync_watermarks w
+                    ON w.market_id = m.id AND w.interval_seconds = %s
+                WHERE m.isActive = TRUE
+            """, (interval_seconds,))
+            
+            conditions = {}
+            read_from = {}
+            for market_id, condition_id, watermark in cursor.fetchall():
+                conditions[market_id] = condition_id
+                if full_resync or watermark is None:
+                    read_from[market_id] = start_time
+                else:
+                    read_from[market_id] = max(start_time, int(watermark) + interval_seconds)
+            
+            if not read_from:
+                return
+            
+            # 全量重同步時不使用水位條件
+            watermark_filter = "" if full_resync else \
+                "AND t.timestamp >= FROM_UNIXTIME(COALESCE(w.last_closed_bucket + %(interval)s, 0))"
+            archived_days = 0
+            
+            for range_from, range_to, archived in self.archive.split_range(min(read_from.values()), end_time + 1):
+                if archived:
+                    archived_days += 1
+                    table = self.archive.scan(
+                        range_from, range_to,
+                        columns=['marketId', 'price', 'amount', 'timestamp'],
+                        market_ids=list(read_from)
+                    ).sort_by([('marketId', 'ascending'), ('timestamp', 'ascending')])
+                    for batch in table.to_batches(max_chunksize=fetch_size):
+                        for market_id, price, amount, ts in zip(*(column.to_pylist() for column in batch.columns)):
+                            if ts >= read_from[market_id]:
+                                yield market_id, conditions[market_id], price, amount, ts
+                    continue
+                
+                cursor.execute(f"""
+                    SELECT 
+                        t.marketId,
+                        m.conditionId,
+                        t.price,
+                        t.amount,
+                        UNIX_TIMESTAMP(t.timestamp)
+                    FROM trades t
+                    JOIN markets m ON m.id = t.marketId
+                    LEFT JOIN price_sync_watermarks w
+                        ON w.market_id = m.id AND w.interval_seconds = %(interval)s
+                    WHERE m.isActive = TRUE
+                        AND t.timestamp >= FROM_UNIXTIME(%(start)s)
+                        AND t.timestamp < FROM_UNIXTIME(%(end)s)
+                        {watermark_filter}
+                    ORDER BY t.marketId, t.timestamp
+                """, {'interval': interval_seconds, 'start': range_from, 'end': range_to})
+                
+                while True:
+                    rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    for market_id, condition_id, price, amount, ts in rows:
+                        yield market_id, condition_id, price, amount, int(ts)
+            
+            if archived_days:
+                logger.info(f"Read {archived_days} day(s) of trades from the archive")
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def sync_all_active_markets(self, days_back: int = 7, interval_seconds: int = PRICE_INTERVAL_SECONDS,
+                                fetch_size: int = 5000, write_batch_size: int = 1000,
+                                grace_seconds: int = CLOSE_GRACE_SECONDS, full_resync: bool = False):
         """
         同步所有活躍市場的價格歷史
         
+        按 (marketId, timestamp) 順序流式讀取所有活躍市場的交易（已歸檔的日期讀取交易歸檔），
+        邊讀邊聚合：同一時間只有一個未完成的時間間隔，內存佔用與市場數量無關。
+        每個市場只讀取其同步水位（最後一個已完成間隔）之後的交易
+        
         Args:
-            days_back: 往回同步的天數
+            days_back: 首次同步往回的天數
+            interval_seconds: 聚合時間間隔（秒）
+            fetch_size: 每次從游標讀取的行數
+            write_batch_size: 每次批量寫入的價格點數
+            grace_seconds: 間隔結束後多久視為已完成
+            full_resync: 忽略水位，重新同步 days_back 天
         """
-        logger.info(f"Syncing price history for all active markets (last {days_back} days)")
+        logger.info(f"Syncing price history for all active markets (last {days_back} days, "
+                    f"mode: {'full resync' if full_resync else 'incremental'})")
         
-        conn = self._get_db_connection()
-        cursor = conn.cursor(dictionary=True)
+        end_time = int(time.time())
+        start_time = end_time - (days_back * 24 * 3600)
+        last_closed = self._last_closed_bucket(end_time, interval_seconds, grace_seconds)
+        
+        write_conn = self._get_db_connection()
+        write_cursor = write_conn.cursor()
+        
+        pending_rows = []
+        markets_synced = set()
+        points_saved = 0
+        
+        def flush():
+            nonlocal points_saved
+            if not pending_rows:
+                return
+            write_cursor.executemany(PRICE_HISTORY_UPSERT_QUERY, pending_rows)
+            write_conn.commit()
+            self.price_series_store.append_price_history_rows(pending_rows, until=last_closed)
+            points_saved += len(pending_rows)
+            pending_rows.clear()
         
         try:
-            # 獲取所有活躍市場
-            cursor.execute("""
-                SELECT conditionId, title
-                FROM markets
-                WHERE isActive = TRUE
-                ORDER BY totalVolume DESC
-                LIMIT 50
-            """)
+            trades = self._iter_active_market_trades(
+                start_time, end_time, interval_seconds, full_resync, fetch_size
+            )
             
-            markets = cursor.fetchall()
-            logger.info(f"Found {len(markets)} active markets to sync")
+            current_market = None
+            current_condition = None
+            bucket = None
             
-            synced_count = 0
-            for market in markets:
-                condition_id = market['conditionId']
-                title = market['title']
+            for market_id, condition_id, price, amount, ts in trades:
+                interval_start = (ts // interval_seconds) * interval_seconds
                 
-                try:
-                    logger.info(f"Syncing market: {title[:50]}...")
-                    self.sync_market_price_history(condition_id, days_back)
-                    synced_count += 1
-                    
-                    # 避免請求過快
-                    time.sleep(0.5)
-                    
-                except Exception as e:
-                    logger.error(f"Error syncing market {condition_id}: {e}")
+                if market_id == current_market and bucket.start == interval_start:
+                    bucket.add(price, amount)
                     continue
+                
+                if bucket is not None:
+                    pending_rows.append(
+                        self._price_point_to_row(current_market, current_condition, bucket.to_point())
+                    )
+                
+                current_market = market_id
+                current_condition = condition_id
+                markets_synced.add(market_id)
+                bucket = OhlcvBucket(interval_start, price, amount)
+                
+                if len(pending_rows) >= write_batch_size:
+                    flush()
+            
+            if bucket is not None:
+                pending_rows.append(
+                    self._price_point_to_row(current_market, current_condition, bucket.to_point())
+                )
+            flush()
             
-            logger.info(f"✅ Successfully synced {synced_count}/{len(markets)} markets")
+            # 所有活躍市場的水位推進到最後一個已完成間隔
+            self._save_sync_watermarks(
+                write_cursor,
+                interval_seconds,
+                last_closed
+            )
+            write_conn.commit()
             
+            logger.info(f"✅ Saved {points_saved} price points for {len(markets_synced)} active markets")
+            
+        except Exception as e:
+            write_conn.rollback()
+            logger.error(f"Error syncing active markets: {e}")
+            raise
         finally:
-            cursor.close()
-            conn.close()
+            write_cursor.close()
+            write_conn.close()
 
 
 # 測試代碼
@@ -327,7 +636,9 @@ if __name__ == "__main__":
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     )
     
+    import sys
+    
     service = PriceSyncService()
     
-    # 同步所有活躍市場的價格歷史（過去 7 天）
-    service.sync_all_active_markets(days_back=7)
+    # 同步所有活躍市場的價格歷史（首次同步過去 7 天，之後增量；--full-resync 忽略水位）
+    service.sync_all_active_markets(days_back=7, full_resync='--full-resync' in sys.argv)
@@ -0,0 +1,342 @@
+"""
+多窗口滾動異常檢測引擎
+為每個市場維護多個時間窗口（15 分鐘 / 1 小時 / 24 小時）的滾動統計，
+每個價格點 O(1) 攤銷更新，實時交易流和歷史回填使用同一套代碼
+"""
+
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 默認窗口（秒）及其在 anomaly_type 中的後綴
+DEFAULT_WINDOWS = (900, 3600, 86400)
+WINDOW_LABELS = {900: '15m', 3600: '1h', 86400: '24h'}
+
+# 逐筆成交檢測的 anomaly_type 前綴（例如 live_price_spike），與按 K 線檢測的結果分開保存
+LIVE_ANOMALY_PREFIX = 'live_'
+
+# 批量檢測和實時檢測共用的 market_anomalies 寫入語句（冪等）
+ANOMALY_UPSERT_QUERY = """
+    INSERT INTO market_anomalies 
+    (market_id, anomaly_type, timestamp, price_change_percent, detected_at)
+    VALUES (%s, %s, %s, %s, NOW())
+    ON DUPLICATE KEY UPDATE
+        price_change_percent = VALUES(price_change_percent),
+        detected_at = NOW()
+"""
+
+
+def anomaly_to_row(anomaly: Dict) -> Tuple:
+    """把異常轉換為 ANOMALY_UPSERT_QUERY 的參數"""
+    return (
+        anomaly['market_id'],
+        anomaly.get('anomaly_type', 'price_spike'),
+        anomaly['timestamp'],
+        int(anomaly['price_change_percent'] * 100)  # 轉換為整數（以分為單位）
+    )
+
+
+def window_label(window_seconds: int) -> str:
+    """窗口長度的可讀標籤，例如 3600 -> '1h'"""
+    if window_seconds in WINDOW_LABELS:
+        return WINDOW_LABELS[window_seconds]
+    if window_seconds % 3600 == 0:
+        return f"{window_seconds // 3600}h"
+    if window_seconds % 60 == 0:
+        return f"{window_seconds // 60}m"
+    return f"{window_seconds}s"
+
+
+class RollingWindow:
+    """
+    固定時間長度的滾動窗口
+    
+    - 滾動最小值 / 最大值：單調雙端隊列
+    - 滾動平均值 / 標準差：Welford 算法（支持移除舊數據）
+    """
+    
+    def __init__(self, window_seconds: int):
+        self.window_seconds = window_seconds
+        self.points = deque()      # (timestamp, price)
+        self.min_deque = deque()   # 價格遞增的 (timestamp, price)
+        self.max_deque = deque()   # 價格遞減的 (timestamp, price)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+    
+    def evict(self, now: float):
+        """移除窗口外的舊數據"""
+        cutoff = now - self.window_seconds
+        while self.points and self.points[0][0] <= cutoff:
+            ts, price = self.points.popleft()
+            self._welford_remove(price)
+            if self.min_deque and self.min_deque[0][0] == ts and self.min_deque[0][1] == price:
+                self.min_deque.popleft()
+            if self.max_deque and self.max_deque[0][0] == ts and self.max_deque[0][1] == price:
+                self.max_deque.popleft()
+    
+    def push(self, timestamp: float, price: float):
+        """加入新價格點（調用前應先 evict）"""
+        self.points.append((timestamp, price))
+        self._welford_add(price)
+        
+        while self.min_deque and self.min_deque[-1][1] >= price:
+            self.min_deque.pop()
+        self.min_deque.append((timestamp, price))
+        
+        while self.max_deque and self.max_deque[-1][1] <= price:
+            self.max_deque.pop()
+        self.max_deque.append((timestamp, price))
+    
+    def _welford_add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+    
+    def _welford_remove(self, value: float):
+        if self.count <= 1:
+            self.count = 0
+            self.mean = 0.0
+            self.m2 = 0.0
+            return
+        self.count -= 1
+        delta = value - self.mean
+        self.mean -= delta / self.count
+        self.m2 -= delta * (value - self.mean)
+        # 浮點誤差可能讓 m2 略小於 0
+        if self.m2 < 0:
+            self.m2 = 0.0
+    
+    @property
+    def stddev(self) -> float:
+        if self.count < 2:
+            return 0.0
+        return (self.m2 / (self.count - 1)) ** 0.5
+    
+    @property
+    def min(self) -> Optional[float]:
+        return self.min_deque[0][1] if self.min_deque else None
+    
+    @property
+    def max(self) -> Optional[float]:
+        return self.max_deque[0][1] if self.max_deque else None
+
+
+class MarketWindowState:
+    """單個市場的所有窗口和觸發狀態"""
+    
+    def __init__(self, windows: Tuple[int, ...]):
+        self.windows = {w: RollingWindow(w) for w in windows}
+        self.last_price: Optional[float] = None
+        self.last_timestamp: Optional[float] = None
+        # 已觸發的 (window, 類型)：價格回到正常範圍前不重複觸發
+        self.active: set = set()
+
+
+class MultiWindowAnomalyDetector:
+    """
+    多窗口滾動異常檢測器
+    
+    對每個新價格點輸出三類異常：
+    - price_spike：與上一個價格點相比變動超過 spike_threshold_percent（與批量檢測器一致）
+    - zscore_breakout_<窗口>：價格偏離窗口平均值超過 z_threshold 個標準差
+    - range_breakout_<窗口>：價格突破窗口內的最高 / 最低價超過 min_range_percent
+    
+    窗口內樣本數不足 min_samples 時不做 z-score / 區間判斷，避免在冷門市場上過度觸發；
+    type_prefix 加在輸出的 anomaly_type 前（逐筆成交使用 LIVE_ANOMALY_PREFIX）
+    """
+    
+    def __init__(
+        self,
+        windows: Tuple[int, ...] = DEFAULT_WINDOWS,
+        spike_threshold_percent: float = 20.0,
+        z_threshold: float = 3.0,
+        min_range_percent: float = 2.0,
+        min_samples: int = 10,
+        type_prefix: str = ''
+    ):
+        self.windows = tuple(sorted(windows))
+        self.spike_threshold_percent = spike_threshold_percent
+        self.z_threshold = z_threshold
+        self.min_range_percent = min_range_percent
+        self.min_samples = min_samples
+        self.type_prefix = type_prefix
+        self.markets: Dict[int, MarketWindowState] = {}
+    
+    @property
+    def max_window_seconds(self) -> int:
+        return self.windows[-1]
+    
+    def _get_state(self, market_id: int) -> MarketWindowState:
+        state = self.markets.get(market_id)
+        if state is None:
+            state = MarketWindowState(self.windows)
+            self.markets[market_id] = state
+        return state
+    
+    def reset(self, market_id: Optional[int] = None):
+        """清除某個市場（或所有市場）的窗口狀態"""
+        if market_id is None:
+            self.markets.clear()
+        else:
+            self.markets.pop(market_id, None)
+    
+    def process(
+        self,
+        market_id: int,
+        timestamp,
+        price: float,
+        volume: float = 0,
+        emit: bool = True
+    ) -> List[Dict]:
+        """
+        處理一個新價格點
+        
+        Args:
+            market_id: 市場 ID
+            timestamp: datetime 或 Unix 時間戳（秒）
+            price: 價格（cents）
+            volume: 成交量
+            emit: False 時只更新窗口和觸發狀態（用於回填前的預熱），不產生異常
+        
+        Returns:
+            本次價格點觸發的異常列表
+        """
+        if isinstance(timestamp, datetime):
+            ts = timestamp.timestamp()
+            when = timestamp
+        else:
+            ts = float(timestamp)
+            when = datetime.fromtimestamp(ts)
+        
+        price = float(price)
+        state = self._get_state(market_id)
+        
+        # 亂序數據不進入窗口，避免破壞單調隊列
+        if state.last_timestamp is not None and ts < state.last_timestamp:
+            return []
+        
+        anomalies = []
+        
+        if emit:
+            # 1. 相鄰價格點的跳變
+            prev_price = state.last_price
+            if prev_price:
+                change = (price - prev_price) / prev_price * 100
+                if abs(change) >= self.spike_threshold_percent:
+                    anomalies.append(self._build_anomaly(
+                        market_id, 'price_spike', when, prev_price, price, change, volume
+                    ))
+        
+        for window_seconds, window in state.windows.items():
+            window.evict(ts)
+            
+            # 預熱時同樣更新觸發狀態，預熱結束時仍在持續的突破不會被當成新突破再次輸出
+            if window.count >= self.min_samples:
+                anomalies.extend(self._check_window(market_id, state, window, when, price, volume, emit))
+            
+            window.push(ts, price)
+        
+        state.last_price = price
+        state.last_timestamp = ts
+        
+        return anomalies
+    
+    def _check_window(self, market_id: int, state: MarketWindowState, window: RollingWindow,
+                      when: datetime, price: float, volume: float, emit: bool = True) -> List[Dict]:
+        """
+        在加入新價格點之前，用窗口的歷史統計判斷新價格是否異常
+        
+        emit=False 時只更新 state.active，不返回異常
+        """
+        anomalies = []
+        label = window_label(window.window_seconds)
+        
+        # z-score 突破
+        zscore_type = f"zscore_breakout_{label}"
+        std = window.stddev
+        if std > 0:
+            z = (price - window.mean) / std
+            if abs(z) >= self.z_threshold:
+                if zscore_type not in state.active:
+                    state.active.add(zscore_type)
+                    if emit:
+                        change = (price - window.mean) / window.mean * 100 if window.mean else 0
+                        anomaly = self._build_anomaly(
+                            market_id, zscore_type, when, window.mean, price, change, volume
+                        )
+                        anomaly['z_score'] = z
+                        anomaly['window_seconds'] = window.window_seconds
+                        anomalies.append(anomaly)
+            else:
+                state.active.discard(zscore_type)
+        
+        # 區間突破
+        range_type = f"range_breakout_{label}"
+        window_max = window.max
+        window_min = window.min
+        margin = self.min_range_percent / 100
+        breakout_ref = None
+        if window_max and price > window_max * (1 + margin):
+            breakout_ref = window_max
+        elif window_min and price < window_min * (1 - margin):
+            breakout_ref = window_min
+        
+        if breakout_ref is not None:
+            if range_type not in state.active:
+                state.active.add(range_type)
+                if emit:
+                    change = (price - breakout_ref) / breakout_ref * 100
+                    anomaly = self._build_anomaly(
+                        market_id, range_type, when, breakout_ref, price, change, volume
+                    )
+                    anomaly['window_seconds'] = window.window_seconds
+                    anomalies.append(anomaly)
+        elif window_min is not None and window_min <= price <= window_max:
+            state.active.discard(range_type)
+        
+        return anomalies
+    
+    def _build_anomaly(self, market_id: int, anomaly_type: str, when: datetime,
+                       price_before: float, price_after: float, change_percent: float,
+                       volume: float) -> Dict:
+        anomaly_type = self.type_prefix + anomaly_type
+        logger.info(f"Detected {anomaly_type}: Market {market_id}, "
+                    f"Change: {change_percent:.2f}%, Time: {when}")
+        return {
+            'market_id': market_id,
+            'anomaly_type': anomaly_type,
+            'timestamp': when,
+            'price_before': price_before,
+            'price_after': price_after,
+            'price_change_percent': change_percent,
+            'volume': volume
+        }
+    
+    def process_history(self, market_id: int, points: List[Dict], warmup_until=None) -> List[Dict]:
+        """
+        回填：按時間順序把歷史價格點送入檢測器
+        
+        Args:
+            market_id: 市場 ID
+            points: 價格點列表（price, volume, timestamp），按時間排序
+            warmup_until: 時間戳不晚於此值的點只用於預熱窗口，不產生異常
+        
+        Returns:
+            異常列表
+        """
+        anomalies = []
+        for point in points:
+            emit = warmup_until is None or point['timestamp'] > warmup_until
+            anomalies.extend(self.process(
+                market_id,
+                point['timestamp'],
+                point['price'],
+                point.get('volume') or 0,
+                emit=emit
+            ))
+        return anomalies
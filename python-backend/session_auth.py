@@ -0,0 +1,82 @@
+"""
+會話驗證
+驗證 Node 服務器簽發的會話 JWT（server/_core/sdk.ts signSession：HS256，密鑰 JWT_SECRET，
+payload 包含 openId / appId / name / exp），用於 WebSocket 連接識別用戶身份
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import time
+from http.cookies import CookieError, SimpleCookie
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# 與 shared/const.ts 的 COOKIE_NAME 一致
+SESSION_COOKIE_NAME = "app_session_id"
+
+
+def _b64decode(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def verify_session_token(token: Optional[str], secret: str,
+                         app_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    驗證會話 JWT
+    
+    Args:
+        token: JWT 字符串
+        secret: JWT_SECRET（為空時一律拒絕）
+        app_id: 期望的 appId，為空時不檢查
+    
+    Returns:
+        驗證通過時返回 payload，否則 None
+    """
+    if not token or not secret:
+        return None
+    
+    try:
+        header_segment, payload_segment, signature_segment = token.split('.')
+        header = json.loads(_b64decode(header_segment))
+        if not isinstance(header, dict) or header.get('alg') != 'HS256':
+            return None
+        
+        expected = hmac.new(
+            secret.encode(), f"{header_segment}.{payload_segment}".encode(), hashlib.sha256
+        ).digest()
+        if not hmac.compare_digest(expected, _b64decode(signature_segment)):
+            return None
+        
+        payload = json.loads(_b64decode(payload_segment))
+    except (ValueError, TypeError) as e:
+        logger.warning(f"Malformed session token: {e}")
+        return None
+    
+    if not isinstance(payload, dict):
+        return None
+    
+    exp = payload.get('exp')
+    if not isinstance(exp, (int, float)) or exp <= time.time():
+        return None
+    if not isinstance(payload.get('openId'), str) or not payload['openId']:
+        return None
+    if app_id and payload.get('appId') != app_id:
+        return None
+    
+    return payload
+
+
+def session_token_from_cookie(cookie_header: Optional[str]) -> Optional[str]:
+    """從 Cookie 請求頭中取出會話 token"""
+    if not cookie_header:
+        return None
+    try:
+        cookie = SimpleCookie(cookie_header)
+    except CookieError:
+        return None
+    morsel = cookie.get(SESSION_COOKIE_NAME)
+    return morsel.value if morsel else None
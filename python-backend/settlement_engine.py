@@ -0,0 +1,299 @@
+"""
+結算引擎
+市場結算後按持倉賬本（position_ledger）計算每個參與地址的盈虧，
+批量更新 addresses 的 win_count / loss_count / settled_count / win_rate / realized_pnl
+
+每個市場只結算一次（market_settlements 記錄已結算的市場），
+每輪只處理新結算的市場，開銷不隨歷史數據增長
+"""
+
+import logging
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+from mysql.connector import pooling
+from position_ledger import PositionLedgerService
+
+logger = logging.getLogger(__name__)
+
+# 持倉、成本和已實現盈虧都小於此值時視為沒有參與（避免浮點誤差把已平倉的地址計入結算）
+POSITION_EPSILON = 1e-6
+
+# 這批市場所有參與地址的持倉
+POSITIONS_QUERY = """
+    SELECT address_id, market_id, outcome, size, cost_basis, realized_pnl
+    FROM position_ledger
+    WHERE market_id IN ({placeholders})
+"""
+
+
+def winning_side(outcome: Optional[str]) -> Optional[str]:
+    """markets.outcome（例如 'Yes' / 'No'）轉換為 address_trades.outcome 的 YES / NO"""
+    if not outcome:
+        return None
+    side = outcome.strip().upper()
+    return side if side in ('YES', 'NO') else None
+
+
+class SettlementEngine:
+    """新結算市場的勝負和盈虧結算"""
+    
+    def __init__(self, market_batch_size: int = 200, write_batch_size: int = 1000):
+        self.market_batch_size = market_batch_size
+        self.write_batch_size = write_batch_size
+        self.db_pool = self._create_db_pool()
+        self.ledger_service = PositionLedgerService(self.db_pool)
+    
+    def _create_db_pool(self):
+        """創建資料庫連接池"""
+        db_config = {
+            'host': os.getenv('DB_HOST', 'localhost'),
+            'user': os.getenv('DB_USER', 'root'),
+            'password': os.getenv('DB_PASSWORD', ''),
+            'database': os.getenv('DB_NAME', 'polymarket_insights'),
+            'pool_name': 'settlement_pool',
+            'pool_size': 2
+        }
+        
+        # 從 DATABASE_URL 解析配置
+        database_url = os.getenv('DATABASE_URL')
+        if database_url:
+            import re
+            match = re.match(r'mysql://([^:]+):([^@]+)@([^:]+):(\d+)/([^?]+)', database_url)
+            if match:
+                db_config['user'] = match.group(1)
+                db_config['password'] = match.group(2)
+                db_config['host'] = match.group(3)
+                db_config['port'] = int(match.group(4))
+                db_config['database'] = match.group(5)
+        
+        return pooling.MySQLConnectionPool(**db_config)
+    
+    def _get_db_connection(self):
+        """從連接池獲取資料庫連接"""
+        return self.db_pool.get_connection()
+    
+    def get_unsettled_markets(self) -> List[Tuple[int, Optional[str]]]:
+        """已結算但還沒有結算記錄的市場 [(market_id, outcome)]"""
+        conn = self._get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT m.id, m.outcome
+                FROM markets m
+                LEFT JOIN market_settlements s ON s.market_id = m.id
+                WHERE m.resolved = 1
+                    AND s.market_id IS NULL
+                ORDER BY m.id
+                LIMIT %s
+            """, (self.market_batch_size,))
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def load_positions(self, market_ids: Sequence[int]) -> Dict[Tuple[int, int], Dict[str, Tuple[float, float, float]]]:
+        """
+        一次查詢這批市場所有參與地址的持倉
+        
+        Returns:
+            {(address_id, market_id): {outcome: (size, cost_basis, realized_pnl)}}
+        """
+        conn = self._get_db_connection()
+        cursor = conn.cursor(buffered=False)
+        positions: Dict[Tuple[int, int], Dict[str, Tuple[float, float, float]]] = {}
+        
+        try:
+            cursor.execute(
+                POSITIONS_QUERY.format(placeholders=', '.join(['%s'] * len(market_ids))),
+                tuple(market_ids)
+            )
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                for address_id, market_id, outcome, size, cost_basis, realized_pnl in rows:
+                    positions.setdefault((address_id, market_id), {})[outcome] = (
+                        float(size or 0), float(cost_basis or 0), float(realized_pnl or 0)
+                    )
+            return positions
+        finally:
+            cursor.close()
+            conn.close()
+    
+    @staticmethod
+    def settle_positions(positions: Dict[Tuple[int, int], Dict[str, Tuple[float, float, float]]],
+                         winners: Dict[int, str]) -> Tuple[Dict[int, List], Dict[int, List]]:
+        """
+        計算每個地址的結算結果
+        
+        盈虧 = 已實現盈虧 + 獲勝結果的持倉份數（每份兌付 1 USDC）- 剩餘持倉成本；
+        盈虧為正計一次勝利，為負計一次失敗
+        
+        Args:
+            positions: load_positions 的結果
+            winners: {market_id: 獲勝結果 YES / NO}
+        
+        Returns:
+            (地址增量 {address_id: [wins, losses, settled, pnl]},
+             市場匯總 {market_id: [participants, winners, losers, total_pnl]})
+        """
+        address_deltas: Dict[int, List] = {}
+        market_totals: Dict[int, List] = {market_id: [0, 0, 0, 0.0] for market_id in winners}
+        
+        for (address_id, market_id), by_outcome in positions.items():
+            winning = winners.get(market_id)
+            if winning is None:
+                continue
+            
+            if all(abs(value) < POSITION_EPSILON for values in by_outcome.values() for value in values):
+                continue
+            
+            cost_basis = sum(cost for _, cost, _ in by_outcome.values())
+            realized = sum(realized for _, _, realized in by_outcome.values())
+            payout = by_outcome.get(winning, (0.0, 0.0, 0.0))[0]
+            
+            pnl = realized + payout - cost_basis
+            won = 1 if pnl > POSITION_EPSILON else 0
+            lost = 1 if pnl < -POSITION_EPSILON else 0
+            
+            delta = address_deltas.setdefault(address_id, [0, 0, 0, 0.0])
+            delta[0] += won
+            delta[1] += lost
+            delta[2] += 1
+            delta[3] += pnl
+            
+            totals = market_totals[market_id]
+            totals[0] += 1
+            totals[1] += won
+            totals[2] += lost
+            totals[3] += pnl
+        
+        return address_deltas, market_totals
+    
+    def apply_settlements(self, markets: Sequence[Tuple[int, Optional[str]]],
+                          address_deltas: Dict[int, List], market_totals: Dict[int, List]):
+        """
+        在一個事務中寫入結算記錄並批量更新地址統計
+        
+        先插入 market_settlements（主鍵衝突時整個事務回滾），保證同一市場不會被重複計入
+        """
+        conn = self._get_db_connection()
+        cursor = conn.cursor()
+        
+        try:
+            settlement_rows = []
+            for market_id, outcome in markets:
+                participants, winners, losers, total_pnl = market_totals.get(market_id, (0, 0, 0, 0.0))
+                settlement_rows.append((
+                    market_id, winning_side(outcome), participants, winners, losers, round(total_pnl, 6)
+                ))
+            cursor.executemany("""
+                INSERT INTO market_settlements
+                    (market_id, winning_outcome, participants, winners, losers, total_pnl, settled_at)
+                VALUES (%s, %s, %s, %s, %s, %s, NOW())
+            """, settlement_rows)
+            
+            if address_deltas:
+                cursor.execute("""
+                    CREATE TEMPORARY TABLE IF NOT EXISTS settlement_deltas (
+                        address_id INT PRIMARY KEY,
+                        wins INT NOT NULL,
+                        losses INT NOT NULL,
+                        settled INT NOT NULL,
+                        pnl DECIMAL(20, 6) NOT NULL
+                    )
+                """)
+                cursor.execute("DELETE FROM settlement_deltas")
+                
+                delta_rows = [
+                    (address_id, wins, losses, settled, round(pnl, 6))
+                    for address_id, (wins, losses, settled, pnl) in address_deltas.items()
+                ]
+                for i in range(0, len(delta_rows), self.write_batch_size):
+                    cursor.executemany("""
+                        INSERT INTO settlement_deltas (address_id, wins, losses, settled, pnl)
+                        VALUES (%s, %s, %s, %s, %s)
+                    """, delta_rows[i:i + self.write_batch_size])
+                
+                cursor.execute("""
+                    UPDATE addresses a
+                    JOIN settlement_deltas d ON d.address_id = a.id
+                    SET a.win_count = COALESCE(a.win_count, 0) + d.wins,
+                        a.loss_count = COALESCE(a.loss_count, 0) + d.losses,
+                        a.settled_count = COALESCE(a.settled_count, 0) + d.settled,
+                        a.realized_pnl = COALESCE(a.realized_pnl, 0) + d.pnl
+                """)
+                
+                # 多表 UPDATE 中賦值順序不確定，勝率在計數更新後單獨計算
+                cursor.execute("""
+                    UPDATE addresses a
+                    JOIN settlement_deltas d ON d.address_id = a.id
+                    SET a.win_rate = CASE
+                        WHEN a.win_count + a.loss_count > 0
+                        THEN ROUND(a.win_count * 100 / (a.win_count + a.loss_count), 2)
+                        ELSE NULL
+                    END
+                """)
+                cursor.execute("DROP TEMPORARY TABLE settlement_deltas")
+            
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def settle_batch(self, markets: Sequence[Tuple[int, Optional[str]]]) -> int:
+        """
+        結算一批市場
+        
+        Returns:
+            更新的地址數量
+        """
+        winners = {}
+        for market_id, outcome in markets:
+            side = winning_side(outcome)
+            if side is None:
+                # 非 YES / NO 結果（或結果缺失）只記錄結算，不計勝負
+                logger.warning(f"Market {market_id} resolved with unsupported outcome {outcome!r}, skipping")
+                continue
+            winners[market_id] = side
+        
+        positions = self.load_positions(list(winners)) if winners else {}
+        address_deltas, market_totals = self.settle_positions(positions, winners)
+        self.apply_settlements(markets, address_deltas, market_totals)
+        return len(address_deltas)
+    
+    def run(self) -> Dict[str, int]:
+        """結算所有新結算的市場"""
+        logger.info("🚀 Starting settlement...")
+        
+        # 先把新交易應用到持倉賬本
+        self.ledger_service.run()
+        
+        total_markets = 0
+        total_addresses = 0
+        
+        while True:
+            markets = self.get_unsettled_markets()
+            if not markets:
+                break
+            
+            total_addresses += self.settle_batch(markets)
+            total_markets += len(markets)
+            logger.info(f"Settled {total_markets} markets ({total_addresses} address updates)")
+        
+        logger.info(f"✅ Settlement completed: {total_markets} markets, {total_addresses} address updates")
+        return {'markets': total_markets, 'addresses': total_addresses}
+
+
+# 測試代碼
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    
+    engine = SettlementEngine()
+    engine.run()
@@ -0,0 +1,169 @@
+"""
+Subgraph 響應緩存
+本地 SQLite 文件按 端點 + 查詢 + 變量 緩存 GraphQL 響應，只緩存不會再變化的歷史數據
+（查詢範圍早於最終性窗口 finality_seconds），重跑回填或失敗重試時不需要再請求網絡
+
+是否可以緩存由調用方按查詢語義判斷（SubgraphEndpoint.execute 的 cacheable 參數），
+最近的數據和可變狀態（例如市場結算狀態）不傳 cacheable，直接繞過緩存
+
+總大小超過 max_bytes 時按最近訪問時間淘汰
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.getenv(
+    'SUBGRAPH_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'subgraph_cache.sqlite')
+)
+
+# 淘汰到 max_bytes 的這個比例以下，避免每次寫入都觸發淘汰
+EVICT_TARGET_RATIO = 0.9
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+class SubgraphResponseCache:
+    """按最近訪問淘汰的 SQLite 響應緩存（線程安全）"""
+    
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = 512 * 1024 * 1024,
+                 finality_seconds: int = 3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.finality_seconds = finality_seconds
+        self.lock = threading.Lock()
+        
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed_at)")
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        
+        # 統計
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def key(endpoint: str, query: str, variables: Optional[Dict[str, Any]]) -> str:
+        """端點 + 查詢 + 變量的哈希（查詢去掉多餘空白，變量按鍵排序）"""
+        normalized = ' '.join(query.split())
+        raw = json.dumps([endpoint, normalized, variables or {}], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(raw.encode()).hexdigest()
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.conn.execute("SELECT body FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+    
+    def put(self, key: str, endpoint: str, data: Dict[str, Any]):
+        body = zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+        now = time.time()
+        
+        with self.lock:
+            previous = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("""
+                INSERT OR REPLACE INTO responses (key, endpoint, body, size, created_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (key, endpoint, body, len(body), now, now))
+            self.total_bytes += len(body) - (previous[0] if previous else 0)
+            
+            if self.total_bytes > self.max_bytes:
+                self._evict(int(self.max_bytes * EVICT_TARGET_RATIO))
+    
+    def _evict(self, target_bytes: int):
+        """按最近訪問時間從舊到新刪除，直到總大小不超過 target_bytes（調用方持有鎖）"""
+        removed = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            if self.total_bytes <= target_bytes:
+                break
+            removed.append((key,))
+            self.total_bytes -= size
+        
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", removed)
+        self.evictions += len(removed)
+        logger.info(f"Evicted {len(removed)} cached subgraph responses ({self.total_bytes} bytes left)")
+    
+    def is_final(self, timestamp) -> bool:
+        """時間戳是否早於最終性窗口（之後不會再有該時間之前的新數據）"""
+        return int(timestamp) <= time.time() - self.finality_seconds
+    
+    def final_boundary(self, granularity: int = 86400) -> int:
+        """
+        早於最終性窗口的最近一個 granularity 整數倍時間點
+        
+        用作查詢的時間上界：同一個 granularity 內重跑使用相同的上界（相同的緩存鍵），緩存才能命中
+        """
+        return (int(time.time()) - self.finality_seconds) // granularity * granularity
+    
+    def window_is_final(self, end_timestamp) -> Callable[[Dict[str, Any]], bool]:
+        """有時間上界的查詢：上界早於最終性窗口時結果不再變化"""
+        return lambda data: self.is_final(end_timestamp)
+    
+    def full_page_is_final(self, field: str, page_size: int,
+                           timestamp_field: str = 'timestamp') -> Callable[[Dict[str, Any]], bool]:
+        """
+        按時間升序、只有時間下界的查詢：頁面已滿且最後一條早於最終性窗口時結果不再變化
+        （不滿的頁面之後還會有新記錄加入）
+        """
+        def cacheable(data):
+            items = data.get(field) or []
+            return len(items) == page_size and self.is_final(items[-1][timestamp_field])
+        return cacheable
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'path': self.path,
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def default_cache() -> Optional[SubgraphResponseCache]:
+    """
+    進程內共享的緩存（按環境變量配置），SUBGRAPH_CACHE_ENABLED=false 時返回 None
+    """
+    global _default_cache
+    
+    if os.getenv('SUBGRAPH_CACHE_ENABLED', 'true').lower() in ('0', 'false', 'no'):
+        return None
+    
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = SubgraphResponseCache(
+                max_bytes=int(os.getenv('SUBGRAPH_CACHE_MAX_MB', '512')) * 1024 * 1024,
+                finality_seconds=int(os.getenv('SUBGRAPH_FINALITY_SECONDS', '3600'))
+            )
+        return _default_cache
@@ -3,13 +3,17 @@ Polymarket Subgraph Client
 整合 Polymarket 的 Subgraph API，獲取歷史交易數據
 """
 
-from gql import gql, Client
-from gql.transport.aiohttp import AIOHTTPTransport
+from gql import gql
 import os
 import logging
+from subgraph_cache import default_cache
+from subgraph_http import SubgraphEndpoint
 
 logger = logging.getLogger(__name__)
 
+# 沒有時間上界的查詢使用的 endTime
+OPEN_END_TIME = 2**63 - 1
+
 
 class PolymarketSubgraphClient:
     """Polymarket Subgraph 客戶端"""
@@ -34,24 +38,112 @@ class PolymarketSubgraphClient:
         self.activity_client = None
         self.positions_client = None
         
+        # 歷史查詢的本地響應緩存（SUBGRAPH_CACHE_ENABLED=false 時為 None）
+        self.cache = default_cache()
+        
         logger.info(f"Polymarket Subgraph Client initialized")
         logger.info(f"PNL endpoint: {self.pnl_endpoint}")
         logger.info(f"Activity endpoint: {self.activity_endpoint}")
         logger.info(f"Positions endpoint: {self.positions_endpoint}")
     
-    def _create_client(self, endpoint):
-        """創建 GraphQL 客戶端"""
-        transport = AIOHTTPTransport(url=endpoint)
-        return Client(transport=transport, fetch_schema_from_transport=False)
+    def _create_client(self, endpoint, name):
+        """創建端點客戶端（長連接 session，可併發查詢）"""
+        return SubgraphEndpoint(
+            endpoint,
+            name=name,
+            rate_per_second=float(os.getenv('SUBGRAPH_RATE_PER_SECOND', '10')),
+            burst=int(os.getenv('SUBGRAPH_BURST', '10')),
+            cache=self.cache
+        )
     
     async def _ensure_clients(self):
         """確保客戶端已初始化"""
         if self.pnl_client is None:
-            self.pnl_client = self._create_client(self.pnl_endpoint)
+            self.pnl_client = self._create_client(self.pnl_endpoint, 'pnl')
         if self.activity_client is None:
-            self.activity_client = self._create_client(self.activity_endpoint)
+            self.activity_client = self._create_client(self.activity_endpoint, 'activity')
         if self.positions_client is None:
-            self.positions_client = self._create_client(self.positions_endpoint)
+            self.positions_client = self._create_client(self.positions_endpoint, 'positions')
+    
+    def stats(self):
+        """各端點的請求計數和延遲直方圖"""
+        return [
+            client.stats()
+            for client in (self.pnl_client, self.activity_client, self.positions_client)
+            if client is not None
+        ]
+    
+    async def close(self):
+        """關閉所有端點的 session"""
+        for client in (self.pnl_client, self.activity_client, self.positions_client):
+            if client is not None:
+                await client.close()
+    
+    async def paginate(self, client, query, field, variables=None, page_size=1000,
+                       cursor_field='id', cursor='', cacheable=None):
+        """
+        按游標分頁的異步生成器，每次產出一頁（內存中只保留當前頁）
+        
+        query 必須接受 $first 和 $cursor 變量，按 cursor_field 升序排序並用 {cursor_field}_gt: $cursor 過濾；
+        cursor_field 的值必須唯一（例如 id），否則頁邊界上相同值的記錄會被跳過
+        
+        Args:
+            client: 端點客戶端（self.pnl_client 等）
+            query: 查詢
+            field: 結果所在的字段名
+            variables: 其他查詢變量
+            page_size: 每頁數量
+            cursor_field: 游標字段
+            cursor: 初始游標
+            cacheable: 傳給 execute，判斷每頁響應是否可以緩存
+        """
+        variables = dict(variables or {})
+        
+        while True:
+            result = await client.execute(query, {**variables, 'first': page_size, 'cursor': cursor}, cacheable)
+            page = result.get(field) or []
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            cursor = page[-1][cursor_field]
+    
+    @staticmethod
+    async def _collect(pages):
+        """把分頁結果合併為列表"""
+        items = []
+        async for page in pages:
+            items.extend(page)
+        return items
+    
+    USER_POSITIONS_QUERY = """
+        query GetUserPositions($userAddress: String!, $first: Int!, $cursor: String!) {
+            userPositions(
+                where: { user: $userAddress, id_gt: $cursor }
+                orderBy: id
+                orderDirection: asc
+                first: $first
+            ) {
+                id
+                user
+                tokenId
+                amount
+                avgPrice
+                realizedPnl
+                totalBought
+            }
+        }
+    """
+    
+    async def iter_user_positions(self, user_address, page_size=1000):
+        """按頁產出用戶所有持倉"""
+        await self._ensure_clients()
+        
+        async for page in self.paginate(
+            self.pnl_client, gql(self.USER_POSITIONS_QUERY), 'userPositions',
+            {"userAddress": user_address.lower()}, page_size
+        ):
+            yield page
     
     async def get_user_positions(self, user_address):
         """
@@ -63,38 +155,71 @@ class PolymarketSubgraphClient:
         Returns:
             用戶持倉列表
         """
-        await self._ensure_clients()
-        
-        query = gql("""
-            query GetUserPositions($userAddress: String!) {
-                userPositions(
-                    where: { user: $userAddress }
-                    orderBy: totalBought
-                    orderDirection: desc
-                    first: 1000
-                ) {
-                    id
-                    user
-                    tokenId
-                    amount
-                    avgPrice
-                    realizedPnl
-                    totalBought
-                }
-            }
-        """)
-        
-        params = {"userAddress": user_address.lower()}
-        
         try:
-            async with self.pnl_client as session:
-                result = await session.execute(query, variable_values=params)
-                logger.info(f"Retrieved {len(result['userPositions'])} positions for {user_address}")
-                return result['userPositions']
+            positions = await self._collect(self.iter_user_positions(user_address))
+            logger.info(f"Retrieved {len(positions)} positions for {user_address}")
+            return positions
         except Exception as e:
             logger.error(f"Error fetching user positions: {e}")
             return []
     
+    def _activity_ranges(self, start_time):
+        """
+        把 [start_time, 現在] 分成可以緩存的歷史部分和最近部分
+        
+        歷史部分的上界是最終性窗口之前的整天邊界，結果不再變化且同一天內的重跑使用相同的查詢變量；
+        最近部分沒有上界，每次都請求網絡。沒有緩存時只有一個範圍
+        
+        Returns:
+            [(start_time, end_time, cacheable)]
+        """
+        if self.cache is None:
+            return [(start_time, OPEN_END_TIME, None)]
+        
+        boundary = self.cache.final_boundary()
+        if boundary < start_time:
+            return [(start_time, OPEN_END_TIME, None)]
+        return [
+            (start_time, boundary, self.cache.window_is_final(boundary)),
+            (boundary + 1, OPEN_END_TIME, None),
+        ]
+    
+    MARKET_ACTIVITY_QUERY = """
+        query GetMarketActivity($conditionId: String!, $startTime: BigInt!, $endTime: BigInt!,
+                                $first: Int!, $cursor: String!) {
+            %s(
+                where: { 
+                    condition: $conditionId
+                    timestamp_gte: $startTime
+                    timestamp_lte: $endTime
+                    id_gt: $cursor
+                }
+                orderBy: id
+                orderDirection: asc
+                first: $first
+            ) { %s }
+        }
+    """
+    
+    async def iter_market_activity(self, condition_id, start_time=0, page_size=1000):
+        """
+        按頁產出市場的交易活動
+        
+        歷史部分（最終性窗口之前的整天邊界以前）的頁面可以緩存，見 _activity_ranges
+        
+        Yields:
+            (實體名 splits / merges / redemptions, 該實體的一頁記錄)
+        """
+        await self._ensure_clients()
+        
+        for entity, fields in self.ACTIVITY_ENTITIES.items():
+            query = gql(self.MARKET_ACTIVITY_QUERY % (entity, fields))
+            for range_start, range_end, cacheable in self._activity_ranges(start_time):
+                params = {"conditionId": condition_id, "startTime": str(range_start), "endTime": str(range_end)}
+                async for page in self.paginate(self.activity_client, query, entity, params, page_size,
+                                                cacheable=cacheable):
+                    yield entity, page
+    
     async def get_market_activity(self, condition_id, start_time=0, limit=1000):
         """
         獲取市場的所有交易活動
@@ -102,164 +227,203 @@ class PolymarketSubgraphClient:
         Args:
             condition_id: 市場條件 ID
             start_time: 開始時間（Unix 時間戳）
-            limit: 返回結果數量限制
+            limit: 每頁數量
         
         Returns:
-            包含 splits 和 merges 的字典
+            包含 splits、merges 和 redemptions 的字典
         """
-        await self._ensure_clients()
-        
-        query = gql("""
-            query GetMarketActivity($conditionId: String!, $startTime: BigInt!, $limit: Int!) {
-                splits(
-                    where: { 
-                        condition: $conditionId
-                        timestamp_gte: $startTime
-                    }
-                    orderBy: timestamp
-                    orderDirection: asc
-                    first: $limit
-                ) {
-                    id
-                    timestamp
-                    stakeholder
-                    amount
-                    condition
-                }
-                
-                merges(
-                    where: { 
-                        condition: $conditionId
-                        timestamp_gte: $startTime
-                    }
-                    orderBy: timestamp
-                    orderDirection: asc
-                    first: $limit
-                ) {
-                    id
-                    timestamp
-                    stakeholder
-                    amount
-                    condition
-                }
-                
-                redemptions(
-                    where: { 
-                        condition: $conditionId
-                        timestamp_gte: $startTime
-                    }
-                    orderBy: timestamp
-                    orderDirection: asc
-                    first: $limit
-                ) {
-                    id
-                    timestamp
-                    redeemer
-                    payout
-                    condition
-                }
-            }
-        """)
-        
-        params = {
-            "conditionId": condition_id,
-            "startTime": str(start_time),
-            "limit": limit
-        }
+        result = {entity: [] for entity in self.ACTIVITY_ENTITIES}
         
         try:
-            async with self.activity_client as session:
-                result = await session.execute(query, variable_values=params)
-                logger.info(f"Retrieved activity for condition {condition_id}: "
-                          f"{len(result.get('splits', []))} splits, "
-                          f"{len(result.get('merges', []))} merges, "
-                          f"{len(result.get('redemptions', []))} redemptions")
-                return result
+            async for entity, page in self.iter_market_activity(condition_id, start_time, limit):
+                result[entity].extend(page)
+            logger.info(f"Retrieved activity for condition {condition_id}: "
+                      f"{len(result['splits'])} splits, "
+                      f"{len(result['merges'])} merges, "
+                      f"{len(result['redemptions'])} redemptions")
+            return result
         except Exception as e:
             logger.error(f"Error fetching market activity: {e}")
             return {'splits': [], 'merges': [], 'redemptions': []}
     
-    async def get_whale_traders(self, min_volume=100000):
+    # 批量查詢中每個市場查詢的實體及字段
+    ACTIVITY_ENTITIES = {
+        'splits': 'id timestamp stakeholder amount condition',
+        'merges': 'id timestamp stakeholder amount condition',
+        'redemptions': 'id timestamp redeemer payout condition',
+    }
+    
+    async def get_markets_activity(self, condition_ids, start_time=0, page_size=1000):
         """
-        獲取大額交易者（最小交易量 $100,000）
+        在一個 GraphQL 請求中獲取多個市場的交易活動
+        
+        每個 (市場, 實體) 使用一個別名（例如 m3_splits），按 id 游標分頁；
+        每輪請求只包含還有下一頁的別名，直到所有別名取完。
+        歷史部分和最近部分分別查詢，歷史部分的響應可以緩存（見 _activity_ranges）
         
         Args:
-            min_volume: 最小交易量（USDC）
+            condition_ids: 市場條件 ID 列表（建議每批幾十個）
+            start_time: 開始時間（Unix 時間戳）
+            page_size: 每個別名每頁的數量
         
         Returns:
-            大額交易者列表
+            {condition_id: {'splits': [...], 'merges': [...], 'redemptions': [...]}}
         """
+        results = {
+            condition_id: {entity: [] for entity in self.ACTIVITY_ENTITIES}
+            for condition_id in condition_ids
+        }
+        
         await self._ensure_clients()
+        requests = 0
         
-        query = gql("""
-            query GetWhaleTraders($minVolume: BigInt!) {
-                userPositions(
-                    where: { totalBought_gte: $minVolume }
-                    orderBy: totalBought
-                    orderDirection: desc
-                    first: 100
-                ) {
-                    user
-                    totalBought
-                    realizedPnl
-                }
+        for range_start, range_end, cacheable in self._activity_ranges(start_time):
+            # 別名 -> (市場序號, 實體, 游標)
+            pending = {
+                f"m{index}_{entity}": (index, entity, "")
+                for index in range(len(condition_ids))
+                for entity in self.ACTIVITY_ENTITIES
             }
-        """)
+            
+            while pending:
+                definitions = ["$startTime: BigInt!", "$endTime: BigInt!", "$first: Int!"]
+                selections = []
+                params = {"startTime": str(range_start), "endTime": str(range_end), "first": page_size}
+                
+                for alias, (index, entity, cursor) in pending.items():
+                    definitions.append(f"${alias}_condition: String!")
+                    definitions.append(f"${alias}_cursor: String!")
+                    params[f"{alias}_condition"] = condition_ids[index]
+                    params[f"{alias}_cursor"] = cursor
+                    selections.append(f"""
+                        {alias}: {entity}(
+                            where: {{
+                                condition: ${alias}_condition
+                                timestamp_gte: $startTime
+                                timestamp_lte: $endTime
+                                id_gt: ${alias}_cursor
+                            }}
+                            orderBy: id
+                            orderDirection: asc
+                            first: $first
+                        ) {{ {self.ACTIVITY_ENTITIES[entity]} }}""")
+                
+                query = gql(f"query GetMarketsActivity({', '.join(definitions)}) {{{''.join(selections)}\n}}")
+                result = await self.activity_client.execute(query, params, cacheable)
+                requests += 1
+                
+                next_pending = {}
+                for alias, (index, entity, _) in pending.items():
+                    page = result.get(alias) or []
+                    results[condition_ids[index]][entity].extend(page)
+                    if len(page) == page_size:
+                        next_pending[alias] = (index, entity, page[-1]['id'])
+                pending = next_pending
+        
+        logger.info(f"Retrieved activity for {len(condition_ids)} conditions in {requests} requests")
+        return results
+    
+    WHALE_TRADERS_QUERY = """
+        query GetWhaleTraders($minVolume: BigInt!, $first: Int!, $cursor: String!) {
+            userPositions(
+                where: { totalBought_gte: $minVolume, id_gt: $cursor }
+                orderBy: id
+                orderDirection: asc
+                first: $first
+            ) {
+                id
+                user
+                totalBought
+                realizedPnl
+            }
+        }
+    """
+    
+    async def iter_whale_traders(self, min_volume=100000, page_size=1000):
+        """按頁產出所有大額交易者持倉（totalBought >= min_volume）"""
+        await self._ensure_clients()
         
         # Convert to USDC decimals (6 decimals)
         params = {"minVolume": str(min_volume * 10**6)}
         
-        try:
-            async with self.pnl_client as session:
-                result = await session.execute(query, variable_values=params)
-                logger.info(f"Retrieved {len(result['userPositions'])} whale traders")
-                return result['userPositions']
-        except Exception as e:
-            logger.error(f"Error fetching whale traders: {e}")
-            return []
+        async for page in self.paginate(
+            self.pnl_client, gql(self.WHALE_TRADERS_QUERY), 'userPositions', params, page_size
+        ):
+            yield page
     
-    async def get_early_traders(self, condition_id, end_time):
+    async def get_whale_traders(self, min_volume=100000):
         """
-        獲取早期交易者（在特定時間前就下注的地址）
+        獲取大額交易者（最小交易量 $100,000）
         
         Args:
-            condition_id: 市場條件 ID
-            end_time: 截止時間（Unix 時間戳）
+            min_volume: 最小交易量（USDC）
         
         Returns:
-            早期交易者列表
+            大額交易者列表（完整結果，按 totalBought 降序）
         """
-        await self._ensure_clients()
-        
-        query = gql("""
-            query GetEarlyTraders($conditionId: String!, $endTime: BigInt!) {
-                splits(
-                    where: { 
-                        condition: $conditionId
-                        timestamp_lte: $endTime
-                    }
-                    orderBy: amount
-                    orderDirection: desc
-                    first: 50
-                ) {
-                    id
-                    timestamp
-                    stakeholder
-                    amount
+        try:
+            whales = await self._collect(self.iter_whale_traders(min_volume))
+            whales.sort(key=lambda whale: int(whale['totalBought']), reverse=True)
+            logger.info(f"Retrieved {len(whales)} whale traders")
+            return whales
+        except Exception as e:
+            logger.error(f"Error fetching whale traders: {e}")
+            return []
+    
+    EARLY_TRADERS_QUERY = """
+        query GetEarlyTraders($conditionId: String!, $endTime: BigInt!, $first: Int!, $cursor: String!) {
+            splits(
+                where: { 
+                    condition: $conditionId
+                    timestamp_lte: $endTime
+                    id_gt: $cursor
                 }
+                orderBy: id
+                orderDirection: asc
+                first: $first
+            ) {
+                id
+                timestamp
+                stakeholder
+                amount
             }
-        """)
+        }
+    """
+    
+    async def iter_early_traders(self, condition_id, end_time, page_size=1000):
+        """按頁產出在截止時間前 split 的所有記錄"""
+        await self._ensure_clients()
         
         params = {
             "conditionId": condition_id,
             "endTime": str(end_time)
         }
         
+        # 截止時間早於最終性窗口時結果不再變化，可以緩存
+        cacheable = self.cache.window_is_final(end_time) if self.cache else None
+        
+        async for page in self.paginate(
+            self.activity_client, gql(self.EARLY_TRADERS_QUERY), 'splits', params, page_size,
+            cacheable=cacheable
+        ):
+            yield page
+    
+    async def get_early_traders(self, condition_id, end_time):
+        """
+        獲取早期交易者（在特定時間前就下注的地址）
+        
+        Args:
+            condition_id: 市場條件 ID
+            end_time: 截止時間（Unix 時間戳）
+        
+        Returns:
+            早期交易者列表（完整結果，按金額降序）
+        """
         try:
-            async with self.activity_client as session:
-                result = await session.execute(query, variable_values=params)
-                logger.info(f"Retrieved {len(result['splits'])} early traders for condition {condition_id}")
-                return result['splits']
+            splits = await self._collect(self.iter_early_traders(condition_id, end_time))
+            splits.sort(key=lambda split: int(split['amount']), reverse=True)
+            logger.info(f"Retrieved {len(splits)} early traders for condition {condition_id}")
+            return splits
         except Exception as e:
             logger.error(f"Error fetching early traders: {e}")
             return []
@@ -279,10 +443,9 @@ class PolymarketSubgraphClient:
                     }
                 }
             """)
-            async with self.pnl_client as session:
-                result = await session.execute(query)
-                logger.info(f"✅ PNL Subgraph connection successful")
-                return True
+            result = await self.pnl_client.execute(query)
+            logger.info(f"✅ PNL Subgraph connection successful")
+            return True
         except Exception as e:
             logger.error(f"❌ PNL Subgraph connection failed: {e}")
             return False
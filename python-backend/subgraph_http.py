@@ -0,0 +1,207 @@
+"""
+Subgraph HTTP 客戶端
+每個 GraphQL 端點一個長連接 aiohttp session（連接池複用），支持併發查詢、
+按端點限流、失敗重試（指數退避）以及請求計數和延遲直方圖；
+可選的本地響應緩存（subgraph_cache）用於不再變化的歷史查詢
+"""
+
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Optional
+import aiohttp
+from subgraph_cache import SubgraphResponseCache
+
+logger = logging.getLogger(__name__)
+
+# 延遲直方圖的桶上界（秒），最後一個桶為無上界
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 可重試的 HTTP 狀態碼
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class SubgraphRequestError(Exception):
+    """GraphQL 返回錯誤或重試耗盡"""
+
+
+class AsyncRateLimiter:
+    """令牌桶限流：最多連續 burst 個請求，之後每秒 rate_per_second 個"""
+    
+    def __init__(self, rate_per_second: float, burst: int):
+        self.rate_per_second = rate_per_second
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate_per_second)
+
+
+class SubgraphEndpoint:
+    """
+    單個 GraphQL 端點
+    
+    session 在第一次請求時創建並一直複用（調用方應在同一個長期運行的事件循環中使用，
+    例如 job_scheduler 的任務事件循環）；在新的事件循環中使用時自動重新創建，限流器同理，
+    舊 session 在其事件循環仍在運行時關閉。事件循環結束前應調用 close()
+    """
+    
+    def __init__(self, url: str, name: Optional[str] = None, rate_per_second: float = 10,
+                 burst: int = 10, max_connections: int = 20, max_retries: int = 4,
+                 timeout: float = 30, cache: Optional[SubgraphResponseCache] = None):
+        self.url = url
+        self.name = name or url
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.cache = cache
+        
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.limiter: Optional[AsyncRateLimiter] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        
+        # 統計
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_total = 0.0
+    
+    def _release_session(self):
+        """事件循環已變化時釋放舊 session（只能在它自己的事件循環中關閉）"""
+        session, loop = self.session, self.loop
+        self.session = None
+        if session is None or session.closed:
+            return
+        if loop is not None and not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+        else:
+            logger.warning(f"Subgraph endpoint {self.name}: previous event loop closed before close(), "
+                           f"its session was not closed")
+    
+    def _ensure_session(self):
+        loop = asyncio.get_running_loop()
+        if self.session is not None and self.loop is not loop:
+            self._release_session()
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+            self.limiter = AsyncRateLimiter(self.rate_per_second, self.burst)
+            self.loop = loop
+        return self.session
+    
+    def _record_latency(self, seconds: float):
+        self.latency_counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.latency_total += seconds
+    
+    async def execute(self, query, variables: Optional[Dict[str, Any]] = None,
+                      cacheable: Optional[Callable[[Dict[str, Any]], bool]] = None) -> Dict[str, Any]:
+        """
+        執行 GraphQL 查詢
+        
+        Args:
+            query: 查詢字符串或 gql() 解析後的文檔
+            variables: 查詢變量
+            cacheable: 判斷響應是否不再變化、可以緩存的函數；不傳時繞過緩存
+        
+        Returns:
+            響應中的 data
+        """
+        if not isinstance(query, str):
+            from graphql import print_ast
+            query = print_ast(query)
+        
+        cache_key = None
+        if self.cache is not None and cacheable is not None:
+            cache_key = self.cache.key(self.url, query, variables)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.cache_hits += 1
+                return cached
+        
+        session = self._ensure_session()
+        payload = {'query': query, 'variables': variables or {}}
+        
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire()
+            self.requests += 1
+            started = time.perf_counter()
+            retry_after = None
+            
+            try:
+                async with session.post(self.url, json=payload) as response:
+                    if response.status in RETRY_STATUSES:
+                        retry_after = response.headers.get('Retry-After')
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, response.history,
+                            status=response.status, message=await response.text()
+                        )
+                    response.raise_for_status()
+                    data = await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self._record_latency(time.perf_counter() - started)
+                self.errors += 1
+                
+                if isinstance(e, aiohttp.ClientResponseError) and e.status not in RETRY_STATUSES:
+                    raise SubgraphRequestError(f"{self.name}: HTTP {e.status}") from e
+                if attempt == self.max_retries:
+                    raise SubgraphRequestError(f"{self.name}: {e!r} after {attempt + 1} attempts") from e
+                
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt
+                self.retries += 1
+                logger.warning(f"{self.name} request failed ({e!r}), retrying in {delay}s")
+                await asyncio.sleep(delay)
+                continue
+            
+            self._record_latency(time.perf_counter() - started)
+            
+            if data.get('errors'):
+                self.errors += 1
+                raise SubgraphRequestError(f"{self.name}: {data['errors']}")
+            
+            result = data.get('data') or {}
+            if cache_key is not None and cacheable(result):
+                self.cache.put(cache_key, self.url, result)
+            return result
+    
+    def stats(self) -> Dict[str, Any]:
+        """請求計數和延遲直方圖（累計，le 為桶上界）"""
+        histogram = {}
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), self.latency_counts):
+            cumulative += count
+            histogram[str(bound)] = cumulative
+        
+        completed = sum(self.latency_counts)
+        return {
+            'endpoint': self.name,
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'cache_hits': self.cache_hits,
+            'avg_latency': self.latency_total / completed if completed else None,
+            'latency_histogram': histogram
+        }
+    
+    async def close(self):
+        if self.session is not None and self.loop is not asyncio.get_running_loop():
+            self._release_session()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
@@ -19,9 +19,41 @@ load_dotenv()
 # Polymarket Subgraph API
 POSITIONS_SUBGRAPH_URL = "https://api.goldsky.com/api/public/project_cl6mb8i9h0003e201j6li0diw/subgraphs/positions-subgraph/0.0.7/gn"
 
+# 按 id 游標分頁（skip 在深分頁時很慢且有上限）
+MARKETS_QUERY = """
+query GetMarkets($first: Int!, $where: Market_filter!) {
+  markets(
+    first: $first
+    where: $where
+    orderBy: id
+    orderDirection: asc
+  ) {
+    id
+    conditionId
+    question
+    outcomes
+    outcomePrices
+    volume
+    liquidity
+    createdAt
+    resolved
+    winningOutcomeIndex
+  }
+}
+"""
+
+PAGE_SIZE = 1000
+NUM_SHARDS = 16          # ID 空間分段數（1 / 2 / 4 / 8 / 16）
+MAX_CONCURRENCY = 4      # 同時請求的分段數
+MAX_RETRIES = 4
+PAGE_QUEUE_SIZE = 8      # 等待寫入的頁數上限，避免拉取速度超過寫入時佔用過多內存
+SERVICE_NAME = 'market_resolution'
+WRITE_BATCH_SIZE = 1000  # 每條多行 INSERT 的行數
+
 class MarketResolutionSyncer:
     def __init__(self):
         self.db_pool = self._create_db_pool()
+        self.market_index = None  # condition_id -> (id, resolved, outcome, question)，首次寫入時加載
         
     def _parse_database_url(self, url):
         """解析 DATABASE_URL"""
@@ -61,167 +93,438 @@ class MarketResolutionSyncer:
             **db_config
         )
     
-    async def fetch_markets_with_resolution(self, session):
-        """從 Positions Subgraph 獲取市場和結算狀態"""
-        query = """
-        query GetMarkets($skip: Int!) {
-          markets(
-            first: 1000
-            skip: $skip
-            orderBy: createdAt
-            orderDirection: desc
-          ) {
-            id
-            conditionId
-            question
-            outcomes
-            outcomePrices
-            volume
-            liquidity
-            createdAt
-            resolved
-            winningOutcomeIndex
-          }
-        }
+    def _shard_ranges(self):
         """
+        把市場 ID 空間（conditionId，0x 開頭的十六進制字符串）按第一個十六進制位切成 NUM_SHARDS 段
         
-        all_markets = []
-        skip = 0
+        Returns:
+            [(shard, lower, upper)]：lower 作為初始 id_gt 游標，upper 為 None 表示沒有上界
+        """
+        digits = '0123456789abcdef'
+        step = 16 // NUM_SHARDS
+        ranges = []
+        for shard in range(NUM_SHARDS):
+            lower = '' if shard == 0 else '0x' + digits[shard * step]
+            upper = '0x' + digits[(shard + 1) * step] if shard < NUM_SHARDS - 1 else None
+            ranges.append((shard, lower, upper))
+        return ranges
+    
+    def _service_name(self, shard):
+        return f"{SERVICE_NAME}:{shard}"
+    
+    def _load_checkpoints(self):
+        """讀取各分段的檢查點 {shard: (run_id, cursor, status, total_processed)}"""
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT serviceName, lastTimestamp, lastCursor, status, totalProcessed
+                FROM sync_state
+                WHERE serviceName LIKE %s
+            """, (f"{SERVICE_NAME}:%",))
+            checkpoints = {}
+            for service_name, run_id, last_cursor, status, total_processed in cursor.fetchall():
+                shard = int(service_name.rsplit(':', 1)[1])
+                checkpoints[shard] = (int(run_id), last_cursor, status, total_processed or 0)
+            return checkpoints
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def _save_checkpoint(self, shard, run_id, last_cursor, total_processed, batch_size,
+                         status='running', error_message=None):
+        """
+        保存分段檢查點（只在該頁寫入資料庫之後調用）
         
-        while True:
+        lastTimestamp 保存本輪同步的開始時間，用來區分中斷後的續跑和新一輪同步
+        """
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                INSERT INTO sync_state
+                    (serviceName, lastTimestamp, lastCursor, lastSyncAt, status, errorMessage,
+                     totalProcessed, lastBatchSize, createdAt, updatedAt)
+                VALUES
+                    (%s, %s, %s, NOW(), %s, %s, %s, %s, NOW(), NOW())
+                ON DUPLICATE KEY UPDATE
+                    lastTimestamp = VALUES(lastTimestamp),
+                    lastCursor = VALUES(lastCursor),
+                    lastSyncAt = VALUES(lastSyncAt),
+                    status = VALUES(status),
+                    errorMessage = VALUES(errorMessage),
+                    totalProcessed = VALUES(totalProcessed),
+                    lastBatchSize = VALUES(lastBatchSize),
+                    updatedAt = NOW()
+            """, (self._service_name(shard), run_id, last_cursor, status, error_message,
+                  total_processed, batch_size))
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def _plan_run(self):
+        """
+        決定本輪要同步的分段和起始游標
+        
+        上一輪有未完成（running / error）的分段時續跑上一輪：已完成的分段跳過，其餘從檢查點繼續；
+        否則開始新一輪，所有分段從頭開始
+        
+        Returns:
+            (run_id, [(shard, cursor, upper, total_processed)])
+        """
+        checkpoints = self._load_checkpoints()
+        unfinished = [cp for cp in checkpoints.values() if cp[2] != 'idle']
+        
+        if not unfinished:
+            run_id = int(datetime.now().timestamp())
+            return run_id, [(shard, lower, upper, 0) for shard, lower, upper in self._shard_ranges()]
+        
+        run_id = max(cp[0] for cp in unfinished)
+        plan = []
+        for shard, lower, upper in self._shard_ranges():
+            checkpoint = checkpoints.get(shard)
+            if checkpoint and checkpoint[0] == run_id and checkpoint[2] == 'idle':
+                continue
+            if checkpoint and checkpoint[0] == run_id and checkpoint[1]:
+                plan.append((shard, checkpoint[1], upper, checkpoint[3]))
+            else:
+                plan.append((shard, lower, upper, 0))
+        
+        print(f"♻️ Resuming sync started at {datetime.fromtimestamp(run_id)} ({len(plan)} shards left)")
+        return run_id, plan
+    
+    async def _fetch_page(self, session, cursor, upper):
+        """按 id_gt 游標獲取一頁市場，失敗時按指數退避重試"""
+        where = {'id_gt': cursor}
+        if upper is not None:
+            where['id_lt'] = upper
+        
+        last_error = None
+        for attempt in range(MAX_RETRIES):
             try:
                 async with session.post(
                     POSITIONS_SUBGRAPH_URL,
-                    json={'query': query, 'variables': {'skip': skip}},
+                    json={'query': MARKETS_QUERY, 'variables': {'first': PAGE_SIZE, 'where': where}},
                     timeout=aiohttp.ClientTimeout(total=30)
                 ) as response:
                     if response.status != 200:
-                        print(f"❌ GraphQL request failed: {response.status}")
                         text = await response.text()
-                        print(f"Response: {text}")
-                        break
+                        raise RuntimeError(f"GraphQL request failed: {response.status} {text[:200]}")
                     
                     data = await response.json()
                     
                     if 'errors' in data:
-                        print(f"❌ GraphQL errors: {data['errors']}")
-                        break
-                    
-                    markets = data.get('data', {}).get('markets', [])
-                    
-                    if not markets:
-                        break
-                    
-                    all_markets.extend(markets)
-                    print(f"✅ Fetched {len(markets)} markets (total: {len(all_markets)})")
-                    
-                    skip += 1000
-                    
-                    # 避免請求過快
-                    await asyncio.sleep(0.5)
+                        raise RuntimeError(f"GraphQL errors: {data['errors']}")
                     
+                    return data.get('data', {}).get('markets', [])
+            
+            except Exception as e:
+                last_error = e
+                await asyncio.sleep(2 ** attempt)
+        
+        raise last_error
+    
+    async def fetch_shard(self, session, shard, cursor, upper, page_queue, semaphore):
+        """
+        按 id_gt 游標順序拉取一個分段，每頁放入寫入隊列
+        
+        同一分段的頁按順序進入隊列，由寫入任務寫入後再保存檢查點
+        """
+        while True:
+            async with semaphore:
+                try:
+                    markets = await self._fetch_page(session, cursor, upper)
+                except Exception as e:
+                    print(f"❌ Error fetching shard {shard} after {cursor!r}: {e}")
+                    await page_queue.put((shard, None, cursor, str(e)))
+                    return
+            
+            if not markets:
+                await page_queue.put((shard, [], None, None))
+                return
+            
+            cursor = markets[-1]['id']
+            await page_queue.put((shard, markets, cursor, None))
+            
+            if len(markets) < PAGE_SIZE:
+                await page_queue.put((shard, [], None, None))
+                return
+    
+    async def write_pages(self, page_queue, run_id, shards, fetchers):
+        """
+        從隊列讀取頁面寫入資料庫並保存檢查點
+        
+        Args:
+            page_queue: fetch_shard 放入的 (shard, markets, cursor, error)
+            run_id: 本輪同步的開始時間
+            shards: {shard: (起始游標, 已處理數量)}
+            fetchers: {shard: 拉取任務}，寫入失敗時取消對應分段
+        
+        Returns:
+            (fetched, updated, inserted, resolved) 統計
+        """
+        cursors = {shard: cursor for shard, (cursor, _) in shards.items()}
+        totals = {shard: total for shard, (_, total) in shards.items()}
+        remaining = len(shards)
+        failed = set()
+        stats = [0, 0, 0, 0]
+        
+        while remaining:
+            shard, markets, cursor, error = await page_queue.get()
+            
+            if shard in failed:
+                # 寫入失敗的分段停在最後的檢查點，已在隊列中的頁面丟棄，下次從檢查點續跑
+                continue
+            
+            if error is not None:
+                self._save_checkpoint(shard, run_id, cursor, totals[shard], 0,
+                                      status='error', error_message=error[:1000])
+                remaining -= 1
+                continue
+            
+            if not markets:
+                # 分段完成
+                self._save_checkpoint(shard, run_id, None, totals[shard], 0, status='idle')
+                remaining -= 1
+                continue
+            
+            try:
+                updated, inserted, resolved = await asyncio.to_thread(self.update_markets_in_db, markets)
             except Exception as e:
-                print(f"❌ Error fetching markets: {e}")
-                break
+                print(f"❌ Error writing shard {shard}: {e}")
+                self._save_checkpoint(shard, run_id, cursors[shard], totals[shard], 0,
+                                      status='error', error_message=str(e)[:1000])
+                fetchers[shard].cancel()
+                failed.add(shard)
+                remaining -= 1
+                continue
+            
+            cursors[shard] = cursor
+            totals[shard] += len(markets)
+            self._save_checkpoint(shard, run_id, cursor, totals[shard], len(markets))
+            
+            stats[0] += len(markets)
+            stats[1] += updated
+            stats[2] += inserted
+            stats[3] += resolved
+            print(f"✅ Shard {shard}: {len(markets)} markets (total fetched: {stats[0]})")
         
-        return all_markets
+        return stats
+    
+    def load_market_index(self):
+        """
+        一次讀取資料庫中已有市場的 condition_id -> (id, resolved, outcome, question)
+        
+        同步時用它在內存中判斷新市場和有變化的市場，不再逐個查詢
+        """
+        conn = self.db_pool.get_connection()
+        cursor = conn.cursor(buffered=False)
+        index = {}
+        
+        try:
+            cursor.execute("""
+                SELECT condition_id, id, resolved, outcome, question
+                FROM markets
+                WHERE condition_id IS NOT NULL
+            """)
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                for condition_id, market_id, resolved, outcome, question in rows:
+                    index[condition_id] = (market_id, 1 if resolved else 0, outcome, question or '')
+        finally:
+            cursor.close()
+            conn.close()
+        
+        print(f"📚 Loaded {len(index)} existing markets")
+        return index
     
     def update_markets_in_db(self, markets):
-        """更新數據庫中的市場數據"""
+        """
+        更新數據庫中的市場數據（一頁一個事務）
+        
+        只寫入新市場和 resolved / outcome / question 有變化的市場：
+        變化的市場批量寫入臨時表後用一條 JOIN UPDATE 更新，新市場用多行 INSERT 插入
+        （conditionId 已存在但 condition_id 未填的市場按唯一鍵補全，不重複插入）
+        
+        Returns:
+            (updated, inserted, resolved) 數量；寫入失敗時回滾並拋出異常，由調用方保留檢查點
+        """
+        if self.market_index is None:
+            self.market_index = self.load_market_index()
+        
+        changed_rows = []
+        changed_ids = []
+        new_rows = []
+        resolved_count = 0
+        
+        for market in markets:
+            condition_id = market['conditionId']
+            question = market.get('question') or ''
+            resolved = 1 if market.get('resolved', False) else 0
+            winning_outcome_index = market.get('winningOutcomeIndex')
+            
+            # 判斷結算結果
+            if resolved and winning_outcome_index is not None:
+                outcomes = market.get('outcomes', [])
+                if winning_outcome_index < len(outcomes):
+                    outcome = outcomes[winning_outcome_index]
+                else:
+                    outcome = 'Unknown'
+                resolved_count += 1
+            else:
+                outcome = None
+            
+            existing = self.market_index.get(condition_id)
+            if existing is None:
+                new_rows.append((condition_id, question, resolved, outcome, 'Unknown'))
+            elif existing[1:] != (resolved, outcome, question):
+                changed_rows.append((existing[0], resolved, outcome, question))
+                changed_ids.append(condition_id)
+        
+        if not changed_rows and not new_rows:
+            return 0, 0, resolved_count
+        
         conn = self.db_pool.get_connection()
         cursor = conn.cursor()
-        
-        updated_count = 0
         inserted_count = 0
-        resolved_count = 0
+        new_ids = {}
         
         try:
-            for market in markets:
-                condition_id = market['conditionId']
-                question = market.get('question', '')
-                resolved = market.get('resolved', False)
-                winning_outcome_index = market.get('winningOutcomeIndex')
-                
-                # 判斷結算結果
-                if resolved and winning_outcome_index is not None:
-                    outcomes = market.get('outcomes', [])
-                    if winning_outcome_index < len(outcomes):
-                        outcome = outcomes[winning_outcome_index]
-                    else:
-                        outcome = 'Unknown'
-                    resolved_count += 1
-                else:
-                    outcome = None
-                
-                # 檢查市場是否已存在
+            if changed_rows:
+                cursor.execute("""
+                    CREATE TEMPORARY TABLE IF NOT EXISTS market_resolution_staging (
+                        id INT PRIMARY KEY,
+                        resolved BOOLEAN,
+                        outcome VARCHAR(255),
+                        question TEXT
+                    )
+                """)
+                cursor.execute("DELETE FROM market_resolution_staging")
+                for i in range(0, len(changed_rows), WRITE_BATCH_SIZE):
+                    cursor.executemany("""
+                        INSERT INTO market_resolution_staging (id, resolved, outcome, question)
+                        VALUES (%s, %s, %s, %s)
+                    """, changed_rows[i:i + WRITE_BATCH_SIZE])
                 cursor.execute("""
-                    SELECT id FROM markets 
-                    WHERE condition_id = %s
-                    LIMIT 1
-                """, (condition_id,))
+                    UPDATE markets m
+                    JOIN market_resolution_staging s ON s.id = m.id
+                    SET m.resolved = s.resolved,
+                        m.outcome = s.outcome,
+                        m.question = s.question
+                """)
+                cursor.execute("DROP TEMPORARY TABLE market_resolution_staging")
+            
+            for i in range(0, len(new_rows), WRITE_BATCH_SIZE):
+                batch = new_rows[i:i + WRITE_BATCH_SIZE]
+                condition_ids = [row[0] for row in batch]
+                placeholders = ', '.join(['%s'] * len(batch))
                 
-                result = cursor.fetchone()
+                # 其他服務創建的市場只有 conditionId，這些行是補全而不是新插入
+                cursor.execute(
+                    f"SELECT COUNT(*) FROM markets WHERE conditionId IN ({placeholders})",
+                    tuple(condition_ids)
+                )
+                inserted_count += len(batch) - cursor.fetchone()[0]
                 
-                if result:
-                    # 更新現有市場
-                    market_id = result[0]
-                    cursor.execute("""
-                        UPDATE markets 
-                        SET resolved = %s,
-                            outcome = %s,
-                            question = %s
-                        WHERE id = %s
-                    """, (1 if resolved else 0, outcome, question, market_id))
-                    updated_count += 1
-                else:
-                    # 插入新市場（如果數據庫中沒有這個 condition_id）
-                    try:
-                        cursor.execute("""
-                            INSERT INTO markets (
-                                condition_id, question, resolved, outcome, 
-                                category, createdAt
-                            ) VALUES (%s, %s, %s, %s, %s, NOW())
-                        """, (
-                            condition_id, 
-                            question, 
-                            1 if resolved else 0, 
-                            outcome,
-                            'Unknown'
-                        ))
-                        inserted_count += 1
-                    except mysql.connector.IntegrityError:
-                        # 如果插入失敗（可能是重複的 condition_id），跳過
-                        pass
+                # 不使用 IGNORE：其他約束錯誤直接拋出，由調用方保留檢查點
+                cursor.execute(
+                    """
+                    INSERT INTO markets (
+                        conditionId, condition_id, title, question, resolved, outcome,
+                        category, currentPrice, createdAt
+                    ) VALUES """ + ', '.join(['(%s, %s, %s, %s, %s, %s, %s, 0, NOW())'] * len(batch)) + """
+                    ON DUPLICATE KEY UPDATE
+                        condition_id = VALUES(condition_id),
+                        question = VALUES(question),
+                        resolved = VALUES(resolved),
+                        outcome = VALUES(outcome)
+                    """,
+                    tuple(
+                        value
+                        for condition_id, question, resolved, outcome, category in batch
+                        for value in (condition_id, condition_id, question, question, resolved, outcome, category)
+                    )
+                )
+                
+                cursor.execute(
+                    f"SELECT condition_id, id FROM markets WHERE condition_id IN ({placeholders})",
+                    tuple(condition_ids)
+                )
+                new_ids.update(cursor.fetchall())
             
             conn.commit()
-            print(f"✅ Updated {updated_count} markets")
-            print(f"✅ Inserted {inserted_count} new markets")
-            print(f"✅ Found {resolved_count} resolved markets")
-            
-        except Exception as e:
+        except Exception:
             conn.rollback()
-            print(f"❌ Error updating markets: {e}")
-            import traceback
-            traceback.print_exc()
+            raise
         finally:
             cursor.close()
             conn.close()
+        
+        # 提交成功後再更新內存索引
+        for condition_id, (market_id, resolved, outcome, question) in zip(changed_ids, changed_rows):
+            self.market_index[condition_id] = (market_id, resolved, outcome, question)
+        for condition_id, question, resolved, outcome, _ in new_rows:
+            if condition_id in new_ids:
+                self.market_index[condition_id] = (new_ids[condition_id], resolved, outcome, question)
+        
+        return len(changed_rows), inserted_count, resolved_count
     
     async def run(self):
-        """運行同步服務"""
+        """
+        運行同步服務
+        
+        各分段併發拉取（最多 MAX_CONCURRENCY 個請求同時進行），頁面經隊列流式寫入資料庫，
+        每頁寫入後保存檢查點；中斷後再次運行從檢查點繼續
+        """
         print("🚀 Starting market resolution sync...")
         
+        run_id, plan = self._plan_run()
+        if not plan:
+            print("✅ Market resolution sync completed!")
+            return
+        
+        for shard, cursor, _, total in plan:
+            self._save_checkpoint(shard, run_id, cursor or None, total, 0)
+        
+        page_queue = asyncio.Queue(maxsize=PAGE_QUEUE_SIZE)
+        semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        
         async with aiohttp.ClientSession() as session:
-            # 獲取市場數據
-            markets = await self.fetch_markets_with_resolution(session)
-            print(f"📊 Total markets fetched: {len(markets)}")
+            fetchers = {
+                shard: asyncio.create_task(
+                    self.fetch_shard(session, shard, cursor, upper, page_queue, semaphore)
+                )
+                for shard, cursor, upper, _ in plan
+            }
+            shards = {shard: (cursor, total) for shard, cursor, _, total in plan}
             
-            if markets:
-                # 更新數據庫
-                self.update_markets_in_db(markets)
+            try:
+                fetched, updated, inserted, resolved = await self.write_pages(
+                    page_queue, run_id, shards, fetchers
+                )
+            finally:
+                for task in fetchers.values():
+                    task.cancel()
+                await asyncio.gather(*fetchers.values(), return_exceptions=True)
         
-        print("✅ Market resolution sync completed!")
+        print(f"📊 Total markets fetched: {fetched}")
+        print(f"✅ Updated {updated} markets")
+        print(f"✅ Inserted {inserted} new markets")
+        print(f"✅ Found {resolved} resolved markets")
+        
+        failed = [shard for shard, cp in self._load_checkpoints().items() if cp[2] == 'error']
+        if failed:
+            print(f"⚠️ Shards {failed} stopped on errors, rerun to resume from their checkpoints")
+        else:
+            print("✅ Market resolution sync completed!")
 
 if __name__ == '__main__':
     syncer = MarketResolutionSyncer()
     asyncio.run(syncer.run())
+    
+    # 結算新結算的市場
+    from settlement_engine import SettlementEngine
+    SettlementEngine().run()
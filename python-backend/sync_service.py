@@ -11,6 +11,8 @@ import mysql.connector
 from mysql.connector import pooling
 import os
 from subgraph_client import PolymarketSubgraphClient
+from position_ledger import LEDGER_APPLIED, LEDGER_CHANGED, PositionLedgerService
+from address_resolver import AddressIdResolver
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +23,9 @@ class SyncService:
     def __init__(self):
         self.subgraph_client = PolymarketSubgraphClient()
         self.db_pool = self._create_db_pool()
+        self.position_ledger = PositionLedgerService(self.db_pool)
+        self.address_resolver = AddressIdResolver()
+        self.write_batch_size = 1000
         
     def _create_db_pool(self):
         """創建資料庫連接池"""
@@ -61,65 +66,65 @@ class SyncService:
         """
         logger.info(f"Starting to sync whale traders (min volume: ${min_volume})...")
         
-        # 從 Subgraph 獲取大額交易者
-        whales = await self.subgraph_client.get_whale_traders(min_volume=min_volume)
+        # 從 Subgraph 按頁獲取大額交易者，每頁寫入後再取下一頁，內存中只保留一頁
+        synced_count = 0
+        
+        try:
+            async for whales in self.subgraph_client.iter_whale_traders(min_volume=min_volume):
+                synced_count += await asyncio.to_thread(self._store_whale_traders, whales)
+                logger.info(f"Synced {synced_count} whale traders...")
+        except Exception as e:
+            logger.error(f"Error syncing whale traders: {e}")
+            raise
         
-        if not whales:
+        if not synced_count:
             logger.warning("No whale traders found")
             return
         
-        logger.info(f"Found {len(whales)} whale traders")
+        logger.info(f"✅ Successfully synced {synced_count} whale traders")
+    
+    def _store_whale_traders(self, whales):
+        """
+        寫入一頁大額交易者
         
-        # 保存到資料庫
+        Returns:
+            寫入的地址數量
+        """
         conn = self._get_db_connection()
         cursor = conn.cursor()
         
-        synced_count = 0
+        # 同一地址可能有多條持倉，與逐條寫入一致取最後一條
+        volumes = {}
+        for whale in whales:
+            volumes[whale['user'].lower()] = Decimal(whale['totalBought']) / Decimal(10**6)  # Convert from USDC decimals
+        rows = list(volumes.items())
+        synced_count = len(rows)
         
         try:
-            for whale in whales:
-                address = whale['user'].lower()
-                total_bought = Decimal(whale['totalBought']) / Decimal(10**6)  # Convert from USDC decimals
-                realized_pnl = Decimal(whale.get('realizedPnl', 0)) / Decimal(10**6)
-                
-                # 檢查地址是否已存在
+            # 一條多行語句插入新地址並更新已有地址
+            for i in range(0, len(rows), self.write_batch_size):
+                batch = rows[i:i + self.write_batch_size]
                 cursor.execute(
-                    "SELECT id FROM addresses WHERE address = %s",
-                    (address,)
+                    """
+                    INSERT INTO addresses (
+                        address,
+                        total_volume,
+                        first_seen_at,
+                        last_active_at
+                    ) VALUES """ + ', '.join(['(%s, %s, NOW(), NOW())'] * len(batch)) + """
+                    ON DUPLICATE KEY UPDATE
+                        total_volume = VALUES(total_volume),
+                        last_active_at = NOW(),
+                        updated_at = NOW()
+                    """,
+                    tuple(value for row in batch for value in row)
                 )
-                result = cursor.fetchone()
-                
-                if result:
-                    # 更新現有地址
-                    cursor.execute("""
-                        UPDATE addresses 
-                        SET total_volume = %s,
-                            last_active_at = NOW(),
-                            updated_at = NOW()
-                        WHERE address = %s
-                    """, (total_bought, address))
-                else:
-                    # 插入新地址
-                    cursor.execute("""
-                        INSERT INTO addresses (
-                            address, 
-                            total_volume,
-                            first_seen_at,
-                            last_active_at
-                        ) VALUES (%s, %s, NOW(), NOW())
-                    """, (address, total_bought))
-                
-                synced_count += 1
-                
-                if synced_count % 10 == 0:
-                    logger.info(f"Synced {synced_count}/{len(whales)} whale traders...")
             
             conn.commit()
-            logger.info(f"✅ Successfully synced {synced_count} whale traders")
+            return synced_count
             
-        except Exception as e:
+        except Exception:
             conn.rollback()
-            logger.error(f"Error syncing whale traders: {e}")
             raise
         finally:
             cursor.close()
@@ -138,6 +143,61 @@ class SyncService:
         # 獲取市場活動數據
         activity = await self.subgraph_client.get_market_activity(condition_id)
         
+        self._store_market_activity(market_id, activity)
+        
+        # 新的 split / merge 應用到持倉賬本
+        self.position_ledger.run()
+    
+    async def sync_markets_activity(self, markets, batch_size=25, concurrency=4):
+        """
+        批量同步多個市場的交易活動
+        
+        每批市場用一個 GraphQL 請求（按別名分頁）獲取，最多 concurrency 個批次同時查詢，
+        查詢完成的批次在線程中寫入資料庫，不阻塞其他批次的查詢
+        
+        Args:
+            markets: [(condition_id, market_id)]
+            batch_size: 每個請求包含的市場數
+            concurrency: 同時進行的請求數
+        
+        Returns:
+            寫入的交易數量
+        """
+        batches = [markets[i:i + batch_size] for i in range(0, len(markets), batch_size)]
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def sync_batch(batch):
+            async with semaphore:
+                activity = await self.subgraph_client.get_markets_activity(
+                    [condition_id for condition_id, _ in batch]
+                )
+            synced = 0
+            for condition_id, market_id in batch:
+                synced += await asyncio.to_thread(self._store_market_activity, market_id, activity[condition_id])
+            return synced
+        
+        results = await asyncio.gather(*(sync_batch(batch) for batch in batches), return_exceptions=True)
+        
+        synced_trades = 0
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error syncing activity for {len(batch)} markets: {result}")
+            else:
+                synced_trades += result
+        
+        logger.info(f"✅ Synced {synced_trades} trades for {len(markets)} markets in {len(batches)} batches")
+        
+        # 新的 split / merge 應用到持倉賬本
+        await asyncio.to_thread(self.position_ledger.run)
+        return synced_trades
+    
+    def _store_market_activity(self, market_id, activity):
+        """
+        寫入一個市場的 split / merge / redemption
+        
+        Returns:
+            寫入的交易數量
+        """
         splits = activity.get('splits', [])
         merges = activity.get('merges', [])
         redemptions = activity.get('redemptions', [])
@@ -147,75 +207,62 @@ class SyncService:
         conn = self._get_db_connection()
         cursor = conn.cursor()
         
-        synced_trades = 0
-        
         try:
-            # 處理 splits（買入）
-            for split in splits:
-                address = split['stakeholder'].lower()
-                amount = Decimal(split['amount']) / Decimal(10**6)
-                timestamp = datetime.fromtimestamp(int(split['timestamp']))
-                tx_hash = split['id']
-                
-                # 確保地址存在
-                address_id = self._ensure_address_exists(cursor, address)
-                
-                # 插入交易記錄
-                try:
-                    cursor.execute("""
-                        INSERT INTO address_trades (
-                            address_id,
-                            market_id,
-                            tx_hash,
-                            trade_type,
-                            amount,
-                            side,
-                            timestamp,
-                            is_whale
-                        ) VALUES (%s, %s, %s, 'split', %s, 'buy', %s, %s)
-                        ON DUPLICATE KEY UPDATE
-                            amount = VALUES(amount),
-                            is_whale = VALUES(is_whale)
-                    """, (address_id, market_id, tx_hash, amount, timestamp, amount >= 100))
-                    synced_trades += 1
-                except mysql.connector.IntegrityError:
-                    # 交易已存在，跳過
-                    pass
+            # 一次解析這個市場所有參與地址的 ID
+            address_ids = self.address_resolver.resolve(
+                cursor,
+                [row['stakeholder'].lower() for row in splits + merges]
+                + [row['redeemer'].lower() for row in redemptions]
+            )
             
-            # 處理 merges（賣出）
-            for merge in merges:
-                address = merge['stakeholder'].lower()
-                amount = Decimal(merge['amount']) / Decimal(10**6)
-                timestamp = datetime.fromtimestamp(int(merge['timestamp']))
-                tx_hash = merge['id']
-                
-                # 確保地址存在
-                address_id = self._ensure_address_exists(cursor, address)
-                
-                # 插入交易記錄
-                try:
-                    cursor.execute("""
-                        INSERT INTO address_trades (
-                            address_id,
-                            market_id,
-                            tx_hash,
-                            trade_type,
-                            amount,
-                            side,
-                            timestamp,
-                            is_whale
-                        ) VALUES (%s, %s, %s, 'merge', %s, 'sell', %s, %s)
-                        ON DUPLICATE KEY UPDATE
-                            amount = VALUES(amount),
-                            is_whale = VALUES(is_whale)
-                    """, (address_id, market_id, tx_hash, amount, timestamp, amount >= 100))
-                    synced_trades += 1
-                except mysql.connector.IntegrityError:
-                    # 交易已存在，跳過
-                    pass
+            # 構建所有交易行：splits（買入）、merges（賣出）、redemptions（結算兌付）
+            rows = []
+            for trade_type, side, items, address_field, amount_field in (
+                ('split', 'buy', splits, 'stakeholder', 'amount'),
+                ('merge', 'sell', merges, 'stakeholder', 'amount'),
+                ('redemption', 'redeem', redemptions, 'redeemer', 'payout'),
+            ):
+                for item in items:
+                    amount = Decimal(item[amount_field]) / Decimal(10**6)
+                    rows.append((
+                        address_ids[item[address_field].lower()],
+                        market_id,
+                        item['id'],
+                        trade_type,
+                        amount,
+                        side,
+                        datetime.fromtimestamp(int(item['timestamp'])),
+                        amount >= 100
+                    ))
+            
+            # 多行 upsert，每批一條語句；已應用到持倉賬本的行金額變化時標記為被修改，
+            # 由持倉賬本重建所在市場（ledger_state 必須在 amount 之前賦值，比較的是舊金額）
+            for i in range(0, len(rows), self.write_batch_size):
+                batch = rows[i:i + self.write_batch_size]
+                cursor.execute(
+                    """
+                    INSERT INTO address_trades (
+                        address_id,
+                        market_id,
+                        tx_hash,
+                        trade_type,
+                        amount,
+                        side,
+                        timestamp,
+                        is_whale
+                    ) VALUES """ + ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s)'] * len(batch)) + """
+                    ON DUPLICATE KEY UPDATE
+                        ledger_state = IF(ledger_state = %s AND amount <> VALUES(amount), %s, ledger_state),
+                        amount = VALUES(amount),
+                        is_whale = VALUES(is_whale)
+                    """,
+                    (*(value for row in batch for value in row), LEDGER_APPLIED, LEDGER_CHANGED)
+                )
+            synced_trades = len(rows)
             
             conn.commit()
             logger.info(f"✅ Successfully synced {synced_trades} trades for market {market_id}")
+            return synced_trades
             
         except Exception as e:
             conn.rollback()
@@ -225,22 +272,6 @@ class SyncService:
             cursor.close()
             conn.close()
     
-    def _ensure_address_exists(self, cursor, address):
-        """確保地址存在於資料庫中，如果不存在則創建"""
-        cursor.execute("SELECT id FROM addresses WHERE address = %s", (address,))
-        result = cursor.fetchone()
-        
-        if result:
-            return result[0]
-        
-        # 創建新地址
-        cursor.execute("""
-            INSERT INTO addresses (address, first_seen_at, last_active_at)
-            VALUES (%s, NOW(), NOW())
-        """, (address,))
-        
-        return cursor.lastrowid
-    
     async def sync_top_markets(self, limit=5):
         """
         同步資料庫中交易量最大的前 N 個市場
@@ -273,17 +304,12 @@ class SyncService:
             
             logger.info(f"Found {len(markets)} markets to sync")
             
-            # 同步每個市場的活動
-            for market in markets:
-                if market['condition_id']:
-                    logger.info(f"Syncing market: {market['title']}")
-                    await self.sync_market_activity(
-                        market['condition_id'],
-                        market['id']
-                    )
-                    
-                    # 避免請求過快
-                    await asyncio.sleep(1)
+            # 批量同步所有市場的活動
+            await self.sync_markets_activity([
+                (market['condition_id'], market['id'])
+                for market in markets
+                if market['condition_id']
+            ])
             
             logger.info(f"✅ Completed syncing {len(markets)} markets")
             
@@ -294,42 +320,73 @@ class SyncService:
             cursor.close()
             conn.close()
     
-    async def update_address_statistics(self):
-        """更新所有地址的統計數據"""
-        logger.info("Updating address statistics...")
+    async def update_address_statistics(self, chunk_size=10000):
+        """
+        更新所有地址的統計數據
         
+        address_trades 只按 address_id 分組掃描一次，匯總到臨時表；
+        再按地址 ID 區間分塊 JOIN 更新，每塊單獨提交，避免長事務鎖住 addresses
+        
+        Args:
+            chunk_size: 每塊的地址 ID 區間大小
+        """
+        logger.info("Updating address statistics...")
+        return await asyncio.to_thread(self._update_address_statistics, chunk_size)
+    
+    def _update_address_statistics(self, chunk_size):
         conn = self._get_db_connection()
         cursor = conn.cursor()
         
         try:
-            # 更新交易次數和總交易量
+            # 匯總時用一致性讀，不對 address_trades 加共享鎖
+            cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+            
+            cursor.execute("DROP TEMPORARY TABLE IF EXISTS address_trade_stats")
             cursor.execute("""
-                UPDATE addresses a
-                SET 
-                    total_trades = (
-                        SELECT COUNT(*) 
-                        FROM address_trades at 
-                        WHERE at.address_id = a.id
-                    ),
-                    total_volume = (
-                        SELECT COALESCE(SUM(amount), 0)
-                        FROM address_trades at
-                        WHERE at.address_id = a.id AND at.side = 'buy'
-                    ),
-                    avg_trade_size = (
-                        SELECT COALESCE(AVG(amount), 0)
-                        FROM address_trades at
-                        WHERE at.address_id = a.id
-                    ),
-                    last_active_at = (
-                        SELECT MAX(timestamp)
-                        FROM address_trades at
-                        WHERE at.address_id = a.id
-                    )
+                CREATE TEMPORARY TABLE address_trade_stats (
+                    address_id INT PRIMARY KEY,
+                    total_trades INT NOT NULL,
+                    total_volume DECIMAL(20, 6) NOT NULL,
+                    avg_trade_size DECIMAL(20, 6) NOT NULL,
+                    last_active_at TIMESTAMP NULL
+                )
+            """)
+            cursor.execute("""
+                INSERT INTO address_trade_stats
+                SELECT
+                    address_id,
+                    COUNT(*),
+                    COALESCE(SUM(CASE WHEN side = 'buy' THEN amount ELSE 0 END), 0),
+                    COALESCE(AVG(amount), 0),
+                    MAX(timestamp)
+                FROM address_trades
+                GROUP BY address_id
             """)
-            
             conn.commit()
-            logger.info(f"✅ Updated statistics for all addresses")
+            
+            cursor.execute("SELECT MIN(id), MAX(id) FROM addresses")
+            min_id, max_id = cursor.fetchone()
+            
+            updated = 0
+            if min_id is not None:
+                for start in range(min_id, max_id + 1, chunk_size):
+                    # 沒有交易的地址也要歸零（與原來的相關子查詢結果一致）
+                    cursor.execute("""
+                        UPDATE addresses a
+                        LEFT JOIN address_trade_stats s ON s.address_id = a.id
+                        SET 
+                            a.total_trades = COALESCE(s.total_trades, 0),
+                            a.total_volume = COALESCE(s.total_volume, 0),
+                            a.avg_trade_size = COALESCE(s.avg_trade_size, 0),
+                            a.last_active_at = s.last_active_at
+                        WHERE a.id >= %s AND a.id < %s
+                    """, (start, start + chunk_size))
+                    updated += cursor.rowcount
+                    conn.commit()
+            
+            cursor.execute("DROP TEMPORARY TABLE address_trade_stats")
+            logger.info(f"✅ Updated statistics for all addresses ({updated} changed)")
+            return updated
             
         except Exception as e:
             conn.rollback()
@@ -339,7 +396,6 @@ class SyncService:
             cursor.close()
             conn.close()
 
-
 # 測試代碼
 if __name__ == "__main__":
     import sys
@@ -359,5 +415,7 @@ if __name__ == "__main__":
         await service.update_address_statistics()
         
         logger.info("✅ Sync completed!")
+        logger.info(f"Subgraph stats: {service.subgraph_client.stats()}")
+        await service.subgraph_client.close()
     
     asyncio.run(main())
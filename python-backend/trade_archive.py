@@ -0,0 +1,407 @@
+"""
+交易歸檔服務
+把 trades 表按天（UTC）導出為 Parquet 列式文件，分析和回填任務從本地文件讀取，
+不再對線上資料庫做全表掃描
+
+目錄結構：<TRADE_ARCHIVE_DIR>/date=YYYY-MM-DD/trades.parquet
+每天的文件按 (marketId, timestamp) 排序，沒有交易的日期也會寫入空文件，
+因此「文件存在」即表示該天已完整歸檔
+
+讀取時按 TRADE_ARCHIVE_SCHEMA 解析，較早導出的文件中沒有的列讀出為 null
+（用 --rebuild-days 重新導出即可補上）
+"""
+
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional, Sequence, Tuple
+from mysql.connector import pooling
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+DAY_SECONDS = 86400
+
+DEFAULT_ARCHIVE_DIR = os.getenv(
+    'TRADE_ARCHIVE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'trade_archive')
+)
+
+# 歸檔的列（timestamp 為 Unix 時間戳，秒；price / amount / fee 與 trades 表一致，以 cents 為單位；
+# makerAmount / takerAmount 為原始金額，以最小單位計）
+TRADE_ARCHIVE_SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('marketId', pa.int32()),
+    ('conditionId', pa.string()),
+    ('makerAddress', pa.string()),
+    ('takerAddress', pa.string()),
+    ('side', pa.string()),
+    ('price', pa.int64()),
+    ('amount', pa.int64()),
+    ('fee', pa.int64()),
+    ('isWhale', pa.bool_()),
+    ('timestamp', pa.int64()),
+    ('makerAssetId', pa.string()),
+    ('takerAssetId', pa.string()),
+    ('makerAmount', pa.int64()),
+    ('takerAmount', pa.int64()),
+])
+
+
+def day_start(timestamp: int) -> int:
+    """時間戳所在 UTC 日期的開始時間"""
+    return (int(timestamp) // DAY_SECONDS) * DAY_SECONDS
+
+
+def day_label(day: int) -> str:
+    return datetime.fromtimestamp(day, tz=timezone.utc).strftime('%Y-%m-%d')
+
+
+class TradeArchiveReader:
+    """
+    歸檔讀取 API
+    
+    只依賴本地文件，不需要資料庫連接
+    """
+    
+    def __init__(self, archive_dir: str = DEFAULT_ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+    
+    def day_path(self, day: int) -> str:
+        return os.path.join(self.archive_dir, f"date={day_label(day)}", 'trades.parquet')
+    
+    def has_day(self, day: int) -> bool:
+        return os.path.exists(self.day_path(day))
+    
+    def archived_days(self) -> List[int]:
+        """所有已歸檔日期的開始時間（升序）"""
+        if not os.path.isdir(self.archive_dir):
+            return []
+        
+        days = []
+        for name in os.listdir(self.archive_dir):
+            if not name.startswith('date='):
+                continue
+            try:
+                day = datetime.strptime(name[5:], '%Y-%m-%d').replace(tzinfo=timezone.utc)
+            except ValueError:
+                continue
+            day = int(day.timestamp())
+            if self.has_day(day):
+                days.append(day)
+        return sorted(days)
+    
+    def read_day(self, day: int, columns: Optional[Sequence[str]] = None) -> pa.Table:
+        """讀取一天的交易（按 marketId, timestamp 排序）"""
+        dataset = ds.dataset(self.day_path(day), schema=TRADE_ARCHIVE_SCHEMA, format='parquet')
+        return dataset.to_table(columns=list(columns) if columns else None)
+    
+    def split_range(self, start_time: int, end_time: int) -> List[Tuple[int, int, bool]]:
+        """
+        把 [start_time, end_time) 按時間順序拆成 (from, to, archived) 區間
+        
+        每個已歸檔的日期一個區間（從歸檔讀取），相鄰的未歸檔日期合併為一個區間
+        （由調用方查詢 trades 表，通常只有最近一兩天）
+        """
+        ranges: List[Tuple[int, int, bool]] = []
+        for day in range(day_start(start_time), end_time, DAY_SECONDS):
+            day_from = max(day, start_time)
+            day_to = min(day + DAY_SECONDS, end_time)
+            archived = self.has_day(day)
+            if not archived and ranges and not ranges[-1][2]:
+                ranges[-1] = (ranges[-1][0], day_to, False)
+            else:
+                ranges.append((day_from, day_to, archived))
+        return ranges
+    
+    def scan(
+        self,
+        start_time: int,
+        end_time: int,
+        columns: Optional[Sequence[str]] = None,
+        market_ids: Optional[Sequence[int]] = None
+    ) -> pa.Table:
+        """
+        讀取時間範圍 [start_time, end_time) 內已歸檔的交易
+        
+        只打開範圍內的日期文件；過濾條件下推到 Parquet 讀取，
+        利用每個 row group 的 marketId / timestamp 統計信息跳過不相關的數據
+        
+        Args:
+            start_time: 開始時間（Unix 時間戳，秒）
+            end_time: 結束時間（Unix 時間戳，秒，不包含）
+            columns: 需要的列（默認全部）
+            market_ids: 只讀取這些市場
+        
+        Returns:
+            pyarrow.Table；範圍內未歸檔的日期不包含在結果中
+        """
+        paths = [
+            self.day_path(day)
+            for day in range(day_start(start_time), end_time, DAY_SECONDS)
+            if self.has_day(day)
+        ]
+        if not paths:
+            return TRADE_ARCHIVE_SCHEMA.empty_table().select(list(columns) if columns else TRADE_ARCHIVE_SCHEMA.names)
+        
+        dataset = ds.dataset(paths, schema=TRADE_ARCHIVE_SCHEMA, format='parquet')
+        condition = (ds.field('timestamp') >= start_time) & (ds.field('timestamp') < end_time)
+        if market_ids is not None:
+            condition = condition & ds.field('marketId').isin(list(market_ids))
+        
+        return dataset.to_table(columns=list(columns) if columns else None, filter=condition)
+    
+    def iter_rows(
+        self,
+        start_time: int,
+        end_time: int,
+        columns: Sequence[str],
+        batch_size: int = 65536
+    ) -> Iterator[Tuple]:
+        """
+        按天逐行讀取 [start_time, end_time) 內已歸檔的交易
+        
+        每天內部按 (marketId, timestamp) 排序，內存佔用只有一個批次
+        """
+        for day in range(day_start(start_time), end_time, DAY_SECONDS):
+            if not self.has_day(day):
+                continue
+            
+            read_columns = list(columns)
+            if 'timestamp' not in read_columns:
+                read_columns.append('timestamp')
+            table = self.read_day(day, columns=read_columns)
+            
+            # 範圍兩端的日期只取範圍內的部分
+            if day < start_time or day + DAY_SECONDS > end_time:
+                timestamps = table.column('timestamp')
+                table = table.filter(pc.and_(
+                    pc.greater_equal(timestamps, start_time),
+                    pc.less(timestamps, end_time)
+                ))
+            table = table.select(list(columns))
+            
+            for batch in table.to_batches(max_chunksize=batch_size):
+                yield from zip(*(column.to_pylist() for column in batch.columns))
+
+
+class TradeArchiveExporter:
+    """把 trades 表按天導出到歸檔目錄，進度記錄在 sync_state 表"""
+    
+    SERVICE_NAME = 'trade_archive'
+    
+    EXPORT_QUERY = """
+        SELECT
+            id,
+            marketId,
+            conditionId,
+            makerAddress,
+            takerAddress,
+            side,
+            price,
+            amount,
+            fee,
+            isWhale,
+            UNIX_TIMESTAMP(timestamp),
+            makerAssetId,
+            takerAssetId,
+            makerAmount,
+            takerAmount
+        FROM trades
+        WHERE timestamp >= FROM_UNIXTIME(%s)
+            AND timestamp < FROM_UNIXTIME(%s)
+        ORDER BY marketId, timestamp
+    """
+    
+    def __init__(self, archive_dir: str = DEFAULT_ARCHIVE_DIR):
+        self.reader = TradeArchiveReader(archive_dir)
+        self.db_pool = self._create_db_pool()
+    
+    def _create_db_pool(self):
+        """創建資料庫連接池"""
+        db_config = {
+            'host': os.getenv('DB_HOST', 'localhost'),
+            'user': os.getenv('DB_USER', 'root'),
+            'password': os.getenv('DB_PASSWORD', ''),
+            'database': os.getenv('DB_NAME', 'polymarket_insights'),
+            'pool_name': 'trade_archive_pool',
+            'pool_size': 2
+        }
+        
+        # 從 DATABASE_URL 解析配置
+        database_url = os.getenv('DATABASE_URL')
+        if database_url:
+            import re
+            match = re.match(r'mysql://([^:]+):([^@]+)@([^:]+):(\d+)/([^?]+)', database_url)
+            if match:
+                db_config['user'] = match.group(1)
+                db_config['password'] = match.group(2)
+                db_config['host'] = match.group(3)
+                db_config['port'] = int(match.group(4))
+                db_config['database'] = match.group(5)
+        
+        return pooling.MySQLConnectionPool(**db_config)
+    
+    def _get_db_connection(self):
+        """從連接池獲取資料庫連接"""
+        return self.db_pool.get_connection()
+    
+    def _get_checkpoint(self) -> Optional[int]:
+        """已歸檔到的時間（不包含），沒有記錄時返回 None"""
+        conn = self._get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT lastTimestamp FROM sync_state WHERE serviceName = %s",
+                (self.SERVICE_NAME,)
+            )
+            row = cursor.fetchone()
+            return int(row[0]) if row else None
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def _save_checkpoint(self, last_timestamp: int, total_processed: int, batch_size: int,
+                         status: str = 'idle', error_message: str = None):
+        conn = self._get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                INSERT INTO sync_state
+                    (serviceName, lastTimestamp, lastSyncAt, status, errorMessage,
+                     totalProcessed, lastBatchSize, createdAt, updatedAt)
+                VALUES
+                    (%s, %s, NOW(), %s, %s, %s, %s, NOW(), NOW())
+                ON DUPLICATE KEY UPDATE
+                    lastTimestamp = VALUES(lastTimestamp),
+                    lastSyncAt = VALUES(lastSyncAt),
+                    status = VALUES(status),
+                    errorMessage = VALUES(errorMessage),
+                    totalProcessed = VALUES(totalProcessed),
+                    lastBatchSize = VALUES(lastBatchSize),
+                    updatedAt = NOW()
+            """, (self.SERVICE_NAME, last_timestamp, status, error_message,
+                  total_processed, batch_size))
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def _get_first_trade_day(self) -> Optional[int]:
+        conn = self._get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT UNIX_TIMESTAMP(MIN(timestamp)) FROM trades")
+            row = cursor.fetchone()
+            return day_start(row[0]) if row and row[0] is not None else None
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def export_day(self, day: int, fetch_size: int = 50000) -> int:
+        """
+        導出一天的交易（流式讀取，每批寫入一個 row group）
+        
+        先寫入臨時文件再重命名，讀取方不會看到寫了一半的文件
+        
+        Returns:
+            導出的交易數量
+        """
+        path = self.reader.day_path(day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        
+        conn = self._get_db_connection()
+        cursor = conn.cursor(buffered=False)
+        writer = pq.ParquetWriter(tmp_path, TRADE_ARCHIVE_SCHEMA, compression='zstd')
+        exported = 0
+        
+        try:
+            cursor.execute(self.EXPORT_QUERY, (day, day + DAY_SECONDS))
+            
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                
+                columns = [list(column) for column in zip(*rows)]
+                columns[9] = [bool(value) for value in columns[9]]  # isWhale: TINYINT -> bool
+                columns[10] = [int(value) for value in columns[10]]  # UNIX_TIMESTAMP 可能返回 Decimal
+                writer.write_batch(pa.RecordBatch.from_arrays(
+                    [pa.array(column, type=field.type) for column, field in zip(columns, TRADE_ARCHIVE_SCHEMA)],
+                    schema=TRADE_ARCHIVE_SCHEMA
+                ))
+                exported += len(rows)
+            
+            writer.close()
+            writer = None
+            os.replace(tmp_path, path)
+            return exported
+        
+        finally:
+            if writer is not None:
+                writer.close()
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            cursor.close()
+            conn.close()
+    
+    def run(self, grace_seconds: int = 3600, rebuild_days: int = 0):
+        """
+        導出所有已結束、尚未歸檔的日期
+        
+        Args:
+            grace_seconds: 日期結束後再等待的時間，讓延遲寫入的交易先落庫
+            rebuild_days: 重新導出最近 N 個已歸檔的日期（補上延遲寫入的交易）
+        """
+        export_until = day_start(int(time.time()) - grace_seconds)
+        
+        checkpoint = self._get_checkpoint()
+        if checkpoint is None:
+            checkpoint = self._get_first_trade_day()
+            if checkpoint is None:
+                logger.info("No trades to archive")
+                return
+        
+        start_day = day_start(checkpoint) - rebuild_days * DAY_SECONDS
+        day = start_day
+        total = 0
+        
+        logger.info(f"Archiving trades from {day_label(start_day)} to {day_label(export_until)} (exclusive)")
+        
+        try:
+            for day in range(start_day, export_until, DAY_SECONDS):
+                exported = self.export_day(day)
+                total += exported
+                self._save_checkpoint(day + DAY_SECONDS, total, exported, status='running')
+                logger.info(f"Archived {exported} trades for {day_label(day)}")
+            
+            self._save_checkpoint(max(export_until, checkpoint), total, 0)
+            logger.info(f"✅ Archived {total} trades")
+        
+        except Exception as e:
+            logger.error(f"Error archiving trades: {e}")
+            self._save_checkpoint(day, total, 0, status='error', error_message=str(e))
+            raise
+
+
+# 測試代碼
+if __name__ == "__main__":
+    import sys
+    
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    
+    exporter = TradeArchiveExporter()
+    
+    # --rebuild-days N 重新導出最近 N 天
+    if len(sys.argv) > 2 and sys.argv[1] == '--rebuild-days':
+        exporter.run(rebuild_days=int(sys.argv[2]))
+    else:
+        exporter.run()
@@ -671,6 +671,7 @@ export interface AlertNotification {
   title: string;
   message: string;
   metadata: any;
+  dedup_key?: string | null; // Python 警報檢測器寫入的去重鍵
   is_read: boolean;
   created_at: Date;
 }